@@ -32,10 +32,12 @@ BYTE_NACK = const(0x02)
 BYTE_ACK = const(0x04)
 CMD_Type = const(0x40)  # @, set sensor type command
 CMD_Select = const(0x43)  #  C, sets modes on the fly
+CMD_WRITE = const(0x44)  # D, write data, like a mode combination, to the sensor
 CMD_MODES = const(0x41)  # I, set mode type command
 CMD_EXT_MODE = const(0x46)
 CMD_Baud = const(0x52)  # R, set the transmission baud rate
 CMD_Vers = const(0x5F)  # _,  set the version number
+MSG_CMD = const(0x40)  # command
 MSG_INFO = const(0x80)  # name command
 MSG_DATA = const(0xC0)  # data command
 MSG_EXT_MODE = const(0x46)
@@ -54,6 +56,7 @@ PCT = const(0x2)
 SI = const(0x3)
 SYM = const(0x4)
 FUNCTION_MAP = const(0x5)
+MODE_COMBOS = const(0x6)
 FMT = const(0x80)
 
 DATA8 = const(0)
@@ -69,8 +72,12 @@ RELATIVE = const(8)  # REL (Relative [-1..1])
 DISCRETE = const(4)  # DIS (Discrete [0, 1, 2, 3])
 
 STRUCT_FMT = ("B", "H", "I", "f")
+DATA_SIZE = (1, 2, 4, 4)  # Bytes per value for each data type
 
 HEARTBEAT_PERIOD = const(1000)  # time of inactivity after which we reset sensor
+TX_FIFO = const(128)  # bytes the UART takes without blocking when its tx is done
+RX_POLL_MS = const(5)  # timer period to read the UART, if it has no irq()
+RX_WAIT_MS = const(10)  # time readchar() waits for the rest of a message
 
 
 def __num_bits(x):
@@ -92,14 +99,44 @@ class LPF2(object):
         rx=None,
         tx=None,
         uart_n=None,
+        combos=None,
+        coalesce_ms=0,
+        tx_queue=0,
+        rx_ring=0,
     ):
         self.modes = modes
+        # Bitmasks of modes the hub can stream together
+        self.combos = combos if combos else []
+        # (mode, dataset) pairs the hub selected to stream together
+        self.combo = []
         self.current_mode = 0
         self.sensor_id = sensor_id
         self.connected = False
         self.payloads = {}
         self.last_nack = 0
         self.debug = debug
+        # Send updates of the current mode at most every coalesce_ms
+        self.coalesce_ms = coalesce_ms
+        self.pending = False
+        self.last_send = 0
+        # UART statistics
+        self.tx_bytes = 0
+        self.tx_frames = 0
+        # Queue of tx_queue bytes that drain() writes without blocking
+        self.tx_buf = bytearray(tx_queue) if tx_queue else None
+        self.tx_start = 0
+        self.tx_end = 0
+        self.tx_dropped = 0  # Frames that did not fit in the queue
+        self.tx_max_queued = 0
+        # Ring buffer of rx_ring bytes that an interrupt fills, see start_rx()
+        self.rx_buf = bytearray(rx_ring) if rx_ring else None
+        self.rx_chunk = bytearray(16)
+        self.rx_head = 0
+        self.rx_tail = 0
+        self.rx_skip = 0  # Bytes left in the message being received
+        self.rx_overflows = 0
+        self.rx_timer = None
+        self.rx_running = False
         self.max_packet_size = max_packet_size
         self.UART_N = uart_n
         self.TX_PIN_N = tx
@@ -146,9 +183,10 @@ class LPF2(object):
         symbol="",
         functionmap=[ABSOLUTE, ABSOLUTE],  # [in (to hub), out (from hub)]
         view=True,
+        fit=False,  # Send the smallest frame that fits variable length data
     ):
         fig, dec = format.split(".")
-        total_data_size = size * 2**data_type  # Byte size of data set.
+        total_data_size = size * DATA_SIZE[data_type]  # Byte size of data set.
         # Find the power of 2 that is greater than the length of the data
         # -1 because of the header byte.
         bit_size = __num_bits(total_data_size - 1)
@@ -163,6 +201,7 @@ class LPF2(object):
             view and functionmap[0],  # 7
             total_data_size,  # 8
             bit_size,  # 9
+            fit,  # 10
         ]
         return mode_list
 
@@ -241,7 +280,14 @@ class LPF2(object):
 
         assert len(bin_data) > 0, "Payload is empty"
         assert len(bin_data) <= bytesize, "Wrong payload size"
+        if self.modes[mode][10]:
+            # The hub only overwrites the bytes in the frame, so the data must
+            # show where it ends.
+            bit = __num_bits(len(bin_data) - 1)
 
+        self.payloads[mode] = self.build_frame(bin_data, mode, bit)
+
+    def build_frame(self, bin_data, mode, bit):
         payload = bytearray(2**bit + 5)
         payload[0] = MSG_EXT_MODE
         payload[1] = EXT_MODE_0 if mode < 8 else EXT_MODE_8
@@ -253,8 +299,43 @@ class LPF2(object):
             payload[i + 4] = bin_data[i]
             cksm ^= bin_data[i]
         payload[-1] = cksm  # No need to checksum zero bytes.
+        return payload
+
+    def combo_frame(self):
+        # Concatenate the selected datasets of all modes in the combination.
+        bin_data = bytearray()
+        for mode, dataset in self.combo:
+            n = DATA_SIZE[self.modes[mode][1][1]]
+            bin_data += self.payloads[mode][4 + dataset * n : 4 + (dataset + 1) * n]
+        assert (
+            len(bin_data) <= self.max_packet_size
+        ), "Mode combination exceeds maximum packet size"
+        return self.build_frame(
+            bin_data, self.current_mode, __num_bits(len(bin_data) - 1)
+        )
 
-        self.payloads[mode] = payload
+    def combo_fits(self, combo):
+        # Check a mode combination from the hub: advertised, with datasets the
+        # modes have, and no larger than a frame.
+        mask = 0
+        size = 0
+        for mode, dataset in combo:
+            if mode >= len(self.modes) or dataset >= self.modes[mode][1][0]:
+                return False
+            mask |= 1 << mode
+            size += DATA_SIZE[self.modes[mode][1][1]]
+        if size > self.max_packet_size:
+            return False
+        for c in self.combos:
+            if mask & c == mask:
+                return True
+        return False
+
+    def in_combo(self, mode):
+        for m, dataset in self.combo:
+            if m == mode:
+                return True
+        return False
 
     def send_payload(self, data=None, mode=None):
         """
@@ -271,11 +352,27 @@ class LPF2(object):
             mode = self.current_mode
         if data != None:
             self.load_payload(data, mode)
-        self.write(self.payloads[mode])
+        if self.combo and (mode == self.current_mode or self.in_combo(mode)):
+            self.write(self.combo_frame())
+        else:
+            self.write(self.payloads[mode])
+        self.tx_frames += 1
+        self.last_send = utime.ticks_ms()
+        self.pending = False
 
     def update_payload(self, data, mode):
-        if mode == self.current_mode:
-            self.send_payload(data, mode)
+        if mode == self.current_mode or self.in_combo(mode):
+            if (
+                self.coalesce_ms
+                and utime.ticks_diff(utime.ticks_ms(), self.last_send)
+                < self.coalesce_ms
+            ):
+                # Keep only the newest payload. heartbeat() sends it with the
+                # next NACK, or when the interval has passed.
+                self.load_payload(data, mode)
+                self.pending = True
+            else:
+                self.send_payload(data, mode)
         else:
             self.load_payload(data, mode)
 
@@ -288,7 +385,69 @@ class LPF2(object):
     def str_b(b):
         return " ".join([hex(c) for c in b])
 
+    @staticmethod
+    def msg_len(b):
+        # Length of a message from the hub, from its first byte.
+        if b & 0xC0 == MSG_CMD or b & 0xC0 == MSG_DATA:
+            return (1 << ((b >> CMD_LLL_SHIFT) & 7)) + 2
+        return 1
+
+    def start_rx(self):
+        # Read the UART from an interrupt. Use the UART's own irq() where the
+        # port has it, else poll it with a timer.
+        self.rx_head = self.rx_tail = self.rx_skip = 0
+        self.rx_running = True
+        if hasattr(self.uart, "irq") and hasattr(machine.UART, "IRQ_RXIDLE"):
+            self.uart.irq(self.rx_irq, machine.UART.IRQ_RXIDLE)
+        else:
+            self.rx_timer = machine.Timer(0)
+            self.rx_timer.init(period=RX_POLL_MS, callback=self.rx_irq)
+
+    def stop_rx(self):
+        # Stop reading in the interrupt, so the handshake reads the UART itself.
+        self.rx_running = False
+        if self.rx_timer:
+            self.rx_timer.deinit()
+            self.rx_timer = None
+        elif hasattr(self.uart, "irq") and hasattr(machine.UART, "IRQ_RXIDLE"):
+            self.uart.irq(None)
+
+    def rx_irq(self, arg):
+        # Copy received bytes to the ring buffer, and nothing else: this may
+        # run in a hard interrupt, which can't allocate memory or write to the
+        # UART under the main loop. heartbeat() answers the buffered messages.
+        if not self.rx_running:
+            return
+        size = len(self.rx_buf)
+        while self.uart.any():
+            n = self.uart.readinto(self.rx_chunk, min(self.uart.any(), 16))
+            if not n:
+                break
+            for i in range(n):
+                b = self.rx_chunk[i]
+                if self.rx_skip:
+                    self.rx_skip -= 1
+                else:
+                    self.rx_skip = self.msg_len(b) - 1
+                head = (self.rx_head + 1) % size
+                if head == self.rx_tail:
+                    self.rx_overflows += 1
+                else:
+                    self.rx_buf[self.rx_head] = b
+                    self.rx_head = head
+
     def readchar(self):
+        if self.rx_running:
+            for i in range(RX_WAIT_MS):
+                if self.rx_tail != self.rx_head:
+                    c = self.rx_buf[self.rx_tail]
+                    self.rx_tail = (self.rx_tail + 1) % len(self.rx_buf)
+                    return c
+                if self.rx_skip == 0:
+                    # Not in the middle of a message
+                    return -1
+                utime.sleep_ms(1)
+            return -1
         if self.uart.any():
             c = self.uart.read(1)
         else: # Try again once
@@ -316,6 +475,13 @@ class LPF2(object):
             self.connect()
             return
 
+        self.drain()
+        if (
+            self.pending
+            and utime.ticks_diff(utime.ticks_ms(), self.last_send) >= self.coalesce_ms
+        ):
+            self.send_payload()
+
         b = self.readchar()  # Read in any heartbeat or command bytes
         if b > 0:  # There is data, let's see what it is.
             if b == BYTE_NACK:
@@ -332,10 +498,32 @@ class LPF2(object):
                 # Calculate the checksum for two bytes.
                 if cksm == 0xFF ^ CMD_Select ^ mode:
                     self.current_mode = mode
+                    self.combo = []
                     self.send_payload()
                     if self.debug:
                         print(f"Mode switched to {mode}")
 
+            elif b & 0xC7 == CMD_WRITE:
+                self.last_nack = utime.ticks_ms()  # reset heartbeat timer
+                size = 2 ** ((b & 0b111000) >> 3)
+                ck = 0xFF ^ b
+                buf = bytearray(size)
+                for i in range(size):
+                    buf[i] = self.readchar()
+                    ck ^= buf[i]
+                if ck == self.readchar() and buf[0] & 0xF0 == 0x20:
+                    # Mode combination: 0x20 | number of entries - 1, followed
+                    # by the entries as (mode << 4) | dataset.
+                    n = (buf[0] & 0x0F) + 1
+                    combo = [(e >> 4, e & 0x0F) for e in buf[1 : n + 1]]
+                    if self.combo_fits(combo):
+                        self.combo = combo
+                        self.send_payload()
+                        if self.debug:
+                            print(f"Mode combination set to {self.combo}")
+                    elif self.debug:
+                        print(f"Mode combination {combo} ignored")
+
             elif b == CMD_EXT_MODE:
                 self.last_nack = utime.ticks_ms()  # reset heartbeat timer
                 ext_mode = self.readchar()  # 0x00 or 0x08
@@ -364,7 +552,7 @@ class LPF2(object):
                         return buf, wrt_mode
                     else:
                         print(
-                            "Checksum error. Try reducing max_packet_size to 16 if using Pybricks."
+                            "Checksum error. With Pybricks, use max_packet_size=16 or negotiate=True."
                         )
             else:
                 if self.debug:
@@ -374,7 +562,39 @@ class LPF2(object):
     def write(self, array):
         if self.debug:
             print("\n>> ", self.str_b(array))
-        return self.uart.write(array)
+        self.tx_bytes += len(array)
+        if self.tx_buf is None or not self.connected:
+            return self.uart.write(array)
+        n = len(array)
+        if self.tx_end + n > len(self.tx_buf):
+            # Move the queued bytes to the front to make room.
+            queued = self.tx_end - self.tx_start
+            if queued + n > len(self.tx_buf):
+                # Drop the whole frame, rather than sending part of it.
+                self.tx_dropped += 1
+                return 0
+            self.tx_buf[:queued] = self.tx_buf[self.tx_start : self.tx_end]
+            self.tx_start = 0
+            self.tx_end = queued
+        self.tx_buf[self.tx_end : self.tx_end + n] = array
+        self.tx_end += n
+        self.tx_max_queued = max(self.tx_max_queued, self.tx_end - self.tx_start)
+        self.drain()
+        return n
+
+    def drain(self):
+        # Write queued bytes, as far as the UART takes them without blocking.
+        if self.tx_start == self.tx_end:
+            return
+        if hasattr(self.uart, "txdone") and not self.uart.txdone():
+            return
+        end = min(self.tx_end, self.tx_start + TX_FIFO)
+        n = self.uart.write(memoryview(self.tx_buf)[self.tx_start : end])
+        if n:
+            # Keep the rest of a short write for the next time.
+            self.tx_start += n
+        if self.tx_start == self.tx_end:
+            self.tx_start = self.tx_end = 0
 
     @staticmethod
     def calc_cksm(array):
@@ -454,7 +674,7 @@ class LPF2(object):
 
     def defineModes(self):
         n_modes = len(self.modes) - 1
-        n_views = [m[7] for m in self.modes].count(True) - 1
+        n_views = [bool(m[7]) for m in self.modes].count(True) - 1
         return self.addChksm(
             bytearray(
                 [
@@ -481,13 +701,32 @@ class LPF2(object):
         self.write(
             self.buildFunctMap(mode[6], num, FUNCTION_MAP | plus_8)
         )  # write Function Map
+        if num == 0 and not plus_8 and self.combos:
+            # Mode combinations are announced with mode 0, as 16 bit masks.
+            combos = b"".join([c.to_bytes(2, "little") for c in self.combos])
+            self.write(self.str_info(combos, 0, MODE_COMBOS))
         self.write(self.buildFormat(mode[1], num, FMT | plus_8))  # write format
 
+    def write_info(self, pause_ms=20):
+        # Describe the sensor and all its modes to the hub.
+        self.write(self.setType(self.sensor_id))
+        self.write(self.defineModes())  # tell how many modes
+        self.write(self.defineBaud(115200))
+        self.write(self.defineVers("0.1", __version__))
+        num = len(self.modes) - 1
+        for mode in reversed(self.modes):
+            utime.sleep_ms(pause_ms)
+            self.setupMode(mode, num)
+            num -= 1
+
     # -----   Start everything up
 
     def connect(self):
         assert len(self.modes) > 0, "No modes (commands) defined"
         fast_uart_hub = False
+        self.stop_rx()
+        self.combo = []
+        self.tx_start = self.tx_end = 0
         self.init_pins()
         self.wrt_tx_pin(1, 5)  # Say hello!
         self.wrt_tx_pin(0, 0)
@@ -516,16 +755,7 @@ class LPF2(object):
         else:
             self.slow_uart()
             self.write(b"\x00")
-        self.write(self.setType(self.sensor_id))
-        self.write(self.defineModes())  # tell how many modes
-        self.write(self.defineBaud(115200))
-        self.write(self.defineVers("0.1", __version__))
-        num = len(self.modes) - 1
-        for mode in reversed(self.modes):
-            utime.sleep_ms(20)
-            self.setupMode(mode, num)
-            num -= 1
-
+        self.write_info()
         self.write(b"\x04")  # ACK
         end = utime.ticks_ms() + 2500
         while utime.ticks_ms() < end:  # Wait for ack
@@ -539,6 +769,8 @@ class LPF2(object):
             print("\nSuccessfully connected to hub with sensor id {}".format(self.sensor_id))
             if not fast_uart_hub:
                 self.fast_uart()
+            if self.rx_buf:
+                self.start_rx()
         else:
             print("\nFailed to connect to hub")
 
@@ -6,7 +6,7 @@ __status__ = "Production"
 
 try:
     from pybricks.iodevices import PUPDevice
-    from pybricks.tools import wait, run_task
+    from pybricks.tools import wait, run_task, StopWatch
     import ustruct as struct
 
     side = "Hub"
@@ -28,10 +28,16 @@ except ImportError:
     def wait(ms):
         pass
 
+    class StopWatch:
+        def time(self):
+            return utime.ticks_ms()
+
     # Import modules for sensor side only.
     import asyncio
     import lpf2
     import struct
+    import utime
+    from array import array
     from collections import deque
 
 try:
@@ -43,8 +49,44 @@ except ImportError:
 
 
 MAX_PKT = const(16)
+MAX_FRAME = const(32)  # Largest LPF2 data frame
+PROBE_READS = const(20)  # Reads of 5ms before a probed frame size counts as failed
 MAX_COMMANDS = const(16)
+MAX_MUX_COMMANDS = const(255)
+MUX_RETRIES = const(100)  # Reads of 5ms before a multiplexed call times out
+MUX_BUSY_READS = const(2000)  # Reads of 5ms before a busy multiplexed call times out
+DELTA_READS = const(20)  # Reads of 5ms for the first values of a delta channel
+MUX_BUSY = const(255)  # Command id with which the sensor says a call is busy
+BULK_WINDOW = const(4)  # Chunks the hub writes ahead of the sensor's acknowledgement
+BULK_READS = const(50)  # Reads without progress before the hub writes again
+BULK_RETRIES = const(5)  # Writes again before a bulk transfer fails
+# Bulk transfer messages: op, transfer id, chunk number (2 bytes), data
+BULK_PUT = const(1)  # Hub starts sending: length, CRC, chunk size, name
+BULK_DATA = const(2)  # A chunk of the blob
+BULK_GET = const(3)  # Hub starts reading: name
+BULK_READ = const(4)  # Hub asks for a chunk
+BULK_ACK = const(5)  # Sensor got all chunks before the chunk number
+BULK_INFO = const(6)  # Sensor has the blob: length, CRC
+BULK_DONE = const(7)  # Sensor got the blob with a matching CRC
+BULK_ERROR = const(8)  # Sensor has no such blob, or it got a broken one
+# Stream requests: op, sequence number, arguments. Replies: sequence number,
+# number of items with the end flag, items.
+STREAM_START = const(1)  # Call the generator
+STREAM_NEXT = const(2)  # Next items
+STREAM_STOP = const(3)  # Close the generator
+STREAM_END = const(0x80)  # No items after these
+# Buffered channel frames: number of the first sample (2 bytes), number of
+# samples, time of the first sample in us (4 bytes), then the samples, each
+# with the us since the previous one (2 bytes). A frame ends early at a
+# sample that is too long after the previous one, and the next frame starts
+# with it.
+RING_HEADER = "<HBI"
+RING_MORE = const(0x80)  # Flag in the number of samples: the frame ended early
+CLOCK_ROUNDS = const(8)  # Round trips per clock sync, of which the fastest counts
+CLOCK_SPAN = const(1000)  # ms between clock syncs before the drift counts
+TICKS_PERIOD = const(1 << 30)  # The sensor's ticks_ms() and ticks_us() wrap at this
 MAX_COMMAND_QUEUE_LENGTH = const(10)
+LATENESS_BINS = const(8)  # Heartbeat lateness histogram: <1, <2, <4 ... ms
 
 # Result holder indices
 DONE = const(0)
@@ -59,6 +101,30 @@ FROM_HUB_FORMAT = const(3)
 CALLABLE = const(4)
 ARGS_TO_HUB = const(5)
 ARGS_FROM_HUB = const(6)
+DATA_TYPE = const(7)
+BUILTIN = const(8)
+PAYLOAD = const(9)
+MEMBERS = const(10)
+PRODUCER = const(11)
+INTERVAL = const(12)
+PRODUCED = const(13)
+CACHE = const(14)
+LAST = const(15)
+DELTA = const(16)
+STREAM = const(17)
+GENERATOR = const(18)
+RING = const(19)
+SAMPLES = const(20)
+
+# LPF2 data types and their size in bytes
+DATA8 = const(0)
+DATA16 = const(1)
+DATA32 = const(2)
+DATAF = const(3)
+TYPE_SIZES = (1, 2, 4, 4)
+# Struct codes that map directly on an LPF2 data type. Not 'l', which is 8
+# bytes on 64-bit CPython.
+NATIVE_TYPES = {"b": DATA8, "h": DATA16, "i": DATA32, "f": DATAF}
 
 #: WeDo Ultrasonic sensor id
 WEDO_ULTRASONIC = const(35)
@@ -70,6 +136,170 @@ SPIKE_ULTRASONIC = const(62)
 CALLBACK = const(0)
 CHANNEL = const(1)
 
+#: Name of the mode that publishes the command table of a sensor
+SCHEMA = "_sch"
+#: Name of the mode that is shared by all multiplexed commands
+MUX = "_mux"
+#: Name of the mode with which the hub checks that it can write full frames
+PROBE = "_mps"
+#: Name of the mode for bulk transfers of blobs
+BULK = "_blk"
+CLOCK = "_clk"
+
+
+def native_type(fmt: str):
+    """Return the LPF2 data type for a format of a single signed type, else None.
+
+    Formats like '4h', '2i' or '3f' can be advertised as DATA16, DATA32 or DATAF
+    modes, so the hub receives ready-to-use values from PUPDevice.read().
+    """
+    codes = set([c for c in fmt if not c.isdigit() and c not in "<="])
+    if len(codes) == 1:
+        return NATIVE_TYPES.get(codes.pop())
+    return None
+
+
+def float_to_half(value):
+    # Return the bits of a half precision float. MicroPython's struct has no 'e'.
+    bits = struct.unpack("<I", struct.pack("<f", value))[0]
+    sign = (bits >> 16) & 0x8000
+    exp = ((bits >> 23) & 0xFF) - 112  # Rebias from 127 to 15
+    mant = bits & 0x7FFFFF
+    if exp >= 31:
+        # Too large, infinite or not a number
+        nan = (bits >> 23) & 0xFF == 0xFF and mant
+        return sign | 0x7C00 | (0x200 if nan else 0)
+    if exp <= 0:
+        # Subnormal, or too small
+        if exp < -10:
+            return sign
+        mant |= 0x800000
+        shift = 14 - exp
+        return sign | ((mant >> shift) + ((mant >> (shift - 1)) & 1))
+    # Round to nearest. A carry into the exponent is still correct.
+    return (sign | (exp << 10) | (mant >> 13)) + ((mant >> 12) & 1)
+
+
+def half_to_float(bits):
+    # Return the value of a half precision float.
+    sign = -1.0 if bits & 0x8000 else 1.0
+    exp = (bits >> 10) & 0x1F
+    mant = bits & 0x3FF
+    if exp == 0:
+        return sign * mant * 2.0**-24
+    if exp == 31:
+        return float("nan") if mant else sign * float("inf")
+    return sign * (1024 + mant) * 2.0 ** (exp - 25)
+
+
+def crc16(data, crc=0xFFFF):
+    # CRC-16/CCITT-FALSE of bytes, to check blobs from bulk transfers.
+    for b in data:
+        crc ^= b << 8
+        for i in range(8):
+            crc = (crc << 1 ^ 0x1021 if crc & 0x8000 else crc << 1) & 0xFFFF
+    return crc
+
+
+def _ticks_since(ticks, base):
+    # Signed difference of two sensor ticks, like utime.ticks_diff().
+    return (ticks - base + TICKS_PERIOD // 2) % TICKS_PERIOD - TICKS_PERIOD // 2
+
+
+def literal(text: str):
+    """Return the value of a Python literal, without running eval().
+
+    Supports the repr() of numbers, strings, bytes, True, False, None and lists,
+    tuples, dicts and sets of those. This is faster than eval() and data from
+    the other side can't run code.
+
+    Raises:
+        ValueError: If the text is not a valid literal.
+    """
+    try:
+        value, i = _parse(text, _skip(text, 0))
+    except IndexError:
+        raise ValueError("Incomplete literal")
+    if _skip(text, i) != len(text):
+        raise ValueError("Unexpected data after literal")
+    return value
+
+
+def _skip(s, i):
+    # Skip spaces
+    while i < len(s) and s[i] == " ":
+        i += 1
+    return i
+
+
+def _parse(s, i):
+    # Parse the literal that starts at s[i]. Returns its value and the index
+    # after it.
+    c = s[i]
+    if c in "([{":
+        close = ")]}"["([{".index(c)]
+        items = []
+        keys = []
+        comma = False
+        i = _skip(s, i + 1)
+        while s[i] != close:
+            value, i = _parse(s, i)
+            i = _skip(s, i)
+            if s[i] == ":":
+                keys.append(value)
+                value, i = _parse(s, _skip(s, i + 1))
+                i = _skip(s, i)
+            items.append(value)
+            comma = s[i] == ","
+            if comma:
+                i = _skip(s, i + 1)
+            elif s[i] != close:
+                raise ValueError("Expected '{}' at {}".format(close, i))
+        i += 1
+        if c == "[":
+            return items, i
+        if c == "{":
+            if items and not keys:
+                return set(items), i
+            return dict(zip(keys, items)), i
+        return (items[0] if len(items) == 1 and not comma else tuple(items)), i
+    if c in "'\"" or c == "b" and s[i + 1] in "'\"":
+        is_bytes = c == "b"
+        if is_bytes:
+            i += 1
+        quote = s[i]
+        chars = []
+        i += 1
+        while s[i] != quote:
+            c = s[i]
+            if c == "\\":
+                i += 1
+                c = s[i]
+                if c in "xu":
+                    n = 2 if c == "x" else 4
+                    c = chr(int(s[i + 1 : i + 1 + n], 16))
+                    i += n
+                else:
+                    c = {"n": "\n", "r": "\r", "t": "\t", "0": "\0"}.get(c, c)
+            chars.append(c)
+            i += 1
+        if is_bytes:
+            return bytes([ord(c) for c in chars]), i + 1
+        return "".join(chars), i + 1
+    for name, value in (("True", True), ("False", False), ("None", None)):
+        if s[i : i + len(name)] == name:
+            return value, i + len(name)
+    j = i
+    while j < len(s) and s[j] in "0123456789+-.eE":
+        j += 1
+    number = s[i:j]
+    if not number:
+        raise ValueError("Unexpected '{}' at {}".format(c, i))
+    for c in ".eE":
+        if c in number:
+            return float(number), j
+    return int(number), j
+
 
 class PUPRemote:
     """Base class for PUPRemoteHub and PUPRemoteSensor. Don't use this class directly.
@@ -85,8 +315,26 @@ class PUPRemote:
         self.commands = []
         self.modes = {}
         self.max_packet_size = max_packet_size
-
-    def add_channel(self, mode_name: str, to_hub_fmt: str = ""):
+        # Largest mode the hub writes to. A negotiating sensor keeps these to
+        # 16 bytes, which all hubs write, and only sends larger channels.
+        self.write_size = max_packet_size
+        # Multiplexed commands, sharing one mode
+        self.mux_commands = []
+        self.mux = {}
+        # Quantized formats: (struct format, scale, offset). No scale means
+        # half precision floats.
+        self.quantized = {}
+        # Bit field formats: (struct format, format before the bit fields,
+        # number of values before the bit fields, fields, bytes). Each field
+        # is a (shift, mask, type) triple, to unpack it from a single integer.
+        self.bitfields = {}
+        # Delta formats: (struct format, byte order, struct code, number of
+        # values, bitmap bytes, updates between key frames).
+        self.deltas = {}
+        # Timestamped formats: (format without the timestamp, its size)
+        self.stamped = {}
+
+    def add_channel(self, mode_name: str, to_hub_fmt: str = "", mux=False):
         """Define a data channel to read on the hub.
 
         Use this function with identical parameters on both the sensor and the hub.
@@ -98,8 +346,11 @@ class PUPRemote:
             to_hub_fmt: The format string of the data sent from the sensor to the hub.
                 Use 'repr' to receive any python object. Or use a struct format string.
                 See https://docs.python.org/3/library/struct.html
+            mux: Set to True to read the channel through the shared multiplexed mode.
         """
-        self.add_command(mode_name, to_hub_fmt=to_hub_fmt, command_type=CHANNEL)
+        self.add_command(
+            mode_name, to_hub_fmt=to_hub_fmt, command_type=CHANNEL, mux=mux
+        )
 
     def add_command(
         self,
@@ -107,6 +358,8 @@ class PUPRemote:
         to_hub_fmt: str = "",
         from_hub_fmt: str = "",
         command_type=CALLBACK,
+        mux=False,
+        refresh_ms=0,
     ):
         """Define a remote call.
 
@@ -117,50 +370,360 @@ class PUPRemote:
             to_hub_fmt: The format string of the data sent from the sensor to the hub.
                 Use 'repr' to receive any python object. Or use a struct format string.
                 See https://docs.python.org/3/library/struct.html
+                Add '*scale' or '*scale+offset' to scale integers to floats, like
+                '2h*0.01'. Use 'e' for half precision floats, like '4e'.
+                Add '|' and bit fields to pack flags and small numbers into bits,
+                like '2h|12?2u3' for 12 booleans and two 3 bit unsigned numbers.
+                Add '~' and a number to a channel to send only the values that
+                changed, and all values every that many updates, like '10h~20'.
+                The hub asks for all values when it missed an update.
+                Add '@' to a channel to send the time of each update with the
+                values, like '3h@'. See `sync_clock()` and `age()`.
             from_hub_fmt: The format string of the data sent from the hub.
             command_type: CALLBACK or CHANNEL (internal).
+            mux: Set to True to share a single LPF2 mode with the other multiplexed
+                commands. This lifts the limit of 16 commands and saves the mode
+                switch between calls. Payloads are 2 bytes smaller. Defaults to False.
+            refresh_ms: For functions without arguments. Set to a positive
+                interval to have the sensor call the function in the background,
+                at most once per interval, and keep its result like a channel.
+                The hub then reads the latest result without a round trip.
+                Defaults to 0.
         """
+        assert not (
+            refresh_ms and from_hub_fmt
+        ), "Only functions without arguments can be refreshed"
+        if refresh_ms:
+            command_type = CHANNEL
+        max_size = self.max_packet_size if command_type == CHANNEL else self.write_size
+        if mux:
+            if MUX not in self.modes:
+                self._add_mux()
+            # Room for the command id and sequence number
+            max_size = self.commands[self.modes[MUX]][SIZE] - 2
+
+        data_type = None
         if to_hub_fmt == "repr" or from_hub_fmt == "repr":
-            msg_size = self.max_packet_size
+            msg_size = max_size
             num_args_from_hub = -1
             num_args_to_hub = -1
         else:
-            size_to_hub_fmt = struct.calcsize(to_hub_fmt)
-            size_from_hub_fmt = struct.calcsize(from_hub_fmt)
+            to_hub_struct = self._add_format(to_hub_fmt)
+            from_hub_struct = self._add_format(from_hub_fmt)
+            if to_hub_struct == to_hub_fmt and from_hub_struct == from_hub_fmt:
+                # Quantized values need converting, so they can't be native.
+                data_type = native_type(to_hub_fmt + from_hub_fmt)
+            size_to_hub_fmt = struct.calcsize(to_hub_struct)
+            size_from_hub_fmt = struct.calcsize(from_hub_struct)
             msg_size = max(size_to_hub_fmt, size_from_hub_fmt)
-            num_args_to_hub = len(
-                struct.unpack(to_hub_fmt, bytearray(struct.calcsize(to_hub_fmt)))
-            )
-            num_args_from_hub = len(
-                struct.unpack(from_hub_fmt, bytearray(struct.calcsize(from_hub_fmt)))
-            )
+            num_args_to_hub = self._num_values(to_hub_fmt)
+            num_args_from_hub = self._num_values(from_hub_fmt)
 
-        assert len(self.commands) < MAX_COMMANDS, "Command limit exceeded"
-        assert msg_size <= self.max_packet_size, "Payload exceeds maximum packet size"
-        self.commands.append(
-            {
-                NAME: mode_name,
-                TO_HUB_FORMAT: to_hub_fmt,
-                SIZE: msg_size,
-                ARGS_TO_HUB: num_args_to_hub,
-            }
-        )
+        assert msg_size <= max_size, "Payload exceeds maximum packet size"
+        assert to_hub_fmt not in self.deltas or (
+            command_type == CHANNEL and not mux
+        ), "Only channels in their own mode can send deltas"
+        assert (
+            to_hub_fmt not in self.stamped or command_type == CHANNEL
+        ), "Only channels can send timestamps"
+        command = {
+            NAME: mode_name,
+            TO_HUB_FORMAT: to_hub_fmt,
+            SIZE: msg_size,
+            ARGS_TO_HUB: num_args_to_hub,
+        }
         if command_type == CALLBACK:
-            self.commands[-1][FROM_HUB_FORMAT] = from_hub_fmt
-            self.commands[-1][ARGS_FROM_HUB] = num_args_from_hub
+            command[FROM_HUB_FORMAT] = from_hub_fmt
+            command[ARGS_FROM_HUB] = num_args_from_hub
+
+        if mux:
+            assert len(self.mux_commands) < MAX_MUX_COMMANDS, "Command limit exceeded"
+            self.mux[mode_name] = len(self.mux_commands)
+            self.mux_commands.append(command)
+            return
+
+        if data_type is not None:
+            command[DATA_TYPE] = data_type
+        assert len(self.commands) < MAX_COMMANDS, "Command limit exceeded"
+        self.commands.append(command)
 
         # Build a dictionary of mode names and their index
         self.modes[mode_name] = len(self.commands) - 1
 
+    def add_snapshot(self, mode_name: str, channels):
+        """Define a snapshot mode that delivers several channels in one read.
+
+        Use this function with identical parameters on both the sensor and the hub,
+        after adding the channels. The sensor keeps the latest values of all
+        channels in the snapshot. On the hub, `read_snapshot()` returns them from
+        a single read, without switching modes for each channel.
+
+        Args:
+            mode_name: The name of the snapshot mode.
+            channels: A list of channel names with struct formats.
+        """
+        size = 0
+        for name in channels:
+            command = self._command(name)
+            assert (
+                FROM_HUB_FORMAT not in command
+                and command[ARGS_TO_HUB] >= 0
+                and command[TO_HUB_FORMAT] not in self.deltas
+                and command[TO_HUB_FORMAT] not in self.stamped
+            ), "'{}' is not a channel with a struct format".format(name)
+            size += struct.calcsize(self._add_format(command[TO_HUB_FORMAT]))
+        self.add_channel(mode_name, "%ds" % size)
+        self._command(mode_name)[MEMBERS] = list(channels)
+
+    def add_bulk(self):
+        """Add the mode for bulk transfers of blobs of bytes, up to 64 kB.
+
+        Use this function in the same place between the other commands on both the
+        sensor and the hub. The hub sends blobs with `send_blob()` and reads the
+        blobs the sensor offers with `put_blob()` using `read_blob()`.
+        """
+        fmt = "%ds" % self.write_size
+        self.add_command(BULK, fmt, fmt)
+
+    def add_stream(self, mode_name: str, to_hub_fmt: str, from_hub_fmt: str = ""):
+        """Define a remote generator that the hub iterates over with `stream()`.
+
+        Use this function with identical parameters on both the sensor and the hub.
+        On the sensor, the function with the mode name is a generator. The hub
+        asks for the next items when it has used the previous ones, so it can act
+        on the first items while the sensor makes the rest. Frames carry as many
+        items of a struct format as fit.
+
+        Args:
+            mode_name: The name of the mode, and the generator to call.
+            to_hub_fmt: The format string of each item sent to the hub. Use 'repr'
+                to send any python object, one per frame.
+            from_hub_fmt: The format string of the arguments of the generator.
+        """
+        room = self.write_size - 2  # Sequence number and item count
+        if to_hub_fmt == "repr":
+            item_size = room
+        else:
+            item_size = struct.calcsize(self._add_format(to_hub_fmt))
+        assert 0 < item_size <= room, "Stream item exceeds maximum packet size"
+        assert (
+            from_hub_fmt == "repr"
+            or struct.calcsize(self._add_format(from_hub_fmt)) <= room
+        ), "Payload exceeds maximum packet size"
+        self.add_command(
+            mode_name,
+            "%ds" % (2 + room // item_size * item_size),
+            "%ds" % self.write_size,
+        )
+        self._command(mode_name)[STREAM] = (to_hub_fmt, from_hub_fmt, item_size)
+
+    def add_buffered_channel(self, mode_name: str, to_hub_fmt: str):
+        """Define a channel that keeps every sample until the hub drains it.
+
+        Use this function with identical parameters on both the sensor and the hub.
+        The sensor adds timestamped samples with `append_sample()`, faster than
+        the hub reads them. The hub gets all samples since its last read with
+        `drain()`, many to a frame.
+
+        Args:
+            mode_name: The name of the mode.
+            to_hub_fmt: The struct format of a sample, with a single type, like
+                'h' or '3h'.
+        """
+        codes = [c for c in to_hub_fmt if not c.isdigit() and c not in "<="]
+        assert len(set(codes)) == 1, "Samples need a format with a single type"
+        room = self.write_size - struct.calcsize(RING_HEADER)
+        sample_size = 2 + struct.calcsize("<" + to_hub_fmt.lstrip("<="))
+        assert sample_size <= room, "Sample exceeds maximum packet size"
+        per_frame = min(room // sample_size, 255)
+        # The hub writes whether it acknowledges samples, and the number of
+        # the first sample it wants.
+        self._add_buffered(
+            mode_name,
+            "%ds" % (struct.calcsize(RING_HEADER) + per_frame * sample_size),
+            "?H",
+        )
+        self._command(mode_name)[RING] = (to_hub_fmt, sample_size, per_frame)
+
+    def _add_buffered(self, mode_name, to_hub_fmt, from_hub_fmt):
+        # Add the mode of a buffered channel.
+        self.add_command(mode_name, to_hub_fmt, from_hub_fmt)
+
+    def add_clock(self):
+        """Add the mode with which the hub syncs its clock to the sensor clock.
+
+        Use this function in the same place between the other commands on both the
+        sensor and the hub. The hub then measures the offset and drift of the
+        sensor clock with `sync_clock()`.
+        """
+        # The hub writes a round number. The sensor answers it with its time
+        # in ms and in us.
+        self.add_command(CLOCK, "BII", "B")
+
+    def _command(self, name):
+        # Return a command by name, multiplexed or not.
+        if name in self.mux:
+            return self.mux_commands[self.mux[name]]
+        return self.commands[self.modes[name]]
+
+    def _add_mux(self):
+        # Add the mode that carries all multiplexed commands.
+        fmt = "%ds" % self.write_size
+        self.add_command(MUX, fmt, fmt)
+
+    def _add_format(self, fmt):
+        # Return the struct format for a format, and remember how to convert
+        # the values of a quantized format. Like '2h*0.01' for values in steps
+        # of 0.01, '2h*0.1+-20' to also subtract 20, or '4e' for half floats.
+        # Bit fields follow a '|', like '2h|12?2u3' for 12 booleans and two 3
+        # bit numbers after the struct values.
+        if fmt in self.quantized:
+            return self.quantized[fmt][0]
+        if fmt in self.bitfields:
+            return self.bitfields[fmt][0]
+        if fmt in self.deltas:
+            return self.deltas[fmt][0]
+        if fmt in self.stamped:
+            return "%ds" % (self.stamped[fmt][1] + 4)
+        if fmt[-1:] == "@":
+            # The values, and the sensor time in ms in 4 bytes.
+            base = fmt[:-1]
+            base_struct = self._add_format(base)
+            assert (
+                base != "repr" and base not in self.deltas
+            ), "Timestamps need a struct format, like '3h@'"
+            self.stamped[fmt] = (base, struct.calcsize(base_struct))
+            return "%ds" % (self.stamped[fmt][1] + 4)
+        if "~" in fmt:
+            values, key_frames = fmt.split("~")
+            order = values[0] if values[0] in "<>=!@" else ""
+            code = values[-1]
+            assert (
+                values[len(order) : -1].isdigit() and code in "bBhHiIlLf"
+            ), "Deltas need a number of values of one type, like '10h~20'"
+            assert (
+                key_frames.isdigit() and int(key_frames) >= 1
+            ), "Deltas need a positive number of updates between key frames"
+            n = int(values[len(order) : -1])
+            num_bitmap = (n + 7) // 8
+            # The bitmap of the values in the frame, a sequence number, values
+            # The hub writes to the mode to ask for a key frame.
+            size = min(num_bitmap + 1 + struct.calcsize(values), self.write_size)
+            assert (
+                size >= num_bitmap + 1 + struct.calcsize(order + code)
+            ), "Payload exceeds maximum packet size"
+            self.deltas[fmt] = (
+                "%ds" % size,
+                order,
+                code,
+                n,
+                num_bitmap,
+                int(key_frames),
+            )
+            return self.deltas[fmt][0]
+        if "|" in fmt:
+            head, spec = fmt.split("|")
+            fields = []
+            shift = 0
+            i = 0
+            while i < len(spec):
+                j = i
+                while j < len(spec) and spec[j].isdigit():
+                    j += 1
+                count = int(spec[i:j]) if j > i else 1
+                kind = spec[j : j + 1]
+                assert kind in ("?", "u"), "Unknown bit field in '{}'".format(fmt)
+                i = j + 1
+                if kind == "?":
+                    width, kind = 1, bool
+                else:
+                    while i < len(spec) and spec[i].isdigit():
+                        i += 1
+                    width, kind = int(spec[j + 1 : i]), int
+                for k in range(count):
+                    fields.append((shift, (1 << width) - 1, kind))
+                    shift += width
+            num_bytes = (shift + 7) // 8
+            struct_fmt = self._add_format(head) + "%ds" % num_bytes
+            self.bitfields[fmt] = (
+                struct_fmt,
+                head,
+                self._num_values(head),
+                fields,
+                num_bytes,
+            )
+            return struct_fmt
+        if "*" in fmt:
+            struct_fmt, scale = fmt.split("*")
+            offset = 0
+            if "+" in scale:
+                scale, offset = scale.split("+")
+            self.quantized[fmt] = (struct_fmt, float(scale), float(offset))
+            return struct_fmt
+        if "e" in fmt:
+            assert set(
+                [c for c in fmt if not c.isdigit() and c not in "<=e"]
+            ) == set(), "Half floats can't be mixed with other types"
+            self.quantized[fmt] = (fmt.replace("e", "H"), None, 0)
+            return self.quantized[fmt][0]
+        return fmt
+
+    def _num_values(self, fmt):
+        # Return the number of values in a format.
+        struct_fmt = self._add_format(fmt)
+        if fmt in self.bitfields:
+            return self.bitfields[fmt][2] + len(self.bitfields[fmt][3])
+        if fmt in self.deltas:
+            return self.deltas[fmt][3]
+        if fmt in self.stamped:
+            return self._num_values(self.stamped[fmt][0])
+        return len(struct.unpack(struct_fmt, bytearray(struct.calcsize(struct_fmt))))
+
+    def _apply_delta(self, fmt, data, values):
+        # Return the values with the changes from a delta frame applied. The
+        # bitmap at the start of the frame says which values it contains.
+        struct_fmt, order, code, n, num_bitmap, key_frames = self.deltas[fmt]
+        bitmap = int.from_bytes(bytes(data[:num_bitmap]), "little")
+        indexes = [i for i in range(n) if bitmap >> i & 1]
+        changes_fmt = order + "%d" % len(indexes) + code
+        start = num_bitmap + 1  # After the sequence number
+        changes = struct.unpack(
+            changes_fmt, bytes(data[start : start + struct.calcsize(changes_fmt)])
+        )
+        values = list(values)
+        for i, value in zip(indexes, changes):
+            values[i] = value
+        return values
+
     def decode(self, fmt: str, data: bytes):
         if fmt == "repr":
-            # Remove trailing zero's (b'\x00') and eval the string
-            clean = bytearray([c for c in data if c != 0])
+            # The text ends at the first zero. Any bytes after it are left
+            # over from earlier, longer frames.
+            clean = bytes(data).split(b"\x00")[0]
             if clean:
-                return (eval(clean),)
+                return (literal(str(clean, "utf-8")),)
             else:
                 # Probably nothing left after stripping zero's
                 return ("",)
+        elif fmt in self.stamped:
+            base, size = self.stamped[fmt]
+            stamp = struct.unpack("<I", bytes(data[size : size + 4]))
+            return self.decode(base, data[:size]) + stamp
+        elif fmt in self.bitfields:
+            struct_fmt, head, num_head, fields, num_bytes = self.bitfields[fmt]
+            size = struct.calcsize(struct_fmt) - num_bytes
+            values = self.decode(head, data[:size]) if head else ()
+            # Unpack all bit fields from a single integer.
+            bits = int.from_bytes(bytes(data[size : size + num_bytes]), "little")
+            return values + tuple(
+                [kind(bits >> shift & mask) for shift, mask, kind in fields]
+            )
+        elif fmt in self.quantized:
+            struct_fmt, scale, offset = self.quantized[fmt]
+            data = struct.unpack(struct_fmt, data[: struct.calcsize(struct_fmt)])
+            if scale is None:
+                return tuple([half_to_float(v) for v in data])
+            return tuple([v * scale + offset for v in data])
         else:
             size = struct.calcsize(fmt)
             data = struct.unpack(fmt, data[:size])
@@ -168,13 +731,97 @@ class PUPRemote:
 
     def encode(self, size, format, *argv):
         if format == "repr":
+            # End with a zero, in case the frame is shorter than the mode.
             s = bytes(repr(*argv), "UTF-8")
+            if len(s) < size:
+                s += b"\x00"
+        elif format in self.stamped:
+            # The time is the last value.
+            base, base_size = self.stamped[format]
+            s = self.encode(base_size, base, *argv[:-1])
+            s += struct.pack("<I", argv[-1])
+        elif format in self.bitfields:
+            struct_fmt, head, num_head, fields, num_bytes = self.bitfields[format]
+            s = self.encode(size, head, *argv[:num_head]) if head else b""
+            # Pack all bit fields into a single integer.
+            bits = sum(
+                [
+                    (int(value) & mask) << shift
+                    for (shift, mask, kind), value in zip(fields, argv[num_head:])
+                ]
+            )
+            s += bits.to_bytes(num_bytes, "little")
+        elif format in self.quantized:
+            struct_fmt, scale, offset = self.quantized[format]
+            if scale is None:
+                argv = [float_to_half(v) for v in argv]
+            else:
+                argv = [round((v - offset) / scale) for v in argv]
+            s = struct.pack(struct_fmt, *argv)
         else:
             s = struct.pack(format, *argv)
         assert len(s) <= size, "Payload exceeds maximum packet size"
         return s
 
 
+class Pending:
+    """Result of a remote call that is not done yet.
+
+    Return a Pending from a function the hub calls, if it takes too long to
+    finish while the hub waits. `process()` keeps answering the hub and calls
+    `poll` until the result is done. The command must be multiplexed, so it can
+    tell the hub that it is busy in the meantime, and the hub waits for the
+    result, for about 10 seconds at most.
+
+    Args:
+        poll: Function that continues the work. It gets this Pending as its
+            argument and calls `done()` when it has the result. Defaults to None,
+            to call `done()` from elsewhere, like the main loop.
+    """
+
+    def __init__(self, poll=None):
+        self.poll = poll
+        self.ready = False
+        self.result = None
+
+    def done(self, result=None):
+        """Send the result to the hub.
+
+        Args:
+            result: The return value, or a tuple of values.
+        """
+        self.result = result
+        self.ready = True
+
+
+class _Cache:
+    # Least recently used cache of encoded results, by argument payload.
+
+    def __init__(self, size):
+        self.size = size
+        self.results = {}
+        self.keys = []
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        result = self.results.get(key)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.keys.remove(key)
+            self.keys.append(key)
+        return result
+
+    def put(self, key, result):
+        if key not in self.results:
+            if len(self.keys) >= self.size:
+                del self.results[self.keys.pop(0)]
+            self.keys.append(key)
+        self.results[key] = result
+
+
 class PUPRemoteSensor(PUPRemote):
     """Emulate a PUPRemote sensor for communication with a hub.
 
@@ -185,6 +832,23 @@ class PUPRemoteSensor(PUPRemote):
         sensor_id: The id of the sensor to emulate, defaults to SPIKE_ULTRASONIC.
         power: Set to True to enable 8V power on M+ wire, defaults to False.
         max_packet_size: Set to 16 for Pybricks compatibility, defaults to 32.
+        schema: Set to True to publish the command table in mode 0, so the hub
+            can register all commands without copying them. Defaults to False.
+        coalesce_ms: Set to send channel updates of the selected mode at most
+            once per this many milliseconds. Only the newest value is sent.
+            Defaults to 0, which sends every update right away.
+        tx_queue: Set to a number of bytes to queue data for the hub, instead of
+            waiting for the UART. Frames that don't fit are dropped and counted
+            in `lpup.tx_dropped`. Defaults to 0, which writes directly.
+        rx_ring: Set to a number of bytes to receive data from the hub in an
+            interrupt, so no bytes are lost while the main loop is slow, like
+            on OpenMV. `process()` still answers them. Defaults to 0, which
+            reads the UART in `process()`.
+        negotiate: Set to True to send channels in frames of up to 32 bytes,
+            instead of setting max_packet_size. The modes the hub writes to,
+            like commands, stay 16 bytes, which all hubs write. The hub checks
+            if it can write 32 byte frames, and the result is in `frame_size`.
+            Defaults to False.
     """
 
     def __init__(
@@ -192,16 +856,65 @@ class PUPRemoteSensor(PUPRemote):
         sensor_id=SPIKE_ULTRASONIC,
         power=False,
         max_packet_size=MAX_PKT,
+        schema=False,
+        coalesce_ms=0,
+        tx_queue=0,
+        rx_ring=0,
+        negotiate=False,
         **kwargs,  # backward compatibility
     ):
+        if negotiate:
+            max_packet_size = MAX_FRAME
         super().__init__(max_packet_size)
         self.connected = False
         self.power = power  ## ?
         self.mode_names = []  ## ?
         self.max_packet_size = max_packet_size
-        self.lpup = lpf2.LPF2([], sensor_id=sensor_id, max_packet_size=max_packet_size)
+        self.lpup = lpf2.LPF2(
+            [],
+            sensor_id=sensor_id,
+            max_packet_size=max_packet_size,
+            coalesce_ms=coalesce_ms,
+            tx_queue=tx_queue,
+            rx_ring=rx_ring,
+        )
         self._callback_queue = deque((), MAX_COMMAND_QUEUE_LENGTH)
         self._callback_lock = asyncio.Lock()
+        self._schema = b""
+        self._snapshots = {}
+        self._producers = False
+        self._refreshed = []
+        # (payload, send) for the protocol thread, by mode. Only the newest is kept.
+        self._threaded = False
+        self._thread_running = False
+        self._slots = {}
+        # Calls that returned a Pending: (pending, mode, command, header)
+        self._pending = []
+        # Timing of the heartbeat loop in process_async() and process_thread()
+        self.max_lateness_us = 0
+        self.missed_beats = 0
+        self.lateness_hist = [0] * LATENESS_BINS
+        # Responses that repeated the last result of a command, and were sent
+        # without encoding them again
+        self.repeat_hits = 0
+        # Largest frame the hub can write, as found by its probe
+        self.frame_size = MAX_PKT if negotiate else max_packet_size
+        # Bulk transfers: blobs from the hub and blobs for the hub, by name
+        self.blobs = {}
+        self._offered = {}
+        # Blob the hub is sending: [id, name, length, CRC, chunk size, data,
+        # next chunk, reply when complete]
+        self._bulk_rx = None
+        # Blob the hub is reading: (id, data)
+        self._bulk_tx = None
+        if negotiate:
+            self._add_builtin(PROBE, "B", "%ds" % max_packet_size, self._probe)
+            # The other modes the hub writes to fit the frames all hubs write.
+            self.write_size = MAX_PKT
+        if schema:
+            self._add_builtin(
+                SCHEMA, "B%ds" % (self.write_size - 1), "B", self._schema_page
+            )
 
     def add_command(
         self,
@@ -209,11 +922,383 @@ class PUPRemoteSensor(PUPRemote):
         to_hub_fmt: str = "",
         from_hub_fmt: str = "",
         command_type=CALLBACK,
+        mux=False,
+        refresh_ms=0,
+        cache=0,
     ):
-        super().add_command(mode_name, to_hub_fmt, from_hub_fmt, command_type)
-        writeable = 0
+        """Define a remote call.
+
+        Use this function with identical parameters on both the sensor and the
+        hub, except for cache.
+
+        Args:
+            mode_name: The name of the mode, and the function to call.
+            to_hub_fmt: The format string of the data sent from the sensor to the hub.
+            from_hub_fmt: The format string of the data sent from the hub.
+            command_type: CALLBACK or CHANNEL (internal).
+            mux: Set to True to share a single LPF2 mode with the other
+                multiplexed commands. Defaults to False.
+            refresh_ms: For functions without arguments, the interval at which
+                the sensor calls the function in the background. Defaults to 0.
+            cache: For functions whose result only depends on their arguments.
+                Set to the number of results to remember, so repeated calls are
+                answered without calling the function. Defaults to 0.
+        """
+        super().add_command(
+            mode_name, to_hub_fmt, from_hub_fmt, command_type, mux, refresh_ms
+        )
+        command = self.mux_commands[-1] if mux else self.commands[-1]
+        if cache:
+            command[CACHE] = _Cache(cache)
         if command_type == CALLBACK:
-            self.commands[-1][CALLABLE] = eval(mode_name)
+            command[CALLABLE] = eval(mode_name)
+        if mux:
+            # Multiplexed channels keep their latest payload here.
+            command[PAYLOAD] = bytes(command[SIZE])
+        else:
+            self._add_mode(mode_name, from_hub_fmt)
+        if command_type == CALLBACK and FROM_HUB_FORMAT not in command:
+            # Promoted to a channel that is refreshed in the background.
+            command[INTERVAL] = refresh_ms
+            command[PRODUCED] = None
+            self._refreshed.append(mode_name)
+
+    def add_channel(
+        self,
+        mode_name: str,
+        to_hub_fmt: str = "",
+        mux=False,
+        producer=None,
+        interval_ms=0,
+    ):
+        """Define a data channel to read on the hub.
+
+        Use this function with the same mode_name, to_hub_fmt and mux on the hub.
+        Update the data with `update_channel(<name>, *args)`, or pass a producer
+        function that returns the values.
+
+        Args:
+            mode_name: The name of the mode.
+            to_hub_fmt: The format string of the data sent from the sensor to the hub.
+            mux: Set to True to read the channel through the shared multiplexed mode.
+            producer: Function that returns the channel values. It is only called
+                while the hub has the mode selected, or when the hub reads the
+                multiplexed channel, so unread values are never computed.
+                `process_async()` calls it apart from the heartbeats. `process()`
+                calls it after answering the hub, so use `process_thread()` if
+                it is slow. Defaults to None.
+            interval_ms: Minimum time between two calls of the producer.
+                Defaults to 0.
+        """
+        super().add_channel(mode_name, to_hub_fmt, mux)
+        if producer:
+            command = self._command(mode_name)
+            command[PRODUCER] = producer
+            command[INTERVAL] = interval_ms
+            command[PRODUCED] = None
+            self._producers = True
+
+    def _add_builtin(self, mode_name, to_hub_fmt, from_hub_fmt, handler=None):
+        # Add a command that is handled by the library itself. Builtin handlers
+        # are called synchronously, also with process_async().
+        PUPRemote.add_command(self, mode_name, to_hub_fmt, from_hub_fmt)
+        if handler:
+            self.commands[-1][CALLABLE] = handler
+        self.commands[-1][BUILTIN] = True
+        self._add_mode(mode_name, from_hub_fmt)
+
+    def add_combo(self, *mode_names):
+        """Advertise a combination of modes the hub can stream at once.
+
+        Hubs that support LPF2 mode combinations, like SPIKE 3, can then receive
+        the values of all these modes in one data stream, without switching modes.
+        Define combinations after the modes they contain.
+
+        Args:
+            *mode_names: Names of the channels or commands in the combination.
+        """
+        mask = 0
+        size = 0
+        for name in mode_names:
+            mask |= 1 << self.modes[name]
+            size += self.commands[self.modes[name]][SIZE]
+        # The hub can select all values of all modes at once.
+        assert (
+            size <= self.max_packet_size
+        ), "Mode combination exceeds maximum packet size"
+        self.lpup.combos.append(mask)
+
+    def add_snapshot(self, mode_name: str, channels):
+        super().add_snapshot(mode_name, channels)
+        mode = len(self.commands) - 1
+        self.commands[mode][PAYLOAD] = bytearray(self.commands[mode][SIZE])
+        offset = 0
+        for name in channels:
+            # Remember where each channel goes in the snapshot payload.
+            self._snapshots.setdefault(name, []).append((mode, offset))
+            fmt = self._command(name)[TO_HUB_FORMAT]
+            offset += struct.calcsize(self._add_format(fmt))
+
+    def _add_mux(self):
+        fmt = "%ds" % self.write_size
+        self._add_builtin(MUX, fmt, fmt)
+
+    def add_bulk(self, max_size=0xFFFF):
+        """Add the mode for bulk transfers of blobs of bytes, up to 64 kB.
+
+        Use this function in the same place between the other commands on both the
+        sensor and the hub. Get the blobs the hub sends with `get_blob()`, and offer
+        blobs for the hub to read with `put_blob()`.
+
+        Args:
+            max_size: The largest blob in bytes the hub may send. Larger blobs, and
+                blobs there is no memory for, are refused. Defaults to 64 kB.
+        """
+        fmt = "%ds" % self.write_size
+        self._add_builtin(BULK, fmt, fmt, self._bulk)
+        self._bulk_max = max_size
+
+    def add_clock(self):
+        self._add_builtin(
+            CLOCK,
+            "BII",
+            "B",
+            lambda number: (number, utime.ticks_ms(), utime.ticks_us()),
+        )
+
+    def add_stream(self, mode_name: str, to_hub_fmt: str, from_hub_fmt: str = ""):
+        super().add_stream(mode_name, to_hub_fmt, from_hub_fmt)
+        # The running generator, the sequence number of the last request and
+        # the reply to it.
+        self._command(mode_name)[GENERATOR] = [None, None, None]
+
+    def add_buffered_channel(self, mode_name: str, to_hub_fmt: str, length=64):
+        """Define a channel that keeps every sample until the hub drains it.
+
+        Use this function with the same mode_name and to_hub_fmt on the hub. Add
+        samples with `append_sample()`. The sensor keeps them in a ring of
+        `length` samples, and drops the oldest sample when the ring is full.
+
+        Args:
+            mode_name: The name of the mode.
+            to_hub_fmt: The struct format of a sample, with a single type, like
+                'h' or '3h'.
+            length: The number of samples to keep. Defaults to 64.
+        """
+        super().add_buffered_channel(mode_name, to_hub_fmt)
+        command = self.commands[self.modes[mode_name]]
+        fmt = to_hub_fmt.lstrip("<=")
+        n = struct.calcsize(fmt) // struct.calcsize(fmt[-1])
+        # Sample times, values, ring index of the oldest sample, number of
+        # samples, number of the oldest sample, samples dropped.
+        command[SAMPLES] = [
+            array("L", [0] * length),
+            array(fmt[-1], [0] * (length * n)),
+            0,
+            0,
+            0,
+            0,
+        ]
+
+    def _add_buffered(self, mode_name, to_hub_fmt, from_hub_fmt):
+        self._add_builtin(
+            mode_name,
+            to_hub_fmt,
+            from_hub_fmt,
+            lambda ack, first: self._ring_ack(mode_name, ack, first),
+        )
+
+    def append_sample(self, mode_name: str, *values):
+        """Add a sample with the current time to a buffered channel.
+
+        Args:
+            mode_name: The name of a channel added with `add_buffered_channel()`.
+            *values: The values of the sample.
+        """
+        mode = self.modes[mode_name]
+        command = self.commands[mode]
+        state = command[SAMPLES]
+        times, ring = state[0], state[1]
+        n = len(ring) // len(times)
+        if state[3] == len(times):
+            # Full. Drop the oldest sample.
+            state[2] = (state[2] + 1) % len(times)
+            state[3] -= 1
+            state[4] = (state[4] + 1) & 0xFFFF
+            state[5] += 1
+        i = (state[2] + state[3]) % len(times)
+        times[i] = utime.ticks_us()
+        for j in range(n):
+            ring[i * n + j] = values[j]
+        state[3] += 1
+        if state[3] <= command[RING][2]:
+            # The frame the hub reads next has room for this sample.
+            self._update(self._ring_frame(command), mode)
+
+    def _ring_ack(self, mode_name, ack, first):
+        # Drop the samples the hub acknowledges, and return the next frame.
+        command = self._command(mode_name)
+        state = command[SAMPLES]
+        done = (first - state[4]) & 0xFFFF
+        if ack and done <= state[3]:
+            state[2] = (state[2] + done) % len(state[0])
+            state[3] -= done
+            state[4] = first
+        return self._ring_frame(command)
+
+    def _ring_frame(self, command):
+        # Encode the oldest samples of a buffered channel that fit a frame.
+        times, ring, start, count, first, dropped = command[SAMPLES]
+        fmt, sample_size, per_frame = command[RING]
+        fmt = "<H" + fmt.lstrip("<=")
+        n = len(ring) // len(times)
+        count = min(count, per_frame)
+        more = 0
+        pl = b""
+        previous = times[start]
+        for j in range(count):
+            i = (start + j) % len(times)
+            dt = utime.ticks_diff(times[i], previous)
+            if dt > 0xFFFF:
+                # Too long a step. The next frame starts at this sample.
+                count, more = j, RING_MORE
+                break
+            pl += struct.pack(fmt, dt, *ring[i * n : i * n + n])
+            previous = times[i]
+        t = times[start] if count else 0
+        return struct.pack(RING_HEADER, first, count | more, t) + pl
+
+    def _stream_request(self, mode, command, pl):
+        # Handle a stream request from the hub. Returns the generator to take
+        # the next items from, or None if the request is answered already.
+        op, seq = pl[0], pl[1]
+        state = command[GENERATOR]
+        if op != STREAM_STOP and seq == state[1]:
+            # The hub missed the reply. Don't start the generator again, so its
+            # side effects only happen once.
+            self._send(state[2], mode)
+            return None
+        state[1] = seq
+        if op != STREAM_NEXT and state[0] is not None:
+            if hasattr(state[0], "close"):
+                state[0].close()
+            state[0] = None
+        if op == STREAM_START:
+            args_fmt = command[STREAM][1]
+            args = ()
+            if args_fmt:
+                pl = bytes(pl[2:]) + bytes(command[SIZE])
+                args = self.decode(args_fmt, pl)
+            state[0] = command[CALLABLE](*args)
+        if state[0] is None:
+            self._stream_reply(mode, command, [], True)
+            return None
+        return state[0]
+
+    def _stream_items(self, command):
+        # Number of items in a frame of a stream.
+        return (command[SIZE] - 2) // command[STREAM][2]
+
+    def _stream_reply(self, mode, command, items, end):
+        # Send a frame of stream items, and keep it in case the hub misses it.
+        item_fmt, args_fmt, item_size = command[STREAM]
+        state = command[GENERATOR]
+        pl = bytes([state[1], len(items) | (STREAM_END if end else 0)])
+        for item in items:
+            if item_fmt == "repr" or not isinstance(item, tuple):
+                item = (item,)
+            pl += self.encode(item_size, item_fmt, *item)
+        if end:
+            state[0] = None
+        state[2] = pl
+        self._send(pl, mode)
+
+    def _stream(self, mode, command, pl):
+        # Answer a stream request with the next items of the generator.
+        generator = self._stream_request(mode, command, pl)
+        if generator is None:
+            return
+        items = []
+        end = False
+        while len(items) < self._stream_items(command):
+            try:
+                items.append(next(generator))
+            except StopIteration:
+                end = True
+                break
+        self._stream_reply(mode, command, items, end)
+
+    async def _stream_async(self, mode, command, pl):
+        # Like _stream(), but also takes items from async generators.
+        generator = self._stream_request(mode, command, pl)
+        if generator is None:
+            return
+        items = []
+        end = False
+        while len(items) < self._stream_items(command):
+            try:
+                if hasattr(generator, "__anext__"):
+                    items.append(await generator.__anext__())
+                else:
+                    items.append(next(generator))
+            except (StopIteration, StopAsyncIteration):
+                end = True
+                break
+        self._stream_reply(mode, command, items, end)
+
+    def _bulk(self, data):
+        # Handle a bulk transfer message from the hub, and return the reply.
+        op, tid, seq = data[0], data[1], data[2] | data[3] << 8
+        body = data[4:]
+        rx = self._bulk_rx
+        if op == BULK_PUT:
+            length, crc, chunk = struct.unpack("<HHB", body[:5])
+            name = str(bytes(body[5:]).split(b"\x00")[0], "utf-8")
+            # Free the last blob before making room for the next one.
+            self._bulk_rx = None
+            if length > self._bulk_max:
+                return struct.pack("<BBH", BULK_ERROR, tid, 0)
+            try:
+                rx = [tid, name, length, crc, chunk, bytearray(length), 0, None]
+            except MemoryError:
+                return struct.pack("<BBH", BULK_ERROR, tid, 0)
+            self._bulk_rx = rx
+        elif op == BULK_DATA and rx and rx[0] == tid:
+            length, chunk = rx[2], rx[4]
+            if seq == rx[6] and seq * chunk < length:
+                # Chunks arrive in order. Others are resent later.
+                end = min(length, (seq + 1) * chunk)
+                rx[5][seq * chunk : end] = body[: end - seq * chunk]
+                rx[6] += 1
+        elif op == BULK_GET:
+            name = str(bytes(body).split(b"\x00")[0], "utf-8")
+            if name not in self._offered:
+                return struct.pack("<BBH", BULK_ERROR, tid, 0)
+            blob = self._offered[name]
+            self._bulk_tx = (tid, blob)
+            return struct.pack("<BBHHH", BULK_INFO, tid, 0, len(blob), crc16(blob))
+        elif op == BULK_READ and self._bulk_tx and self._bulk_tx[0] == tid:
+            chunk = self.write_size - 4
+            blob = self._bulk_tx[1]
+            return struct.pack("<BBH", BULK_DATA, tid, seq) + blob[
+                seq * chunk : (seq + 1) * chunk
+            ]
+        else:
+            return struct.pack("<BBH", BULK_ERROR, tid, 0)
+        if rx[6] * rx[4] < rx[2]:
+            return struct.pack("<BBH", BULK_ACK, tid, rx[6])
+        if rx[7] is None:
+            # Complete. Check the blob once.
+            if crc16(rx[5]) == rx[3]:
+                self.blobs[rx[1]] = bytes(rx[5])
+                rx[7] = struct.pack("<BBH", BULK_DONE, tid, rx[6])
+            else:
+                rx[7] = struct.pack("<BBH", BULK_ERROR, tid, rx[6])
+        return rx[7]
+
+    def _add_mode(self, mode_name, from_hub_fmt):
+        # Advertise the last added command as an LPF2 mode.
+        writeable = 0
         if from_hub_fmt != "":
             writeable = lpf2.ABSOLUTE
         max_mode_name_len = 5 if self.power else 11
@@ -228,22 +1313,177 @@ class PUPRemoteSensor(PUPRemote):
                 + b" " * (5 - len(mode_name))
                 + b"\x00\x80\x00\x00\x00\x05\x04"
             )
+        command = self.commands[-1]
+        data_type = command.get(DATA_TYPE, DATA8)
+        # Send short frames for data of variable length: 'repr', and the
+        # multiplexed mode with results of all sizes. Other formats fill the
+        # mode anyway.
+        fit = command[TO_HUB_FORMAT] == "repr" or command[NAME] == MUX
         self.lpup.modes.append(
             self.lpup.mode(
                 mode_name,
-                self.commands[-1][SIZE],  # Size of the last command we added.
-                lpf2.DATA8,
+                # Number of values in the last command we added.
+                command[SIZE] // TYPE_SIZES[data_type],
+                data_type,
                 writeable,
+                fit=fit,
             )
         )
 
+    def _probe(self, data):
+        # Answer the hub's probe with the length of the test pattern that
+        # arrived. Frames that are too large for the hub arrive broken, and
+        # are dropped.
+        n = 0
+        while n < len(data) and data[n] == n + 1:
+            n += 1
+        self.frame_size = n
+        return n
+
+    def _schema_page(self, page):
+        # Return a page of the command table as 'name,to_hub_fmt[,from_hub_fmt]'
+        # entries, separated by ';'. Multiplexed commands have a '*' before
+        # their name and are listed in place of the shared mode, so the hub
+        # adds that mode with the same number. Snapshots are listed as
+        # '@name,channel+channel', streams as '%name,to_hub_fmt,from_hub_fmt',
+        # buffered channels as '&name,to_hub_fmt', and the bulk transfer and
+        # clock modes by their names.
+        # Pages count from 1, so a zero page number in the payload means the
+        # hub's request was not handled yet.
+        if not self._schema:
+            entries = []
+            for c in self.commands:
+                if c[NAME] == MUX:
+                    entries += ["*" + self._schema_entry(m) for m in self.mux_commands]
+                elif MEMBERS in c:
+                    entries.append("@" + c[NAME] + "," + "+".join(c[MEMBERS]))
+                elif c[NAME] in (BULK, CLOCK):
+                    entries.append(c[NAME])
+                elif STREAM in c:
+                    entries.append("%" + ",".join([c[NAME]] + list(c[STREAM][:2])))
+                elif RING in c:
+                    entries.append("&" + c[NAME] + "," + c[RING][0])
+                elif BUILTIN not in c:
+                    entries.append(self._schema_entry(c))
+            self._schema = ";".join(entries).encode()
+        n = self.write_size - 1
+        return page, self._schema[(page - 1) * n : page * n]
+
+    @staticmethod
+    def _schema_entry(c):
+        return ",".join(
+            [c[NAME], c[TO_HUB_FORMAT]]
+            + ([c[FROM_HUB_FORMAT]] if FROM_HUB_FORMAT in c else [])
+        )
+
+    def _prepare_call(self, mode, pl):
+        # Find the command for data the hub wrote to a mode. Returns the
+        # command, its decoded arguments, the header for the response and the
+        # cached response, if any.
+        command = self.commands[mode]
+        header = b""
+        if command[NAME] == MUX:
+            # Multiplexed: command id, sequence number, arguments
+            if pl[0] >= len(self.mux_commands):
+                return command, (), header, None
+            header = bytes(pl[:2])
+            command = self.mux_commands[pl[0]]
+            pl = pl[2:]
+        if FROM_HUB_FORMAT not in command:
+            return command, (), header, None
+        if CACHE in command:
+            cached = command[CACHE].get(bytes(pl))
+            if cached is not None:
+                return command, (), header, cached
+        if len(pl) < command[SIZE]:
+            # The hub wrote a frame shorter than the mode.
+            pl = bytes(pl) + bytes(command[SIZE] - len(pl))
+        return command, self.decode(command[FROM_HUB_FORMAT], pl), header, None
+
+    def _due(self, command):
+        # Check whether a channel function may run again, at most once per
+        # interval, and remember when it did.
+        now = utime.ticks_ms()
+        if (
+            command[PRODUCED] is not None
+            and utime.ticks_diff(now, command[PRODUCED]) < command[INTERVAL]
+        ):
+            return False
+        command[PRODUCED] = now
+        return True
+
+    def _store(self, mode_name, result):
+        if not isinstance(result, tuple):
+            result = (result,)
+        self.update_channel(mode_name, *result)
+
+    def _produce(self, mode_name):
+        # Call the producer of a channel, if it is due.
+        command = self._command(mode_name)
+        if PRODUCER in command and self._due(command):
+            self._store(mode_name, command[PRODUCER]())
+
+    def _produce_selected(self):
+        # Refresh the producer channels in the modes the hub is reading.
+        modes = [self.lpup.current_mode]
+        for mode, dataset in self.lpup.combo:
+            if mode not in modes:
+                modes.append(mode)
+        for mode in modes:
+            if mode < len(self.commands):
+                command = self.commands[mode]
+                for name in command.get(MEMBERS, (command[NAME],)):
+                    self._produce(name)
+
+    def _late(self, deadline):
+        # Record how late a heartbeat round starts.
+        late = utime.ticks_diff(utime.ticks_us(), deadline)
+        if late > self.max_lateness_us:
+            self.max_lateness_us = late
+        ms = late // 1000 if late > 0 else 0
+        n = 0
+        while ms and n < LATENESS_BINS - 1:
+            ms >>= 1
+            n += 1
+        self.lateness_hist[n] += 1
+
+    def _next(self, deadline, period_us):
+        # Return the next deadline and the time to sleep until then. A round
+        # that is a little late shortens the next sleep, so the period does not
+        # drift. After falling behind more than a period, skip the missed rounds.
+        deadline = utime.ticks_add(deadline, period_us)
+        delay = utime.ticks_diff(deadline, utime.ticks_us())
+        if delay < -period_us:
+            self.missed_beats += -delay // period_us
+            deadline = utime.ticks_add(deadline, -delay)
+            delay = 0
+        return deadline, max(0, delay)
+
     async def _heartbeat_loop(self, interval_ms: int):
         """Continuously call heartbeat at fixed interval and enqueue callbacks"""
+        period = interval_ms * 1000
+        deadline = utime.ticks_us()
         while True:
+            self._late(deadline)
             data = self.lpup.heartbeat()
             if data:
                 async with self._callback_lock:
                     self._callback_queue.append(data)
+            if self._pending:
+                self._poll_pending()
+            deadline, delay = self._next(deadline, period)
+            await asyncio.sleep(delay / 1000000)
+
+    async def _refresh_loop(self, interval_ms: int):
+        """Call the refreshed commands and the producers, apart from the heartbeats"""
+        while True:
+            if self.lpup.connected:
+                for name in self._refreshed:
+                    command = self._command(name)
+                    if self._due(command):
+                        self._store(name, await command[CALLABLE]())
+                if self._producers:
+                    self._produce_selected()
             await asyncio.sleep(interval_ms / 1000)
 
     async def _process_callbacks(self):
@@ -256,19 +1496,103 @@ class PUPRemoteSensor(PUPRemote):
                 else:
                     continue
 
-            if CALLABLE in self.commands[mode]:
-                result = None
-                args = self.decode(self.commands[mode][FROM_HUB_FORMAT], pl)
-                result = await self.commands[mode][CALLABLE](*args)
-                self._send_response(mode, result)
+            command, args, header, cached = self._prepare_call(mode, pl)
+            if STREAM in command:
+                await self._stream_async(mode, command, pl)
+            elif cached is not None:
+                self._send(header + cached, mode)
+            elif CALLABLE in command and INTERVAL not in command:
+                result = command[CALLABLE](*args)
+                if BUILTIN not in command:
+                    result = await result
+                self._send_response(mode, result, command, header, pl)
+            elif command[TO_HUB_FORMAT] in self.deltas:
+                self._key_frame(command, mode)
+            elif header:
+                # A multiplexed channel, or refreshed command
+                self._produce(command[NAME])
+                self._send(header + command[PAYLOAD], mode)
+
+    def _delta_frame(self, command, argv, key=False):
+        # Encode the values that changed since they were last sent. Changes
+        # that don't fit wait for the next update. Key frames fill up with
+        # unchanged values. Each frame has a sequence number, so the hub knows
+        # when it missed one, and asks for key frames.
+        fmt = command[TO_HUB_FORMAT]
+        struct_fmt, order, code, n, num_bitmap, key_frames = self.deltas[fmt]
+        assert len(argv) == n, "Expected {} values for '{}'".format(n, command[NAME])
+        if DELTA not in command:
+            # Updates, next value for a key frame, values sent, sequence
+            # number, latest values
+            command[DELTA] = [0, 0, [None] * n, 0, argv]
+        state = command[DELTA]
+        state[4] = argv
+        sent = state[2]
+        room = (command[SIZE] - num_bitmap - 1) // struct.calcsize(order + code)
+        indexes = [i for i in range(n) if argv[i] != sent[i]][:room]
+        if key or state[0] % key_frames == 0:
+            start = state[1]
+            for j in range(n):
+                if len(indexes) >= room:
+                    break
+                i = (start + j) % n
+                if i not in indexes:
+                    indexes.append(i)
+                    state[1] = (i + 1) % n
+            indexes.sort()
+        state[0] += 1
+        state[3] = (state[3] + 1) & 0xFF
+        bitmap = 0
+        for i in indexes:
+            bitmap |= 1 << i
+            sent[i] = argv[i]
+        return (
+            bitmap.to_bytes(num_bitmap, "little")
+            + bytes([state[3]])
+            + struct.pack(
+                order + "%d" % len(indexes) + code, *[argv[i] for i in indexes]
+            )
+        )
+
+    def _key_frame(self, command, mode):
+        # Send a key frame of a delta channel, that the hub asked for after it
+        # missed a frame.
+        if DELTA in command:
+            self._send(self._delta_frame(command, command[DELTA][4], True), mode)
 
-    def _send_response(self, mode, result):
-        num_args = self.commands[mode][ARGS_TO_HUB]
+    def _send(self, pl, mode):
+        # Send a payload to the hub, through the protocol thread if it runs.
+        if self._threaded:
+            self._slots[mode] = (pl, True)
+        else:
+            self.lpup.send_payload(pl, mode)
 
-        if result is None:
-            assert num_args <= 0, "{}() did not return value(s)".format(
-                self.commands[mode][NAME]
+    def _update(self, pl, mode):
+        # Store a payload, and send it if the hub reads the mode.
+        if self._threaded:
+            self._slots[mode] = (bytes(pl), False)
+        else:
+            self.lpup.update_payload(pl, mode)
+
+    def _send_response(self, mode, result, command=None, header=b"", request=None):
+        if command is None:
+            command = self.commands[mode]
+        if isinstance(result, Pending):
+            # Answer when the result is done. Until then, the hub reads a busy
+            # status. Other modes have no way to say so.
+            assert header, "{}() returned a Pending, but is not multiplexed".format(
+                command[NAME]
             )
+            self._pending.append((result, mode, command, header))
+            self._send(bytes([MUX_BUSY, header[1]]), mode)
+            return
+        num_args = command[ARGS_TO_HUB]
+
+        if result is None:
+            assert num_args <= 0, "{}() did not return value(s)".format(command[NAME])
+            if header:
+                # Multiplexed calls always answer, so the hub knows it's done.
+                self._send(header, mode)
         else:
             if not isinstance(result, tuple):
                 result = (result,)
@@ -276,21 +1600,72 @@ class PUPRemoteSensor(PUPRemote):
                 assert num_args == len(
                     result
                 ), "{}() returned {} value(s) instead of expected {}".format(
-                    self.commands[mode][NAME], len(result), num_args
+                    command[NAME], len(result), num_args
                 )
-            pl = self.encode(
-                self.commands[mode][SIZE],
-                self.commands[mode][TO_HUB_FORMAT],
-                *result,
+            last = command.get(LAST)
+            repeat = (
+                last is not None
+                # Equal values can have a different repr(), like [1] and [True]
+                and command[TO_HUB_FORMAT] != "repr"
+                and last[0] == result
             )
-            self.lpup.send_payload(pl, mode)
+            if repeat:
+                pl = last[1]
+            else:
+                pl = self.encode(command[SIZE], command[TO_HUB_FORMAT], *result)
+            if CACHE in command and request is not None:
+                # Remember the response by the arguments the hub wrote.
+                command[CACHE].put(bytes(request[len(header) :]), pl)
+            if repeat:
+                self.repeat_hits += 1
+                if (
+                    not header
+                    and not self._threaded
+                    and self.lpup.payloads[mode] is last[2]
+                ):
+                    # The frame of the last response is still loaded.
+                    self.lpup.send_payload(None, mode)
+                else:
+                    self._send(header + last[1], mode)
+                return
+            self._send(header + pl, mode)
+            command[LAST] = (result, pl, self.lpup.payloads.get(mode))
+
+    def cache_info(self, mode_name: str):
+        """Return how often the cache of a command answered a call.
+
+        Args:
+            mode_name: The name of a command added with `cache`.
+
+        Returns:
+            The number of hits and misses.
+        """
+        cache = self._command(mode_name)[CACHE]
+        return cache.hits, cache.misses
+
+    def _poll_pending(self):
+        # Send the results of deferred calls that are done.
+        for call in self._pending[:]:
+            pending, mode, command, header = call
+            if not pending.ready and pending.poll:
+                pending.poll(pending)
+            if pending.ready:
+                self._pending.remove(call)
+                self._send_response(mode, pending.result, command, header)
 
     async def process_async(self, interval_ms: int = 50):
         """Start async heartbeat and callback processing.
 
-        Runs two asynchronous tasks concurrently:
+        Runs asynchronous tasks concurrently:
         - Heartbeat loop maintaining communication at minimum 15 Hz
         - Callback processing loop handling queued commands
+        - Refresh loop calling the commands added with `refresh_ms` and the
+          producers of channels, if any
+
+        Heartbeats are scheduled at fixed deadlines, so the period doesn't drift
+        with the processing time. `max_lateness_us`, `missed_beats` and
+        `lateness_hist` (counts of rounds that started <1, <2, <4 ... ms late)
+        show how well the sensor keeps time while the application is busy.
 
         Args:
             interval_ms: The interval in milliseconds between heartbeats.
@@ -299,27 +1674,111 @@ class PUPRemoteSensor(PUPRemote):
         Raises:
             asyncio.CancelledError: If either task is cancelled during execution.
         """
-        hb_task = asyncio.create_task(self._heartbeat_loop(interval_ms))
-        cb_task = asyncio.create_task(self._process_callbacks())
-        await asyncio.gather(hb_task, cb_task)
+        tasks = [
+            asyncio.create_task(self._heartbeat_loop(interval_ms)),
+            asyncio.create_task(self._process_callbacks()),
+        ]
+        if self._refreshed or self._producers:
+            # A slow function must not delay the heartbeats.
+            tasks.append(asyncio.create_task(self._refresh_loop(interval_ms)))
+        await asyncio.gather(*tasks)
+
+    def process_thread(self, interval_ms: int = 5):
+        """Run the communication with the hub in a separate thread.
+
+        Keeps the link with the hub alive, however slow the main loop is. Keep
+        calling `process()` in the main loop, to run the functions the hub calls
+        and the producers of channels. Needs the _thread module, like on LMS-ESP32.
+        Stop the thread with `stop_thread()`.
+
+        Args:
+            interval_ms: The interval in milliseconds between heartbeats.
+                Defaults to 5ms.
+        """
+        import _thread
+
+        self._threaded = True
+        self._thread_running = True
+        _thread.start_new_thread(self._protocol_loop, (interval_ms,))
+
+    def stop_thread(self):
+        """Stop the thread of `process_thread()`, and wait until it stopped.
+
+        `process()` then talks to the hub itself again.
+        """
+        self._threaded = False
+        while self._thread_running:
+            utime.sleep_ms(1)
+
+    def _protocol_loop(self, interval_ms):
+        # Only this thread uses the UART. The main thread hands over payloads
+        # in slots and takes calls from the hub out of the callback queue.
+        period = interval_ms * 1000
+        deadline = utime.ticks_us()
+        while self._threaded:
+            self._late(deadline)
+            data = self.lpup.heartbeat()
+            if data:
+                self._callback_queue.append(data)
+            self._send_slots()
+            deadline, delay = self._next(deadline, period)
+            utime.sleep_us(delay)
+        self._send_slots()
+        self._thread_running = False
+
+    def _send_slots(self):
+        # Take the slots the main thread filled, and send their payloads.
+        # No lock: the main thread only stores a slot, and this thread only
+        # pops one, which are single dict operations under the interpreter
+        # lock. A payload stored after list() waits for the next round, and
+        # one stored before pop() replaces the older one, which is fine.
+        for mode in list(self._slots):
+            pl, send = self._slots.pop(mode)
+            if send:
+                self.lpup.send_payload(pl, mode)
+            else:
+                self.lpup.update_payload(pl, mode)
 
     def process(self):
         """Process commands and communication with the hub.
 
         Call this function in your main loop, preferably at least once every 20ms.
-        Handles hub communication, auto-connect, and command invocation.
+        Handles hub communication, auto-connect, and command invocation. Sends
+        the results of calls that returned a `Pending` when they are done.
 
         Returns:
             True if connected to the hub, False otherwise.
         """
-        data = self.lpup.heartbeat()
+        if self._threaded:
+            # The protocol thread queues what the hub writes.
+            data = self._callback_queue.popleft() if self._callback_queue else None
+        else:
+            data = self.lpup.heartbeat()
         if data is not None:
             pl, mode = data
-            if CALLABLE in self.commands[mode]:
-                result = None
-                args = self.decode(self.commands[mode][FROM_HUB_FORMAT], pl)
-                result = self.commands[mode][CALLABLE](*args)
-                self._send_response(mode, result)
+            command, args, header, cached = self._prepare_call(mode, pl)
+            if STREAM in command:
+                self._stream(mode, command, pl)
+            elif cached is not None:
+                self._send(header + cached, mode)
+            elif CALLABLE in command and INTERVAL not in command:
+                result = command[CALLABLE](*args)
+                self._send_response(mode, result, command, header, pl)
+            elif command[TO_HUB_FORMAT] in self.deltas:
+                self._key_frame(command, mode)
+            elif header:
+                # A multiplexed channel, or refreshed command
+                self._produce(command[NAME])
+                self._send(header + command[PAYLOAD], mode)
+        if self._pending:
+            self._poll_pending()
+        if self.lpup.connected:
+            if self._producers:
+                self._produce_selected()
+            for name in self._refreshed:
+                command = self._command(name)
+                if self._due(command):
+                    self._store(name, command[CALLABLE]())
         return self.lpup.connected
 
     def update_channel(self, mode_name: str, *argv):
@@ -332,19 +1791,51 @@ class PUPRemoteSensor(PUPRemote):
             mode_name: Mode name you defined when you used `add_channel()`.
             *argv: Values to update.
         """
-        mode = self.modes[mode_name]
+        command = self._command(mode_name)
+        if command[TO_HUB_FORMAT] in self.stamped:
+            argv += (utime.ticks_ms(),)
+        if command[TO_HUB_FORMAT] in self.deltas:
+            pl = self._delta_frame(command, argv)
+        else:
+            pl = self.encode(command[SIZE], command[TO_HUB_FORMAT], *argv)
+        for mode, offset in self._snapshots.get(mode_name, ()):
+            snapshot = self.commands[mode][PAYLOAD]
+            snapshot[offset : offset + len(pl)] = pl
+            self._update(snapshot, mode)
+        if mode_name in self.mux:
+            command[PAYLOAD] = pl
+        else:
+            self._update(pl, self.modes[mode_name])
 
-        pl = self.encode(
-            self.commands[mode][SIZE], self.commands[mode][TO_HUB_FORMAT], *argv
-        )
-        self.lpup.update_payload(pl, mode)
+    def put_blob(self, name: str, data):
+        """Offer a blob of bytes for the hub to read with `read_blob()`.
+
+        Needs `add_bulk()`.
+
+        Args:
+            name: The name the hub reads the blob by.
+            data: The bytes to offer, up to 64 kB.
+        """
+        assert len(data) < 0x10000, "Blob exceeds 64 kB"
+        self._offered[name] = bytes(data)
+
+    def get_blob(self, name: str):
+        """Return the blob the hub sent with `send_blob()`, or None.
+
+        Args:
+            name: The name the hub sent the blob with.
+        """
+        return self.blobs.get(name)
 
 
 class PUPRemoteHub(PUPRemote):
     """Communicate with a PUPRemoteSensor from a Pybricks hub.
 
     Use on the hub side running Pybricks. Copy the commands you defined on the sensor
-    side to the hub side using add_command() and add_channel().
+    side to the hub side using add_command() and add_channel(). If the sensor was
+    created with schema=True, all commands are registered automatically. If the
+    sensor was created with negotiate=True, the hub reads channels in the packet
+    size of the sensor, and checks if it can write frames of that size.
 
     Args:
         port: The port to which the PUPRemoteSensor is connected (e.g., Port.A).
@@ -366,13 +1857,113 @@ class PUPRemoteHub(PUPRemote):
         # Multitask stuff
         self._queue = []
         self._multitask_loop_running = False
+        # Read the advertised modes once, to check commands against.
+        self._sensor_modes = self.pup_device.info()["modes"]
+        self._mux_seq = 0
+        self._bulk_id = 0
+        self._stream_seq = 0
+        # Number of the next sample to drain, by buffered channel
+        self._next_sample = {}
+        # Samples the sensor dropped before the hub drained them
+        self.samples_lost = 0
+        self._watch = StopWatch()
+        self._clock_round = 0
+        # Hub time, offset, drift and sensor time in us of the last clock sync,
+        # and the hub time and offset of the first one.
+        self.clock = None
+        self._first_sync = None
+        # Hub time of the last values of timestamped channels, by name
+        self._value_times = {}
+        # Largest frame the hub writes
+        self.frame_size = max_packet_size
+        if self._sensor_modes[0][0].rstrip() == PROBE:
+            self._probe()
+        if self._sensor_modes[len(self.commands)][0].rstrip() == SCHEMA:
+            self._read_schema()
+
+    def _probe(self):
+        # Write a test pattern in a full frame, and see if the sensor got it.
+        # Pybricks writes all values of a mode, and frames that are too large
+        # for the hub arrive broken, so the sensor drops them.
+        size = self._sensor_modes[0][1]
+        self.max_packet_size = self.write_size = size
+        self.add_command(PROBE, "B", "%ds" % size)
+        # Like the sensor, keep the other modes the hub writes to 16 bytes.
+        self.write_size = self.frame_size = MAX_PKT
+        self.pup_device.write(0, list(range(1, size + 1)))
+        for i in range(PROBE_READS):
+            wait(5)
+            if self._result_from_sensor(0, self.pup_device.read(0)) == size:
+                self.frame_size = size
+                break
+
+    def _read_schema(self):
+        # Register all commands from the command table the sensor publishes.
+        mode = len(self.commands)
+        n = self._sensor_modes[mode][1] - 1  # Schema bytes per page
+        self.add_command(SCHEMA, "B%ds" % n, "B")
+        schema = b""
+        page = 1
+        while True:
+            self.pup_device.write(mode, self._values_to_sensor(mode, (page,)))
+            for i in range(200):
+                wait(5)
+                number, chunk = self._result_from_sensor(
+                    mode, self.pup_device.read(mode)
+                )
+                if number == page:
+                    break
+            else:
+                raise OSError("No command table from sensor on " + str(self.port))
+            chunk = chunk.rstrip(b"\x00")
+            schema += chunk
+            if len(chunk) < n:
+                break
+            page += 1
+        for entry in schema.decode().split(";") if schema else []:
+            mux = entry[0] == "*"
+            fields = entry.lstrip("*@%&").split(",")
+            if entry == BULK:
+                self.add_bulk()
+            elif entry == CLOCK:
+                self.add_clock()
+            elif entry[0] == "%":
+                self.add_stream(*fields)
+            elif entry[0] == "&":
+                self.add_buffered_channel(*fields)
+            elif entry[0] == "@":
+                self.add_snapshot(fields[0], fields[1].split("+"))
+            elif len(fields) == 2:
+                self.add_channel(*fields, mux=mux)
+            else:
+                self.add_command(*fields, mux=mux)
 
     def add_command(
-        self, mode_name, to_hub_fmt="", from_hub_fmt="", command_type=CALLBACK
+        self,
+        mode_name,
+        to_hub_fmt="",
+        from_hub_fmt="",
+        command_type=CALLBACK,
+        mux=False,
+        refresh_ms=0,
     ):
-        super().add_command(mode_name, to_hub_fmt, from_hub_fmt, command_type)
+        if mode_name in self.modes or mode_name in self.mux:
+            # Already registered from the sensor's command table.
+            if mux:
+                command = self.mux_commands[self.mux[mode_name]]
+            else:
+                command = self.commands[self.modes[mode_name]]
+            assert to_hub_fmt == command[TO_HUB_FORMAT] and from_hub_fmt == command.get(
+                FROM_HUB_FORMAT, ""
+            ), "Different formats than on remote side for '{}'".format(mode_name)
+            return
+        super().add_command(
+            mode_name, to_hub_fmt, from_hub_fmt, command_type, mux, refresh_ms
+        )
+        if mux:
+            return
         # Check the newly added commands against the advertised modes.
-        modes = self.pup_device.info()["modes"]
+        modes = self._sensor_modes
         n = len(self.commands) - 1  # Zero indexed mode number
         assert len(self.commands) <= len(modes), "More commands than on remote side"
         assert (
@@ -380,10 +1971,219 @@ class PUPRemoteHub(PUPRemote):
         ), "Expected '{}' as mode {}, but got '{}'".format(
             modes[n][0].rstrip(), n, mode_name
         )
+        data_type = self.commands[-1].get(DATA_TYPE, DATA8)
         assert (
-            self.commands[-1][SIZE] == modes[n][1]
+            self.commands[-1][SIZE] // TYPE_SIZES[data_type] == modes[n][1]
+            and data_type == modes[n][2]
         ), "Different parameter size than on remote side. Check formats."
 
+    def _check_args(self, command, argv):
+        num_args = command[ARGS_FROM_HUB]
+        if num_args >= 0:
+            assert (
+                len(argv) == num_args
+            ), "Expected {} argument(s) in call '{}'".format(num_args, command[NAME])
+
+    def _write_size(self, mode):
+        # Return the number of bytes to write to a mode. PUPDevice.write()
+        # takes all values of the mode, and frames that are larger than the
+        # hub can write arrive broken.
+        command = self.commands[mode]
+        assert (
+            command[SIZE] <= self.frame_size
+        ), "Mode '{}' needs larger frames than the hub writes. Use max_packet_size={} on the sensor".format(
+            command[NAME], self.frame_size
+        )
+        return command[SIZE]
+
+    def _values_to_sensor(self, mode, argv):
+        # Encode call arguments as the list of values PUPDevice.write() expects.
+        command = self.commands[mode]
+        self._check_args(command, argv)
+        size = self._write_size(mode)
+        if DATA_TYPE in command:
+            # Native data type. The hub writes the values as they are.
+            num_values = size // TYPE_SIZES[command[DATA_TYPE]]
+            assert len(argv) <= num_values, "Payload exceeds maximum packet size"
+            return list(argv) + [0] * (num_values - len(argv))
+        payl = self.encode(size, command[FROM_HUB_FORMAT], *argv)
+        return self._int8_to_uint8(tuple(payl + b"\x00" * (size - len(payl))))
+
+    def _result_from_sensor(self, mode, data):
+        # Decode the values from PUPDevice.read() into the call result.
+        command = self.commands[mode]
+        if DATA_TYPE in command:
+            # Native data type. No need to convert and unpack.
+            result = data[: command[ARGS_TO_HUB]]
+        else:
+            raw_data = bytes([b if b >= 0 else b + 256 for b in data])
+            if MEMBERS in command:
+                return self._decode_snapshot(command, raw_data)
+            fmt = command[TO_HUB_FORMAT]
+            if fmt in self.deltas:
+                return self._delta_result(command, raw_data)
+            result = self.decode(command[TO_HUB_FORMAT], raw_data)
+            if fmt in self.stamped:
+                result = self._unstamp(command, result)
+        # Convert tuple size 1 to single value
+        return result[0] if len(result) == 1 else result
+
+    def _delta_result(self, command, data):
+        # Apply a delta frame to the values the hub keeps. After a missed
+        # frame, values are stale until a key frame brings them again.
+        fmt = command[TO_HUB_FORMAT]
+        n, num_bitmap = self.deltas[fmt][3], self.deltas[fmt][4]
+        if DELTA not in command:
+            # Values, sequence number of the last frame, bitmap of the values
+            # that arrived at least once, and whether the last frame came
+            # after a missed one
+            command[DELTA] = [[0] * n, None, 0, False]
+        state = command[DELTA]
+        seq = data[num_bitmap]
+        state[3] = False
+        if seq != state[1]:
+            state[3] = state[1] is None or seq != (state[1] + 1) & 0xFF
+            state[0] = self._apply_delta(fmt, data, state[0])
+            state[1] = seq
+            state[2] |= int.from_bytes(bytes(data[:num_bitmap]), "little")
+        return tuple(state[0])
+
+    def _all_deltas(self, mode):
+        # Return whether all values of a delta channel arrived at least once.
+        command = self.commands[mode]
+        return command[DELTA][2] == (1 << self.deltas[command[TO_HUB_FORMAT]][3]) - 1
+
+    def _decode_snapshot(self, command, data):
+        # Split snapshot data into a dictionary of channel values.
+        snapshot = {}
+        offset = 0
+        for name in command[MEMBERS]:
+            fmt = self._command(name)[TO_HUB_FORMAT]
+            size = struct.calcsize(self._add_format(fmt))
+            values = self.decode(fmt, data[offset : offset + size])
+            snapshot[name] = values[0] if len(values) == 1 else values
+            offset += size
+        return snapshot
+
+    def _mux_values(self, mode_name, argv):
+        # Encode a multiplexed call as the values to write to the shared mode.
+        command = self.mux_commands[self.mux[mode_name]]
+        self._mux_seq = self._mux_seq % 255 + 1
+        payl = bytes([self.mux[mode_name], self._mux_seq])
+        size = self._write_size(self.modes[MUX])
+        if FROM_HUB_FORMAT in command:
+            self._check_args(command, argv)
+            payl += self.encode(
+                min(command[SIZE], size - 2), command[FROM_HUB_FORMAT], *argv
+            )
+        return self._int8_to_uint8(tuple(payl + b"\x00" * (size - len(payl))))
+
+    def _mux_result(self, mode_name, data):
+        # Decode the shared mode data. Returns None if the sensor did not
+        # answer the last call yet, or False if it is still busy with it.
+        if data[1] & 0xFF != self._mux_seq:
+            return None
+        if data[0] & 0xFF == MUX_BUSY:
+            return False
+        if data[0] & 0xFF != self.mux[mode_name]:
+            return None
+        command = self.mux_commands[self.mux[mode_name]]
+        fmt = command[TO_HUB_FORMAT]
+        result = self.decode(fmt, bytes([b & 0xFF for b in data[2:]]))
+        if fmt in self.stamped:
+            result = self._unstamp(command, result)
+        return result
+
+    def _unstamp(self, command, result):
+        # Remember the hub time of timestamped values, and return the values.
+        if self.clock:
+            # Not later than now, which they can seem by the error of the
+            # clock sync.
+            now = self._watch.time()
+            self._value_times[command[NAME]] = min(now, self.hub_time(result[-1]))
+        return result[:-1]
+
+    def sync_clock(self, rounds=CLOCK_ROUNDS):
+        """Measure the offset and drift of the sensor clock from the hub clock.
+
+        Takes the fastest of several round trips, and assumes the sensor read
+        its clock halfway. Call it after connecting, and now and then to follow
+        the drift. Needs `add_clock()`.
+
+        Args:
+            rounds: The number of round trips. Defaults to 8.
+
+        Returns:
+            The sensor time minus the hub time, in ms.
+        """
+        mode = self.modes[CLOCK]
+        best = None
+        for i in range(rounds):
+            self._clock_round = self._clock_round % 255 + 1
+            sent = self._watch.time()
+            self.pup_device.write(
+                mode, self._values_to_sensor(mode, (self._clock_round,))
+            )
+            for j in range(BULK_READS):
+                number, sensor_time, sensor_us = self._result_from_sensor(
+                    mode, self.pup_device.read(mode)
+                )
+                if number == self._clock_round:
+                    break
+                wait(1)
+            else:
+                continue
+            now = self._watch.time()
+            if best is None or now - sent < best[0]:
+                best = (now - sent, (sent + now) / 2, sensor_time, sensor_us)
+        if best is None:
+            raise OSError("No clock from sensor on " + str(self.port))
+        rtt, hub_time, sensor_time, sensor_us = best
+        offset = sensor_time - hub_time
+        drift = self.clock[2] if self.clock else 0
+        if self._first_sync is None:
+            self._first_sync = (hub_time, offset)
+        elif hub_time - self._first_sync[0] >= CLOCK_SPAN:
+            drift = (offset - self._first_sync[1]) / (hub_time - self._first_sync[0])
+        self.clock = (hub_time, offset, drift, sensor_us)
+        return offset
+
+    def hub_time(self, sensor_time, us=False):
+        """Convert a time of the sensor clock to the hub clock.
+
+        The sensor clock wraps, so this works for times up to days from the last
+        `sync_clock()` in ms, and up to 8 minutes in us. Needs `sync_clock()`.
+
+        Args:
+            sensor_time: The sensor time in ms.
+            us: Set to True for a sensor time in us, like the times of samples
+                from `drain()`. Defaults to False.
+
+        Returns:
+            The hub time in ms, like `StopWatch().time()`.
+        """
+        sync, offset, drift, sensor_us = self.clock
+        # Sensor ms since the sync
+        if us:
+            elapsed = _ticks_since(sensor_time, sensor_us) / 1000
+        else:
+            elapsed = _ticks_since(sensor_time, sync + offset)
+        return round(sync + elapsed / (1 + drift))
+
+    def age(self, mode_name: str):
+        """Return how old the last value read from a timestamped channel is.
+
+        Args:
+            mode_name: The name of a channel with a '@' format.
+
+        Returns:
+            The time in ms since the sensor updated the value, or None before
+            `sync_clock()` or the first read.
+        """
+        if mode_name not in self._value_times:
+            return None
+        return self._watch.time() - self._value_times[mode_name]
+
     def call(self, mode_name: str, *argv, wait_ms=0):
         """Call a remote function on the sensor side.
 
@@ -403,26 +2203,295 @@ class PUPRemoteHub(PUPRemote):
             not run_task()
         ), "Use 'call_multitask' instead of 'call', with multiple start blocks or multitask blocks"
 
+        if mode_name in self.mux:
+            mode = self.modes[MUX]
+            self.pup_device.write(mode, self._mux_values(mode_name, argv))
+            wait(wait_ms)
+            retries = MUX_RETRIES
+            reads = MUX_BUSY_READS
+            while retries and reads:
+                result = self._mux_result(mode_name, self.pup_device.read(mode))
+                if result is False:
+                    # Keep waiting as long as the sensor is busy.
+                    retries = MUX_RETRIES
+                elif result is not None:
+                    # Convert tuple size 1 to single value
+                    return result[0] if len(result) == 1 else result
+                retries -= 1
+                reads -= 1
+                wait(5)
+            if not reads:
+                raise OSError("Sensor still busy with '{}'".format(mode_name))
+            raise OSError("No answer to '{}' from sensor".format(mode_name))
+
         mode = self.modes[mode_name]
-        size = self.commands[mode][SIZE]
+
+        if self.commands[mode][TO_HUB_FORMAT] in self.deltas:
+            # Only wait for the first values. After that, return the values
+            # the hub has, and let a key frame bring the ones it missed.
+            for i in range(DELTA_READS):
+                result = self._result_from_sensor(mode, self.pup_device.read(mode))
+                if self.commands[mode][DELTA][3]:
+                    # Missed a frame. Any write asks the sensor for a key frame.
+                    self.pup_device.write(mode, [0] * self._write_size(mode))
+                if self._all_deltas(mode):
+                    break
+                wait(5)
+            return result
 
         if FROM_HUB_FORMAT in self.commands[mode]:
-            num_args = self.commands[mode][ARGS_FROM_HUB]
-            if num_args >= 0:
-                assert (
-                    len(argv) == num_args
-                ), "Expected {} argument(s) in call '{}'".format(num_args, mode_name)
-            payl = self.encode(size, self.commands[mode][FROM_HUB_FORMAT], *argv)
-            self.pup_device.write(
-                mode, self._int8_to_uint8(tuple(payl + b"\x00" * (size - len(payl))))
-            )
+            self.pup_device.write(mode, self._values_to_sensor(mode, argv))
             wait(wait_ms)
 
-        data = self.pup_device.read(mode)
-        raw_data = bytes([b if b>=0 else b+256 for b in data])
-        result = self.decode(self.commands[mode][TO_HUB_FORMAT], raw_data)
-        # Convert tuple size 1 to single value
-        return result[0] if len(result) == 1 else result
+        return self._result_from_sensor(mode, self.pup_device.read(mode))
+
+    def read_snapshot(self, mode_name: str, as_tuple=False):
+        """Read all channels of a snapshot mode at once.
+
+        Use `call_multitask(mode_name)` for the same result in multitask programs.
+
+        Args:
+            mode_name: The name of the snapshot you defined with `add_snapshot()`.
+            as_tuple: Set to True to get the values in the order of the channels
+                in the snapshot, instead of a dictionary. Defaults to False.
+
+        Returns:
+            A dictionary with the latest values of each channel in the snapshot,
+            or a tuple of them.
+        """
+        snapshot = self.call(mode_name)
+        if as_tuple:
+            members = self.commands[self.modes[mode_name]][MEMBERS]
+            return tuple([snapshot[name] for name in members])
+        return snapshot
+
+    def send_blob(self, name: str, data, window=BULK_WINDOW):
+        """Send a blob of bytes to the sensor, which gets it with `get_blob()`.
+
+        The blob goes in numbered chunks. The hub writes up to `window` chunks
+        ahead of the sensor's acknowledgement, and writes the chunks after the
+        last acknowledged one again if one got lost. The sensor checks a CRC over
+        the whole blob. Needs `add_bulk()`.
+
+        Args:
+            name: The name of the blob.
+            data: The bytes to send, up to 64 kB.
+            window: The number of chunks to write ahead. Defaults to 4.
+
+        Raises:
+            OSError: If the sensor doesn't answer, refused the blob, or the blob
+                arrived broken.
+        """
+        assert len(data) < 0x10000, "Blob exceeds 64 kB"
+        size = self._write_size(self.modes[BULK])
+        chunk = size - 4
+        chunks = (len(data) + chunk - 1) // chunk
+        self._bulk_id = self._bulk_id % 255 + 1
+        header = struct.pack("<HHB", len(data), crc16(data), chunk) + name.encode()
+        reply = self._bulk_request(size, BULK_PUT, 0, header, (BULK_ACK, BULK_DONE))
+        acked = sent = reads = 0
+        retries = BULK_RETRIES
+        while reply is None or reply[0] == BULK_ACK:
+            if reply and reply[1] > acked:
+                acked = reply[1]
+                reads = 0
+                retries = BULK_RETRIES
+            elif reads < BULK_READS:
+                reads += 1
+                wait(2)
+            else:
+                # Chunks or acknowledgements got lost. Write the chunks the
+                # sensor doesn't have again.
+                retries -= 1
+                if not retries:
+                    raise OSError("No answer to bulk transfer from " + str(self.port))
+                sent = acked
+                reads = 0
+            while sent < chunks and sent < acked + window:
+                self._bulk_write(
+                    size, BULK_DATA, sent, data[sent * chunk : (sent + 1) * chunk]
+                )
+                sent += 1
+            reply = self._bulk_reply()
+        if reply[0] != BULK_DONE:
+            raise OSError("Blob '{}' was refused or arrived broken".format(name))
+
+    def read_blob(self, name: str):
+        """Read a blob the sensor offers with `put_blob()`.
+
+        The hub asks for one chunk at a time, because a read only returns the
+        newest data from the sensor. Needs `add_bulk()`.
+
+        Args:
+            name: The name of the blob.
+
+        Returns:
+            The bytes of the blob, or None if the sensor has no blob by that name.
+
+        Raises:
+            OSError: If the sensor doesn't answer, or the blob arrived broken.
+        """
+        size = self._write_size(self.modes[BULK])
+        chunk = size - 4
+        self._bulk_id = self._bulk_id % 255 + 1
+        reply = self._bulk_request(size, BULK_GET, 0, name.encode(), (BULK_INFO,))
+        if reply[0] != BULK_INFO:
+            return None
+        length, crc = struct.unpack("<HH", reply[2][:4])
+        data = bytearray()
+        seq = 0
+        while len(data) < length:
+            reply = self._bulk_request(size, BULK_READ, seq, b"", (BULK_DATA,))
+            if reply[0] != BULK_DATA:
+                raise OSError("Blob '{}' is gone".format(name))
+            data += reply[2][: min(chunk, length - len(data))]
+            seq += 1
+        if crc16(data) != crc:
+            raise OSError("Blob '{}' arrived broken".format(name))
+        return bytes(data)
+
+    def _bulk_write(self, size, op, seq, data=b""):
+        # Write a bulk transfer message of the current transfer.
+        payl = struct.pack("<BBH", op, self._bulk_id, seq) + data
+        payl += b"\x00" * (size - len(payl))
+        self.pup_device.write(self.modes[BULK], self._int8_to_uint8(tuple(payl)))
+
+    def _bulk_reply(self):
+        # Read the sensor's reply in the current transfer as (op, chunk number,
+        # data), or None if it has not replied yet.
+        mode = self.modes[BULK]
+        data = self._result_from_sensor(mode, self.pup_device.read(mode))
+        if data[1] != self._bulk_id:
+            return None
+        op, tid, seq = struct.unpack("<BBH", data[:4])
+        return op, seq, data[4:]
+
+    def _bulk_request(self, size, op, seq, data, replies):
+        # Write a message and wait for one of the expected replies to it, or
+        # an error. Writes again if the message or the reply got lost.
+        for i in range(BULK_RETRIES):
+            self._bulk_write(size, op, seq, data)
+            for j in range(BULK_READS):
+                reply = self._bulk_reply()
+                if reply and (
+                    reply[0] == BULK_ERROR or reply[0] in replies and reply[1] == seq
+                ):
+                    return reply
+                wait(2)
+        raise OSError("No answer to bulk transfer from " + str(self.port))
+
+    def stream(self, mode_name: str, *argv):
+        """Call a remote generator and iterate over the items it yields.
+
+        The hub reads a frame of items at a time, and asks for the next frame
+        when the loop has used them. Leaving the loop early, like with `break`,
+        closes the generator on the sensor.
+
+        Args:
+            mode_name: The name of a stream added with `add_stream()`.
+            *argv: The arguments of the generator.
+
+        Yields:
+            The items, as single values or tuples.
+        """
+        mode = self.modes[mode_name]
+        command = self.commands[mode]
+        item_fmt, args_fmt, item_size = command[STREAM]
+        size = self._write_size(mode)
+        args = self.encode(size - 2, args_fmt, *argv) if args_fmt else b""
+        # The sensor takes a start with the sequence number it answered last
+        # for a resend, so skip that one. It may be from an earlier program.
+        last = self._result_from_sensor(mode, self.pup_device.read(mode))[0]
+        if self._stream_seq % 255 + 1 == last:
+            self._stream_seq = last
+        op = STREAM_START
+        end = False
+        try:
+            while not end:
+                data = self._stream_request(mode, size, op, args)
+                op = STREAM_NEXT
+                args = b""
+                end = data[1] & STREAM_END
+                for i in range(data[1] & ~STREAM_END):
+                    start = 2 + i * item_size
+                    item = self.decode(item_fmt, data[start : start + item_size])
+                    yield item[0] if len(item) == 1 else item
+        finally:
+            if not end:
+                self._stream_seq = self._stream_seq % 255 + 1
+                self._stream_write(mode, size, STREAM_STOP)
+
+    def drain(self, mode_name: str):
+        """Read all samples of a buffered channel since the last drain.
+
+        The hub acknowledges each frame of samples, so the sensor can drop them,
+        and reads until the sensor has no more. Samples the sensor had to drop
+        because its buffer was full are counted in `samples_lost`.
+
+        Args:
+            mode_name: The name of a channel added with `add_buffered_channel()`.
+
+        Returns:
+            A list of (time, value) pairs, with the time in us on the sensor
+            clock, which `hub_time()` converts. The value is a tuple for
+            formats with several values.
+        """
+        mode = self.modes[mode_name]
+        command = self.commands[mode]
+        fmt, sample_size, per_frame = command[RING]
+        fmt = "<" + fmt.lstrip("<=")
+        header_size = struct.calcsize(RING_HEADER)
+        samples = []
+        while True:
+            wanted = self._next_sample.get(mode_name)
+            self.pup_device.write(
+                mode, self._values_to_sensor(mode, (wanted is not None, wanted or 0))
+            )
+            for i in range(BULK_READS):
+                data = self._result_from_sensor(mode, self.pup_device.read(mode))
+                first, count, t = struct.unpack(RING_HEADER, data[:header_size])
+                skipped = (first - wanted) & 0xFFFF if wanted is not None else 0
+                if skipped < 0x8000:
+                    # Not a frame from before the acknowledgement
+                    break
+                wait(2)
+            else:
+                raise OSError("No samples from '{}' on {}".format(mode_name, self.port))
+            self.samples_lost += skipped
+            more = count & RING_MORE
+            count &= ~RING_MORE
+            offset = header_size
+            for i in range(count):
+                values = struct.unpack_from("<H" + fmt[1:], data, offset)
+                t += values[0] if i else 0
+                samples.append((t, values[1] if len(values) == 2 else values[1:]))
+                offset += sample_size
+            self._next_sample[mode_name] = (first + count) & 0xFFFF
+            if count < per_frame and not more:
+                return samples
+
+    def _stream_write(self, mode, size, op, args=b""):
+        # Write a stream request with the current sequence number.
+        payl = bytes([op, self._stream_seq]) + args
+        payl += b"\x00" * (size - len(payl))
+        self.pup_device.write(mode, self._int8_to_uint8(tuple(payl)))
+
+    def _stream_request(self, mode, size, op, args):
+        # Write a stream request and read until the reply to it arrives. Writes
+        # the request again if it or the reply got lost.
+        self._stream_seq = self._stream_seq % 255 + 1
+        for i in range(BULK_RETRIES):
+            self._stream_write(mode, size, op, args)
+            for j in range(BULK_READS):
+                data = self._result_from_sensor(mode, self.pup_device.read(mode))
+                if data[0] == self._stream_seq:
+                    return data
+                wait(2)
+        raise OSError(
+            "No answer from stream '{}' on {}".format(
+                self.commands[mode][NAME], self.port
+            )
+        )
 
     async def call_multitask(self, command_name: str, *argv, wait_ms=0):
         """Call a remote function asynchronously for use with Pybricks multitask.
@@ -453,26 +2522,47 @@ class PUPRemoteHub(PUPRemote):
         return result_holder[RESULT]
 
     async def _execute_call(self, mode_name: str, *argv, wait_ms=0):
+        if mode_name in self.mux:
+            mode = self.modes[MUX]
+            await self.pup_device.write(mode, self._mux_values(mode_name, argv))
+            await wait(wait_ms)
+            retries = MUX_RETRIES
+            reads = MUX_BUSY_READS
+            while retries and reads:
+                data = await self.pup_device.read(mode)
+                result = self._mux_result(mode_name, data)
+                if result is False:
+                    # Keep waiting as long as the sensor is busy.
+                    retries = MUX_RETRIES
+                elif result is not None:
+                    # Convert tuple size 1 to single value
+                    return result[0] if len(result) == 1 else result
+                retries -= 1
+                reads -= 1
+                await wait(5)
+            if not reads:
+                raise OSError("Sensor still busy with '{}'".format(mode_name))
+            raise OSError("No answer to '{}' from sensor".format(mode_name))
+
         mode = self.modes[mode_name]
-        size = self.commands[mode][SIZE]
+
+        if self.commands[mode][TO_HUB_FORMAT] in self.deltas:
+            for i in range(DELTA_READS):
+                data = await self.pup_device.read(mode)
+                result = self._result_from_sensor(mode, data)
+                if self.commands[mode][DELTA][3]:
+                    # Missed a frame. Any write asks the sensor for a key frame.
+                    await self.pup_device.write(mode, [0] * self._write_size(mode))
+                if self._all_deltas(mode):
+                    break
+                await wait(5)
+            return result
 
         if FROM_HUB_FORMAT in self.commands[mode]:
-            num_args = self.commands[mode][ARGS_FROM_HUB]
-            if num_args >= 0:
-                assert (
-                    len(argv) == num_args
-                ), "Expected {} argument(s) in call '{}'".format(num_args, mode_name)
-            payl = self.encode(size, self.commands[mode][FROM_HUB_FORMAT], *argv)
-            await self.pup_device.write(
-                mode, self._int8_to_uint8(tuple(payl + b"\x00" * (size - len(payl))))
-            )
+            await self.pup_device.write(mode, self._values_to_sensor(mode, argv))
             await wait(wait_ms)
 
-        data = await self.pup_device.read(mode)
-        raw_data = bytes([b if b>=0 else b+256 for b in data])
-        result = self.decode(self.commands[mode][TO_HUB_FORMAT], raw_data)
-        # Convert tuple size 1 to single value
-        return result[0] if len(result) == 1 else result
+        return self._result_from_sensor(mode, await self.pup_device.read(mode))
 
     async def process_async(self):
         """
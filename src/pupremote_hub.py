@@ -1,15 +1,36 @@
 # Trimmed version of pupremote that only runs on Pybricks hubs
 # Includes async/multitask support for concurrent hub-side operations
 #
-# This is a lightweight version (44% smaller than pupremote.py) optimized for:
+# This is a lightweight version of pupremote.py optimized for:
 # - Pybricks block code:
 #      - import sync functions connect(), add_command(), call()
 #      - import async functions call_multitask(), process_async()
 # - Pybricks multitask support for concurrent operations
-# - Low memory footprint on Pybricks hubs
 # - Hub-side only (no sensor emulation code)
 # - Async support via call_multitask() and process_async()
 # - Compatible with Pybricks multitask for concurrent operations
+#
+# Everything beyond plain struct and 'repr' formats is in add-on modules, so it
+# only takes memory on hubs that use it. Copy the add-ons next to this file,
+# and mix them into the hub class:
+#
+#     from pupremote_hub import PUPRemoteHub
+#     from pupremote_hub_bulk import BulkMixin
+#
+#     class Hub(BulkMixin, PUPRemoteHub):
+#         pass
+#
+# - pupremote_hub_formats.py: FormatMixin, for formats like '2h*0.01', '4e',
+#   '2h|12?' and '10h~20'
+# - pupremote_hub_mux.py: MuxMixin, to call commands added with mux=True
+# - pupremote_hub_snapshot.py: SnapshotMixin, with read_snapshot()
+# - pupremote_hub_schema.py: SchemaMixin, to register the commands of a sensor
+#   with schema=True
+# - pupremote_hub_probe.py: ProbeMixin, to write larger frames to a sensor
+#   with negotiate=True
+# - pupremote_hub_bulk.py: BulkMixin, with send_blob() and read_blob()
+# - pupremote_hub_stream.py: StreamMixin, with stream() and drain()
+# - pupremote_hub_clock.py: ClockMixin, with sync_clock(), hub_time() and age()
 
 __author__ = "Anton Vanhoucke & Ste7an"
 __copyright__ = "Copyright 2023,2024 AntonsMindstorms.com"
@@ -19,10 +40,19 @@ __status__ = "Production"
 
 import ustruct as struct
 from pybricks.iodevices import PUPDevice
-from pybricks.tools import wait, run_task
+from pybricks.tools import wait, run_task, StopWatch
 from micropython import const
 
 MAX_PKT = const(16)
+MAX_COMMANDS = const(16)
+MAX_MUX_COMMANDS = const(255)
+# Buffered channel frames: number of the first sample (2 bytes), number of
+# samples, time of the first sample in us (4 bytes), then the samples, each
+# with the us since the previous one (2 bytes). A frame ends early at a
+# sample that is too long after the previous one, and the next frame starts
+# with it.
+RING_HEADER = "<HBI"
+RING_MORE = const(0x80)  # Flag in the number of samples: the frame ended early
 
 # Result holder indices
 DONE = const(0)
@@ -36,8 +66,125 @@ TO_HUB_FORMAT = const(2)
 FROM_HUB_FORMAT = const(3)
 ARGS_TO_HUB = const(5)
 ARGS_FROM_HUB = const(6)
+DATA_TYPE = const(7)
+MEMBERS = const(10)
+DELTA = const(16)
+STREAM = const(17)
+RING = const(19)
 CALLBACK = const(0)
 CHANNEL = const(1)
+SCHEMA = "_sch"
+MUX = "_mux"
+PROBE = "_mps"
+BULK = "_blk"
+CLOCK = "_clk"
+
+# LPF2 data types and their size in bytes
+DATA8 = const(0)
+DATA16 = const(1)
+DATA32 = const(2)
+DATAF = const(3)
+TYPE_SIZES = (1, 2, 4, 4)
+# Struct codes that map directly on an LPF2 data type. Not 'l', which is 8
+# bytes on 64-bit CPython.
+NATIVE_TYPES = {"b": DATA8, "h": DATA16, "i": DATA32, "f": DATAF}
+
+
+def native_type(fmt):
+    # Return the LPF2 data type for a format of a single signed type, else None.
+    codes = set([c for c in fmt if not c.isdigit() and c not in "<="])
+    if len(codes) == 1:
+        return NATIVE_TYPES.get(codes.pop())
+    return None
+
+
+def literal(text):
+    # Return the value of a Python literal, without running eval(). Supports
+    # the repr() of numbers, strings, bytes, True, False, None and lists,
+    # tuples, dicts and sets of those.
+    try:
+        value, i = _parse(text, _skip(text, 0))
+    except IndexError:
+        raise ValueError("Incomplete literal")
+    if _skip(text, i) != len(text):
+        raise ValueError("Unexpected data after literal")
+    return value
+
+
+def _skip(s, i):
+    # Skip spaces
+    while i < len(s) and s[i] == " ":
+        i += 1
+    return i
+
+
+def _parse(s, i):
+    # Parse the literal that starts at s[i]. Returns its value and the index
+    # after it.
+    c = s[i]
+    if c in "([{":
+        close = ")]}"["([{".index(c)]
+        items = []
+        keys = []
+        comma = False
+        i = _skip(s, i + 1)
+        while s[i] != close:
+            value, i = _parse(s, i)
+            i = _skip(s, i)
+            if s[i] == ":":
+                keys.append(value)
+                value, i = _parse(s, _skip(s, i + 1))
+                i = _skip(s, i)
+            items.append(value)
+            comma = s[i] == ","
+            if comma:
+                i = _skip(s, i + 1)
+            elif s[i] != close:
+                raise ValueError("Expected '{}' at {}".format(close, i))
+        i += 1
+        if c == "[":
+            return items, i
+        if c == "{":
+            if items and not keys:
+                return set(items), i
+            return dict(zip(keys, items)), i
+        return (items[0] if len(items) == 1 and not comma else tuple(items)), i
+    if c in "'\"" or c == "b" and s[i + 1] in "'\"":
+        is_bytes = c == "b"
+        if is_bytes:
+            i += 1
+        quote = s[i]
+        chars = []
+        i += 1
+        while s[i] != quote:
+            c = s[i]
+            if c == "\\":
+                i += 1
+                c = s[i]
+                if c in "xu":
+                    n = 2 if c == "x" else 4
+                    c = chr(int(s[i + 1 : i + 1 + n], 16))
+                    i += n
+                else:
+                    c = {"n": "\n", "r": "\r", "t": "\t", "0": "\0"}.get(c, c)
+            chars.append(c)
+            i += 1
+        if is_bytes:
+            return bytes([ord(c) for c in chars]), i + 1
+        return "".join(chars), i + 1
+    for name, value in (("True", True), ("False", False), ("None", None)):
+        if s[i : i + len(name)] == name:
+            return value, i + len(name)
+    j = i
+    while j < len(s) and s[j] in "0123456789+-.eE":
+        j += 1
+    number = s[i:j]
+    if not number:
+        raise ValueError("Unexpected '{}' at {}".format(c, i))
+    for c in ".eE":
+        if c in number:
+            return float(number), j
+    return int(number), j
 
 
 def connect(port):
@@ -108,8 +255,26 @@ class PUPRemote:
         self.commands = []
         self.modes = {}
         self.max_packet_size = max_packet_size
-
-    def add_channel(self, mode_name: str, to_hub_fmt: str = ""):
+        # Largest mode the hub writes to. A negotiating sensor keeps these to
+        # 16 bytes, which all hubs write, and only sends larger channels.
+        self.write_size = max_packet_size
+        # Multiplexed commands, sharing one mode
+        self.mux_commands = []
+        self.mux = {}
+        # The formats of FormatMixin. Quantized formats: (struct format,
+        # scale, offset). No scale means half precision floats.
+        self.quantized = {}
+        # Bit field formats: (struct format, format before the bit fields,
+        # number of values before the bit fields, fields, bytes). Each field
+        # is a (shift, mask, type) triple, to unpack it from a single integer.
+        self.bitfields = {}
+        # Delta formats: (struct format, byte order, struct code, number of
+        # values, bitmap bytes, updates between key frames).
+        self.deltas = {}
+        # Timestamped formats: (format without the timestamp, its size)
+        self.stamped = {}
+
+    def add_channel(self, mode_name: str, to_hub_fmt: str = "", mux=False):
         """Define a data channel to read on the hub.
 
         Use this function with identical parameters on both the sensor and the hub.
@@ -121,8 +286,11 @@ class PUPRemote:
             to_hub_fmt: The format string of the data sent from the sensor to the hub.
                 Use 'repr' to receive any python object. Or use a struct format string.
                 See https://docs.python.org/3/library/struct.html
+            mux: Set to True to read the channel through the shared multiplexed mode.
         """
-        self.add_command(mode_name, to_hub_fmt=to_hub_fmt, command_type=CHANNEL)
+        self.add_command(
+            mode_name, to_hub_fmt=to_hub_fmt, command_type=CHANNEL, mux=mux
+        )
 
     def add_command(
         self,
@@ -130,6 +298,8 @@ class PUPRemote:
         to_hub_fmt: str = "",
         from_hub_fmt: str = "",
         command_type=CALLBACK,
+        mux=False,
+        refresh_ms=0,
     ):
         """Define a remote call.
 
@@ -140,44 +310,245 @@ class PUPRemote:
             to_hub_fmt: The format string of the data sent from the sensor to the hub.
                 Use 'repr' to receive any python object. Or use a struct format string.
                 See https://docs.python.org/3/library/struct.html
+                Add '*scale' or '*scale+offset' to scale integers to floats, like
+                '2h*0.01'. Use 'e' for half precision floats, like '4e'.
+                Add '|' and bit fields to pack flags and small numbers into bits,
+                like '2h|12?2u3' for 12 booleans and two 3 bit unsigned numbers.
+                Add '~' and a number to a channel to send only the values that
+                changed, and all values every that many updates, like '10h~20'.
+                The hub asks for all values when it missed an update.
+                These formats need FormatMixin.
+                Add '@' to a channel to send the time of each update with the
+                values, like '3h@'. See `age()` of ClockMixin.
             from_hub_fmt: The format string of the data sent from the hub.
             command_type: CALLBACK or CHANNEL (internal).
+            mux: Set to True to share a single LPF2 mode with the other multiplexed
+                commands. This lifts the limit of 16 commands and saves the mode
+                switch between calls. Payloads are 2 bytes smaller. Calling them
+                needs MuxMixin. Defaults to False.
+            refresh_ms: For functions without arguments. Set to a positive
+                interval to have the sensor call the function in the background,
+                at most once per interval, and keep its result like a channel.
+                The hub then reads the latest result without a round trip.
+                Defaults to 0.
         """
+        assert not (
+            refresh_ms and from_hub_fmt
+        ), "Only functions without arguments can be refreshed"
+        if refresh_ms:
+            command_type = CHANNEL
+        max_size = self.max_packet_size if command_type == CHANNEL else self.write_size
+        if mux:
+            if MUX not in self.modes:
+                self._add_mux()
+            # Room for the command id and sequence number
+            max_size = self.commands[self.modes[MUX]][SIZE] - 2
+
+        data_type = None
         if to_hub_fmt == "repr" or from_hub_fmt == "repr":
-            msg_size = self.max_packet_size
+            msg_size = max_size
             num_args_from_hub = -1
             num_args_to_hub = -1
         else:
-            size_to_hub_fmt = struct.calcsize(to_hub_fmt)
-            size_from_hub_fmt = struct.calcsize(from_hub_fmt)
+            to_hub_struct = self._add_format(to_hub_fmt)
+            from_hub_struct = self._add_format(from_hub_fmt)
+            if to_hub_struct == to_hub_fmt and from_hub_struct == from_hub_fmt:
+                # Quantized values need converting, so they can't be native.
+                data_type = native_type(to_hub_fmt + from_hub_fmt)
+            size_to_hub_fmt = struct.calcsize(to_hub_struct)
+            size_from_hub_fmt = struct.calcsize(from_hub_struct)
             msg_size = max(size_to_hub_fmt, size_from_hub_fmt)
-            num_args_to_hub = len(
-                struct.unpack(to_hub_fmt, bytearray(struct.calcsize(to_hub_fmt)))
-            )
-            num_args_from_hub = len(
-                struct.unpack(from_hub_fmt, bytearray(struct.calcsize(from_hub_fmt)))
-            )
+            num_args_to_hub = self._num_values(to_hub_fmt)
+            num_args_from_hub = self._num_values(from_hub_fmt)
 
-        assert msg_size <= self.max_packet_size, "Payload exceeds maximum packet size"
-        self.commands.append(
-            {
-                NAME: mode_name,
-                TO_HUB_FORMAT: to_hub_fmt,
-                SIZE: msg_size,
-                ARGS_TO_HUB: num_args_to_hub,
-            }
-        )
+        assert msg_size <= max_size, "Payload exceeds maximum packet size"
+        assert to_hub_fmt not in self.deltas or (
+            command_type == CHANNEL and not mux
+        ), "Only channels in their own mode can send deltas"
+        assert (
+            to_hub_fmt not in self.stamped or command_type == CHANNEL
+        ), "Only channels can send timestamps"
+        command = {
+            NAME: mode_name,
+            TO_HUB_FORMAT: to_hub_fmt,
+            SIZE: msg_size,
+            ARGS_TO_HUB: num_args_to_hub,
+        }
         if command_type == CALLBACK:
-            self.commands[-1][FROM_HUB_FORMAT] = from_hub_fmt
-            self.commands[-1][ARGS_FROM_HUB] = num_args_from_hub
+            command[FROM_HUB_FORMAT] = from_hub_fmt
+            command[ARGS_FROM_HUB] = num_args_from_hub
+
+        if mux:
+            assert len(self.mux_commands) < MAX_MUX_COMMANDS, "Command limit exceeded"
+            self.mux[mode_name] = len(self.mux_commands)
+            self.mux_commands.append(command)
+            return
+
+        if data_type is not None:
+            command[DATA_TYPE] = data_type
+        assert len(self.commands) < MAX_COMMANDS, "Command limit exceeded"
+        self.commands.append(command)
 
         # Build a dictionary of mode names and their index
         self.modes[mode_name] = len(self.commands) - 1
 
+    def add_snapshot(self, mode_name: str, channels):
+        """Define a snapshot mode that delivers several channels in one read.
+
+        Use this function with identical parameters on both the sensor and the hub,
+        after adding the channels. The sensor keeps the latest values of all
+        channels in the snapshot. On the hub, `read_snapshot()` of SnapshotMixin
+        returns them from a single read, without switching modes for each channel.
+
+        Args:
+            mode_name: The name of the snapshot mode.
+            channels: A list of channel names with struct formats.
+        """
+        size = 0
+        for name in channels:
+            command = self._command(name)
+            assert (
+                FROM_HUB_FORMAT not in command
+                and command[ARGS_TO_HUB] >= 0
+                and command[TO_HUB_FORMAT] not in self.deltas
+                and command[TO_HUB_FORMAT] not in self.stamped
+            ), "'{}' is not a channel with a struct format".format(name)
+            size += struct.calcsize(self._add_format(command[TO_HUB_FORMAT]))
+        self.add_channel(mode_name, "%ds" % size)
+        self._command(mode_name)[MEMBERS] = list(channels)
+
+    def add_bulk(self):
+        """Add the mode for bulk transfers of blobs of bytes, up to 64 kB.
+
+        Use this function in the same place between the other commands on both the
+        sensor and the hub. With BulkMixin, the hub sends blobs with `send_blob()`
+        and reads the blobs the sensor offers with `put_blob()` using `read_blob()`.
+        """
+        fmt = "%ds" % self.write_size
+        self.add_command(BULK, fmt, fmt)
+
+    def add_stream(self, mode_name: str, to_hub_fmt: str, from_hub_fmt: str = ""):
+        """Define a remote generator that the hub iterates over with `stream()`.
+
+        Use this function with identical parameters on both the sensor and the hub.
+        On the sensor, the function with the mode name is a generator. The hub
+        asks for the next items when it has used the previous ones, so it can act
+        on the first items while the sensor makes the rest. Frames carry as many
+        items of a struct format as fit. `stream()` is in StreamMixin.
+
+        Args:
+            mode_name: The name of the mode, and the generator to call.
+            to_hub_fmt: The format string of each item sent to the hub. Use 'repr'
+                to send any python object, one per frame.
+            from_hub_fmt: The format string of the arguments of the generator.
+        """
+        room = self.write_size - 2  # Sequence number and item count
+        if to_hub_fmt == "repr":
+            item_size = room
+        else:
+            item_size = struct.calcsize(self._add_format(to_hub_fmt))
+        assert 0 < item_size <= room, "Stream item exceeds maximum packet size"
+        assert (
+            from_hub_fmt == "repr"
+            or struct.calcsize(self._add_format(from_hub_fmt)) <= room
+        ), "Payload exceeds maximum packet size"
+        self.add_command(
+            mode_name,
+            "%ds" % (2 + room // item_size * item_size),
+            "%ds" % self.write_size,
+        )
+        self._command(mode_name)[STREAM] = (to_hub_fmt, from_hub_fmt, item_size)
+
+    def add_buffered_channel(self, mode_name: str, to_hub_fmt: str):
+        """Define a channel that keeps every sample until the hub drains it.
+
+        Use this function with identical parameters on both the sensor and the hub.
+        The sensor adds timestamped samples with `append_sample()`, faster than
+        the hub reads them. The hub gets all samples since its last read with
+        `drain()` of StreamMixin, many to a frame.
+
+        Args:
+            mode_name: The name of the mode.
+            to_hub_fmt: The struct format of a sample, with a single type, like
+                'h' or '3h'.
+        """
+        codes = [c for c in to_hub_fmt if not c.isdigit() and c not in "<="]
+        assert len(set(codes)) == 1, "Samples need a format with a single type"
+        room = self.write_size - struct.calcsize(RING_HEADER)
+        sample_size = 2 + struct.calcsize("<" + to_hub_fmt.lstrip("<="))
+        assert sample_size <= room, "Sample exceeds maximum packet size"
+        per_frame = min(room // sample_size, 255)
+        # The hub writes whether it acknowledges samples, and the number of
+        # the first sample it wants.
+        self._add_buffered(
+            mode_name,
+            "%ds" % (struct.calcsize(RING_HEADER) + per_frame * sample_size),
+            "?H",
+        )
+        self._command(mode_name)[RING] = (to_hub_fmt, sample_size, per_frame)
+
+    def _add_buffered(self, mode_name, to_hub_fmt, from_hub_fmt):
+        # Add the mode of a buffered channel.
+        self.add_command(mode_name, to_hub_fmt, from_hub_fmt)
+
+    def add_clock(self):
+        """Add the mode with which the hub syncs its clock to the sensor clock.
+
+        Use this function in the same place between the other commands on both the
+        sensor and the hub. With ClockMixin, the hub then measures the offset and
+        drift of the sensor clock with `sync_clock()`.
+        """
+        # The hub writes a round number. The sensor answers it with its time
+        # in ms and in us.
+        self.add_command(CLOCK, "BII", "B")
+
+    def _command(self, name):
+        # Return a command by name, multiplexed or not.
+        if name in self.mux:
+            return self.mux_commands[self.mux[name]]
+        return self.commands[self.modes[name]]
+
+    def _add_mux(self):
+        # Add the mode that carries all multiplexed commands.
+        fmt = "%ds" % self.write_size
+        self.add_command(MUX, fmt, fmt)
+
+    def _add_format(self, fmt):
+        # Return the struct format for a format. A '@' at the end adds the
+        # sensor time in ms after the values. FormatMixin adds more formats.
+        if fmt in self.stamped:
+            return "%ds" % (self.stamped[fmt][1] + 4)
+        if fmt[-1:] == "@":
+            # The values, and the sensor time in ms in 4 bytes.
+            base = fmt[:-1]
+            assert base != "repr", "Timestamps need a struct format, like '3h@'"
+            base_struct = self._add_format(base)
+            assert (
+                base not in self.deltas
+            ), "Timestamps need a struct format, like '3h@'"
+            self.stamped[fmt] = (base, struct.calcsize(base_struct))
+            return "%ds" % (self.stamped[fmt][1] + 4)
+        for c in "~|*e":
+            assert c not in fmt, "Use FormatMixin for the format '{}'".format(fmt)
+        return fmt
+
+    def _num_values(self, fmt):
+        # Return the number of values in a format.
+        struct_fmt = self._add_format(fmt)
+        if fmt in self.stamped:
+            return self._num_values(self.stamped[fmt][0])
+        return len(struct.unpack(struct_fmt, bytearray(struct.calcsize(struct_fmt))))
+
     def decode(self, fmt: str, data: bytes):
         if fmt == "repr":
-            clean = data.rstrip(b"\x00")
-            return (eval(clean),) if clean else ("",)
+            # The text ends at the first zero. Any bytes after it are left
+            # over from earlier, longer frames.
+            clean = bytes(data).split(b"\x00")[0]
+            return (literal(str(clean, "utf-8")),) if clean else ("",)
+        elif fmt in self.stamped:
+            base, size = self.stamped[fmt]
+            stamp = struct.unpack("<I", bytes(data[size : size + 4]))
+            return self.decode(base, data[:size]) + stamp
         else:
             size = struct.calcsize(fmt)
             data = struct.unpack(fmt, data[:size])
@@ -185,7 +556,15 @@ class PUPRemote:
 
     def encode(self, size, format, *argv):
         if format == "repr":
+            # End with a zero, in case the frame is shorter than the mode.
             s = bytes(repr(*argv), "UTF-8")
+            if len(s) < size:
+                s += b"\x00"
+        elif format in self.stamped:
+            # The time is the last value.
+            base, base_size = self.stamped[format]
+            s = self.encode(base_size, base, *argv[:-1])
+            s += struct.pack("<I", argv[-1])
         else:
             s = struct.pack(format, *argv)
         assert len(s) <= size, "Payload exceeds maximum packet size"
@@ -196,7 +575,10 @@ class PUPRemoteHub(PUPRemote):
     """Communicate with a PUPRemoteSensor from a Pybricks hub.
 
     Use on the hub side running Pybricks. Copy the commands you defined on the sensor
-    side to the hub side using add_command() and add_channel().
+    side to the hub side using add_command() and add_channel(). If the sensor was
+    created with schema=True, all commands are registered automatically. If the
+    sensor was created with negotiate=True, the hub reads channels in the packet
+    size of the sensor, and checks if it can write frames of that size.
 
     Args:
         port: The port to which the PUPRemoteSensor is connected (e.g., Port.A).
@@ -218,13 +600,60 @@ class PUPRemoteHub(PUPRemote):
         # Multitask stuff
         self._queue = []
         self._multitask_loop_running = False
+        # Read the advertised modes once, to check commands against.
+        self._sensor_modes = self.pup_device.info()["modes"]
+        self._watch = StopWatch()
+        # Hub time of the last read of timestamped channels, and the sensor
+        # time of their values, by name
+        self._stamps = {}
+        # Largest frame the hub writes
+        self.frame_size = max_packet_size
+        if self._sensor_modes[0][0].rstrip() == PROBE:
+            self._probe()
+        if self._sensor_modes[len(self.commands)][0].rstrip() == SCHEMA:
+            self._read_schema()
+
+    def _probe(self):
+        # Register the probe mode of a negotiating sensor. Like the sensor,
+        # keep the other modes the hub writes to 16 bytes. ProbeMixin checks
+        # if the hub can write larger frames.
+        size = self._sensor_modes[0][1]
+        self.max_packet_size = self.write_size = size
+        self.add_command(PROBE, "B", "%ds" % size)
+        self.write_size = self.frame_size = MAX_PKT
+
+    def _read_schema(self):
+        # Register the mode of the command table the sensor publishes.
+        # SchemaMixin reads the table, and registers all commands in it.
+        n = self._sensor_modes[len(self.commands)][1] - 1  # Schema bytes per page
+        self.add_command(SCHEMA, "B%ds" % n, "B")
 
     def add_command(
-        self, mode_name, to_hub_fmt="", from_hub_fmt="", command_type=CALLBACK
+        self,
+        mode_name,
+        to_hub_fmt="",
+        from_hub_fmt="",
+        command_type=CALLBACK,
+        mux=False,
+        refresh_ms=0,
     ):
-        super().add_command(mode_name, to_hub_fmt, from_hub_fmt, command_type)
+        if mode_name in self.modes or mode_name in self.mux:
+            # Already registered from the sensor's command table.
+            if mux:
+                command = self.mux_commands[self.mux[mode_name]]
+            else:
+                command = self.commands[self.modes[mode_name]]
+            assert to_hub_fmt == command[TO_HUB_FORMAT] and from_hub_fmt == command.get(
+                FROM_HUB_FORMAT, ""
+            ), "Different formats than on remote side for '{}'".format(mode_name)
+            return
+        super().add_command(
+            mode_name, to_hub_fmt, from_hub_fmt, command_type, mux, refresh_ms
+        )
+        if mux:
+            return
         # Check the newly added commands against the advertised modes.
-        modes = self.pup_device.info()["modes"]
+        modes = self._sensor_modes
         n = len(self.commands) - 1  # Zero indexed mode number
         assert len(self.commands) <= len(modes), "More commands than on remote side"
         assert (
@@ -232,11 +661,66 @@ class PUPRemoteHub(PUPRemote):
         ), "Expected '{}' as mode {}, but got '{}'".format(
             modes[n][0].rstrip(), n, mode_name
         )
+        data_type = self.commands[-1].get(DATA_TYPE, DATA8)
         assert (
-            self.commands[-1][SIZE] == modes[n][1]
+            self.commands[-1][SIZE] // TYPE_SIZES[data_type] == modes[n][1]
+            and data_type == modes[n][2]
         ), "Different parameter size than on remote side. Check formats."
 
-    def call(self, mode_name: str, *argv, wait_ms=0) -> Any:
+    def _check_args(self, command, argv):
+        num_args = command[ARGS_FROM_HUB]
+        if num_args >= 0:
+            assert (
+                len(argv) == num_args
+            ), "Expected {} argument(s) in call '{}'".format(num_args, command[NAME])
+
+    def _write_size(self, mode):
+        # Return the number of bytes to write to a mode. PUPDevice.write()
+        # takes all values of the mode, and frames that are larger than the
+        # hub can write arrive broken.
+        command = self.commands[mode]
+        assert (
+            command[SIZE] <= self.frame_size
+        ), "Mode '{}' needs larger frames than the hub writes. Use max_packet_size={} on the sensor".format(
+            command[NAME], self.frame_size
+        )
+        return command[SIZE]
+
+    def _values_to_sensor(self, mode, argv):
+        # Encode call arguments as the list of values PUPDevice.write() expects.
+        command = self.commands[mode]
+        self._check_args(command, argv)
+        size = self._write_size(mode)
+        if DATA_TYPE in command:
+            # Native data type. The hub writes the values as they are.
+            num_values = size // TYPE_SIZES[command[DATA_TYPE]]
+            assert len(argv) <= num_values, "Payload exceeds maximum packet size"
+            return list(argv) + [0] * (num_values - len(argv))
+        payl = self.encode(size, command[FROM_HUB_FORMAT], *argv)
+        return self._int8_to_uint8(tuple(payl + b"\x00" * (size - len(payl))))
+
+    def _result_from_sensor(self, mode, data):
+        # Decode the values from PUPDevice.read() into the call result.
+        command = self.commands[mode]
+        if DATA_TYPE in command:
+            # Native data type. No need to convert and unpack.
+            result = data[: command[ARGS_TO_HUB]]
+        else:
+            raw_data = bytes([b if b >= 0 else b + 256 for b in data])
+            fmt = command[TO_HUB_FORMAT]
+            result = self.decode(fmt, raw_data)
+            if fmt in self.stamped:
+                result = self._unstamp(command, result)
+        # Convert tuple size 1 to single value
+        return result[0] if len(result) == 1 else result
+
+    def _unstamp(self, command, result):
+        # Remember when the hub read timestamped values, and their sensor time,
+        # for the age() of ClockMixin. Returns the values.
+        self._stamps[command[NAME]] = (self._watch.time(), result[-1])
+        return result[:-1]
+
+    def call(self, mode_name: str, *argv, wait_ms=0):
         """Call a remote function on the sensor side.
 
         Args:
@@ -256,29 +740,12 @@ class PUPRemoteHub(PUPRemote):
         ), "Use 'call_multitask' instead of 'call', with multiple start blocks or multitask blocks"
 
         mode = self.modes[mode_name]
-        size = self.commands[mode][SIZE]
 
         if FROM_HUB_FORMAT in self.commands[mode]:
-            num_args = self.commands[mode][ARGS_FROM_HUB]
-            if num_args >= 0:
-                assert (
-                    len(argv) == num_args
-                ), "Expected {} argument(s) in call '{}'".format(num_args, mode_name)
-            payl = self.encode(size, self.commands[mode][FROM_HUB_FORMAT], *argv)
-            self.pup_device.write(
-                mode,
-                [
-                    ((i + 128) & 0xFF) - 128
-                    for i in tuple(payl + b"\x00" * (size - len(payl)))
-                ],
-            )
+            self.pup_device.write(mode, self._values_to_sensor(mode, argv))
             wait(wait_ms)
 
-        data = self.pup_device.read(mode)
-        raw_data = bytes([b if b>=0 else b+256 for b in data])
-        result = self.decode(self.commands[mode][TO_HUB_FORMAT], raw_data)
-        # Convert tuple size 1 to single value
-        return result[0] if len(result) == 1 else result
+        return self._result_from_sensor(mode, self.pup_device.read(mode))
 
     async def call_multitask(self, command_name: str, *argv, wait_ms=0):
         """Call a remote function asynchronously for use with Pybricks multitask.
@@ -310,27 +777,12 @@ class PUPRemoteHub(PUPRemote):
 
     async def _execute_call(self, mode_name: str, *argv, wait_ms=0):
         mode = self.modes[mode_name]
-        size = self.commands[mode][SIZE]
 
         if FROM_HUB_FORMAT in self.commands[mode]:
-            num_args = self.commands[mode][ARGS_FROM_HUB]
-            if num_args >= 0:
-                assert len(argv) == num_args, "Args mismatch in {}".format(mode_name)
-            payl = self.encode(size, self.commands[mode][FROM_HUB_FORMAT], *argv)
-            await self.pup_device.write(
-                mode,
-                [
-                    ((i + 128) & 0xFF) - 128
-                    for i in tuple(payl + b"\x00" * (size - len(payl)))
-                ],
-            )
+            await self.pup_device.write(mode, self._values_to_sensor(mode, argv))
             await wait(wait_ms)
 
-        data = await self.pup_device.read(mode)
-        raw_data = bytes([b if b>=0 else b+256 for b in data])
-        result = self.decode(self.commands[mode][TO_HUB_FORMAT], raw_data)
-        # Convert tuple size 1 to single value
-        return result[0] if len(result) == 1 else result
+        return self._result_from_sensor(mode, await self.pup_device.read(mode))
 
     async def process_async(self):
         """
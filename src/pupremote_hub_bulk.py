@@ -0,0 +1,164 @@
+# Bulk transfer add-on for pupremote_hub.py on Pybricks hubs
+#
+# Moves blobs of up to 64 kB to and from a sensor with `add_bulk()`, in
+# windowed and acknowledged chunks. Mix it into the hub class:
+#
+#     from pupremote_hub import PUPRemoteHub
+#     from pupremote_hub_bulk import BulkMixin
+#
+#     class Hub(BulkMixin, PUPRemoteHub):
+#         pass
+
+__author__ = "Anton Vanhoucke & Ste7an"
+__copyright__ = "Copyright 2023,2024 AntonsMindstorms.com"
+__license__ = "GPL"
+__version__ = "2.1"
+__status__ = "Production"
+
+import ustruct as struct
+from pybricks.tools import wait
+from micropython import const
+from pupremote_hub import BULK, SIZE
+
+BULK_WINDOW = const(4)  # Chunks the hub writes ahead of the sensor's acknowledgement
+BULK_READS = const(50)  # Reads without progress before the hub writes again
+BULK_RETRIES = const(5)  # Writes again before a bulk transfer fails
+# Bulk transfer messages: op, transfer id, chunk number (2 bytes), data
+BULK_PUT = const(1)  # Hub starts sending: length, CRC, chunk size, name
+BULK_DATA = const(2)  # A chunk of the blob
+BULK_GET = const(3)  # Hub starts reading: name
+BULK_READ = const(4)  # Hub asks for a chunk
+BULK_ACK = const(5)  # Sensor got all chunks before the chunk number
+BULK_INFO = const(6)  # Sensor has the blob: length, CRC
+BULK_DONE = const(7)  # Sensor got the blob with a matching CRC
+BULK_ERROR = const(8)  # Sensor has no such blob, or it got a broken one
+
+
+def crc16(data, crc=0xFFFF):
+    # CRC-16/CCITT-FALSE of bytes.
+    for b in data:
+        crc ^= b << 8
+        for i in range(8):
+            crc = (crc << 1 ^ 0x1021 if crc & 0x8000 else crc << 1) & 0xFFFF
+    return crc
+
+
+class BulkMixin:
+    """Bulk transfers for a PUPRemoteHub, with a sensor that has `add_bulk()`."""
+
+    _bulk_id = 0
+
+    def send_blob(self, name: str, data, window=BULK_WINDOW):
+        """Send a blob of bytes to the sensor, which gets it with `get_blob()`.
+
+        The blob goes in numbered chunks. The hub writes up to `window` chunks
+        ahead of the sensor's acknowledgement, and writes the chunks after the
+        last acknowledged one again if one got lost. The sensor checks a CRC over
+        the whole blob. Needs `add_bulk()`.
+
+        Args:
+            name: The name of the blob.
+            data: The bytes to send, up to 64 kB.
+            window: The number of chunks to write ahead. Defaults to 4.
+
+        Raises:
+            OSError: If the sensor doesn't answer, refused the blob, or the blob
+                arrived broken.
+        """
+        assert len(data) < 0x10000, "Blob exceeds 64 kB"
+        size = self._write_size(self.modes[BULK])
+        chunk = size - 4
+        chunks = (len(data) + chunk - 1) // chunk
+        self._bulk_id = self._bulk_id % 255 + 1
+        header = struct.pack("<HHB", len(data), crc16(data), chunk) + name.encode()
+        reply = self._bulk_request(size, BULK_PUT, 0, header, (BULK_ACK, BULK_DONE))
+        acked = sent = reads = 0
+        retries = BULK_RETRIES
+        while reply is None or reply[0] == BULK_ACK:
+            if reply and reply[1] > acked:
+                acked = reply[1]
+                reads = 0
+                retries = BULK_RETRIES
+            elif reads < BULK_READS:
+                reads += 1
+                wait(2)
+            else:
+                # Chunks or acknowledgements got lost. Write the chunks the
+                # sensor doesn't have again.
+                retries -= 1
+                if not retries:
+                    raise OSError("No answer to bulk transfer from " + str(self.port))
+                sent = acked
+                reads = 0
+            while sent < chunks and sent < acked + window:
+                self._bulk_write(
+                    size, BULK_DATA, sent, data[sent * chunk : (sent + 1) * chunk]
+                )
+                sent += 1
+            reply = self._bulk_reply()
+        if reply[0] != BULK_DONE:
+            raise OSError("Blob '{}' was refused or arrived broken".format(name))
+
+    def read_blob(self, name: str):
+        """Read a blob the sensor offers with `put_blob()`.
+
+        The hub asks for one chunk at a time, because a read only returns the
+        newest data from the sensor. Needs `add_bulk()`.
+
+        Args:
+            name: The name of the blob.
+
+        Returns:
+            The bytes of the blob, or None if the sensor has no blob by that name.
+
+        Raises:
+            OSError: If the sensor doesn't answer, or the blob arrived broken.
+        """
+        size = self._write_size(self.modes[BULK])
+        chunk = size - 4
+        self._bulk_id = self._bulk_id % 255 + 1
+        reply = self._bulk_request(size, BULK_GET, 0, name.encode(), (BULK_INFO,))
+        if reply[0] != BULK_INFO:
+            return None
+        length, crc = struct.unpack("<HH", reply[2][:4])
+        data = bytearray()
+        seq = 0
+        while len(data) < length:
+            reply = self._bulk_request(size, BULK_READ, seq, b"", (BULK_DATA,))
+            if reply[0] != BULK_DATA:
+                raise OSError("Blob '{}' is gone".format(name))
+            data += reply[2][: min(chunk, length - len(data))]
+            seq += 1
+        if crc16(data) != crc:
+            raise OSError("Blob '{}' arrived broken".format(name))
+        return bytes(data)
+
+    def _bulk_write(self, size, op, seq, data=b""):
+        # Write a bulk transfer message of the current transfer.
+        payl = struct.pack("<BBH", op, self._bulk_id, seq) + data
+        payl += b"\x00" * (size - len(payl))
+        self.pup_device.write(self.modes[BULK], self._int8_to_uint8(tuple(payl)))
+
+    def _bulk_reply(self):
+        # Read the sensor's reply in the current transfer as (op, chunk number,
+        # data), or None if it has not replied yet.
+        mode = self.modes[BULK]
+        data = self._result_from_sensor(mode, self.pup_device.read(mode))
+        if data[1] != self._bulk_id:
+            return None
+        op, tid, seq = struct.unpack("<BBH", data[:4])
+        return op, seq, data[4:]
+
+    def _bulk_request(self, size, op, seq, data, replies):
+        # Write a message and wait for one of the expected replies to it, or
+        # an error. Writes again if the message or the reply got lost.
+        for i in range(BULK_RETRIES):
+            self._bulk_write(size, op, seq, data)
+            for j in range(BULK_READS):
+                reply = self._bulk_reply()
+                if reply and (
+                    reply[0] == BULK_ERROR or reply[0] in replies and reply[1] == seq
+                ):
+                    return reply
+                wait(2)
+        raise OSError("No answer to bulk transfer from " + str(self.port))
@@ -0,0 +1,125 @@
+# Clock sync add-on for pupremote_hub.py on Pybricks hubs
+#
+# Measures the offset and drift of the sensor clock, to convert sensor times
+# and to tell how old the values of timestamped channels are. Mix it into the
+# hub class:
+#
+#     from pupremote_hub import PUPRemoteHub
+#     from pupremote_hub_clock import ClockMixin
+#
+#     class Hub(ClockMixin, PUPRemoteHub):
+#         pass
+
+__author__ = "Anton Vanhoucke & Ste7an"
+__copyright__ = "Copyright 2023,2024 AntonsMindstorms.com"
+__license__ = "GPL"
+__version__ = "2.1"
+__status__ = "Production"
+
+from pybricks.tools import wait
+from micropython import const
+from pupremote_hub import CLOCK
+
+CLOCK_ROUNDS = const(8)  # Round trips per clock sync, of which the fastest counts
+CLOCK_SPAN = const(1000)  # ms between clock syncs before the drift counts
+CLOCK_READS = const(50)  # Reads of 1ms before a round trip counts as lost
+TICKS_PERIOD = const(1 << 30)  # The sensor's ticks_ms() and ticks_us() wrap at this
+
+
+def _ticks_since(ticks, base):
+    # Signed difference of two sensor ticks, like utime.ticks_diff().
+    return (ticks - base + TICKS_PERIOD // 2) % TICKS_PERIOD - TICKS_PERIOD // 2
+
+
+class ClockMixin:
+    """Clock sync for a PUPRemoteHub, with a sensor that has `add_clock()`."""
+
+    _clock_round = 0
+    # Hub time, offset, drift and sensor time in us of the last clock sync, and
+    # the hub time and offset of the first one.
+    clock = None
+    _first_sync = None
+
+    def sync_clock(self, rounds=CLOCK_ROUNDS):
+        """Measure the offset and drift of the sensor clock from the hub clock.
+
+        Takes the fastest of several round trips, and assumes the sensor read
+        its clock halfway. Call it after connecting, and now and then to follow
+        the drift. Needs `add_clock()`.
+
+        Args:
+            rounds: The number of round trips. Defaults to 8.
+
+        Returns:
+            The sensor time minus the hub time, in ms.
+        """
+        mode = self.modes[CLOCK]
+        best = None
+        for i in range(rounds):
+            self._clock_round = self._clock_round % 255 + 1
+            sent = self._watch.time()
+            self.pup_device.write(
+                mode, self._values_to_sensor(mode, (self._clock_round,))
+            )
+            for j in range(CLOCK_READS):
+                number, sensor_time, sensor_us = self._result_from_sensor(
+                    mode, self.pup_device.read(mode)
+                )
+                if number == self._clock_round:
+                    break
+                wait(1)
+            else:
+                continue
+            now = self._watch.time()
+            if best is None or now - sent < best[0]:
+                best = (now - sent, (sent + now) / 2, sensor_time, sensor_us)
+        if best is None:
+            raise OSError("No clock from sensor on " + str(self.port))
+        rtt, hub_time, sensor_time, sensor_us = best
+        offset = sensor_time - hub_time
+        drift = self.clock[2] if self.clock else 0
+        if self._first_sync is None:
+            self._first_sync = (hub_time, offset)
+        elif hub_time - self._first_sync[0] >= CLOCK_SPAN:
+            drift = (offset - self._first_sync[1]) / (hub_time - self._first_sync[0])
+        self.clock = (hub_time, offset, drift, sensor_us)
+        return offset
+
+    def hub_time(self, sensor_time, us=False):
+        """Convert a time of the sensor clock to the hub clock.
+
+        The sensor clock wraps, so this works for times up to days from the last
+        `sync_clock()` in ms, and up to 8 minutes in us. Needs `sync_clock()`.
+
+        Args:
+            sensor_time: The sensor time in ms.
+            us: Set to True for a sensor time in us, like the times of samples
+                from `drain()`. Defaults to False.
+
+        Returns:
+            The hub time in ms, like `StopWatch().time()`.
+        """
+        sync, offset, drift, sensor_us = self.clock
+        # Sensor ms since the sync
+        if us:
+            elapsed = _ticks_since(sensor_time, sensor_us) / 1000
+        else:
+            elapsed = _ticks_since(sensor_time, sync + offset)
+        return round(sync + elapsed / (1 + drift))
+
+    def age(self, mode_name: str):
+        """Return how old the last value read from a timestamped channel is.
+
+        Args:
+            mode_name: The name of a channel with a '@' format.
+
+        Returns:
+            The time in ms since the sensor updated the value, or None before
+            `sync_clock()` or the first read.
+        """
+        if self.clock is None or mode_name not in self._stamps:
+            return None
+        read, stamp = self._stamps[mode_name]
+        # Not later than the read, which the value can seem by the error of
+        # the clock sync.
+        return self._watch.time() - min(read, self.hub_time(stamp))
@@ -0,0 +1,295 @@
+# Formats add-on for pupremote_hub.py on Pybricks hubs
+#
+# Decodes and encodes quantized values like '2h*0.01', half floats like '4e',
+# bit fields like '2h|12?2u3' and delta channels like '10h~20'. Mix it into
+# the hub class:
+#
+#     from pupremote_hub import PUPRemoteHub
+#     from pupremote_hub_formats import FormatMixin
+#
+#     class Hub(FormatMixin, PUPRemoteHub):
+#         pass
+
+__author__ = "Anton Vanhoucke & Ste7an"
+__copyright__ = "Copyright 2023,2024 AntonsMindstorms.com"
+__license__ = "GPL"
+__version__ = "2.1"
+__status__ = "Production"
+
+import ustruct as struct
+from pybricks.tools import wait, run_task
+from micropython import const
+from pupremote_hub import DELTA, TO_HUB_FORMAT
+
+DELTA_READS = const(20)  # Reads of 5ms for the first values of a delta channel
+
+
+def float_to_half(value):
+    # Return the bits of a half precision float. MicroPython's struct has no 'e'.
+    bits = struct.unpack("<I", struct.pack("<f", value))[0]
+    sign = (bits >> 16) & 0x8000
+    exp = ((bits >> 23) & 0xFF) - 112  # Rebias from 127 to 15
+    mant = bits & 0x7FFFFF
+    if exp >= 31:
+        # Too large, infinite or not a number
+        nan = (bits >> 23) & 0xFF == 0xFF and mant
+        return sign | 0x7C00 | (0x200 if nan else 0)
+    if exp <= 0:
+        # Subnormal, or too small
+        if exp < -10:
+            return sign
+        mant |= 0x800000
+        shift = 14 - exp
+        return sign | ((mant >> shift) + ((mant >> (shift - 1)) & 1))
+    # Round to nearest. A carry into the exponent is still correct.
+    return (sign | (exp << 10) | (mant >> 13)) + ((mant >> 12) & 1)
+
+
+def half_to_float(bits):
+    # Return the value of a half precision float.
+    sign = -1.0 if bits & 0x8000 else 1.0
+    exp = (bits >> 10) & 0x1F
+    mant = bits & 0x3FF
+    if exp == 0:
+        return sign * mant * 2.0**-24
+    if exp == 31:
+        return float("nan") if mant else sign * float("inf")
+    return sign * (1024 + mant) * 2.0 ** (exp - 25)
+
+
+class FormatMixin:
+    """Quantized, half float, bit field and delta formats for a PUPRemoteHub.
+
+    Use it with a sensor that has commands or channels with these formats. See
+    `add_command()` for their syntax.
+    """
+
+    def _add_format(self, fmt):
+        # Return the struct format for a format, and remember how to convert
+        # the values of a quantized format. Like '2h*0.01' for values in steps
+        # of 0.01, '2h*0.1+-20' to also subtract 20, or '4e' for half floats.
+        # Bit fields follow a '|', like '2h|12?2u3' for 12 booleans and two 3
+        # bit numbers after the struct values.
+        if fmt in self.quantized:
+            return self.quantized[fmt][0]
+        if fmt in self.bitfields:
+            return self.bitfields[fmt][0]
+        if fmt in self.deltas:
+            return self.deltas[fmt][0]
+        if fmt[-1:] == "@":
+            # Timestamps are in the core, around any of these formats.
+            return super()._add_format(fmt)
+        if "~" in fmt:
+            values, key_frames = fmt.split("~")
+            order = values[0] if values[0] in "<>=!@" else ""
+            code = values[-1]
+            assert (
+                values[len(order) : -1].isdigit() and code in "bBhHiIlLf"
+            ), "Deltas need a number of values of one type, like '10h~20'"
+            assert (
+                key_frames.isdigit() and int(key_frames) >= 1
+            ), "Deltas need a positive number of updates between key frames"
+            n = int(values[len(order) : -1])
+            num_bitmap = (n + 7) // 8
+            # The bitmap of the values in the frame, a sequence number, values
+            # The hub writes to the mode to ask for a key frame.
+            size = min(num_bitmap + 1 + struct.calcsize(values), self.write_size)
+            assert (
+                size >= num_bitmap + 1 + struct.calcsize(order + code)
+            ), "Payload exceeds maximum packet size"
+            self.deltas[fmt] = (
+                "%ds" % size,
+                order,
+                code,
+                n,
+                num_bitmap,
+                int(key_frames),
+            )
+            return self.deltas[fmt][0]
+        if "|" in fmt:
+            head, spec = fmt.split("|")
+            fields = []
+            shift = 0
+            i = 0
+            while i < len(spec):
+                j = i
+                while j < len(spec) and spec[j].isdigit():
+                    j += 1
+                count = int(spec[i:j]) if j > i else 1
+                kind = spec[j : j + 1]
+                assert kind in ("?", "u"), "Unknown bit field in '{}'".format(fmt)
+                i = j + 1
+                if kind == "?":
+                    width, kind = 1, bool
+                else:
+                    while i < len(spec) and spec[i].isdigit():
+                        i += 1
+                    width, kind = int(spec[j + 1 : i]), int
+                for k in range(count):
+                    fields.append((shift, (1 << width) - 1, kind))
+                    shift += width
+            num_bytes = (shift + 7) // 8
+            struct_fmt = self._add_format(head) + "%ds" % num_bytes
+            self.bitfields[fmt] = (
+                struct_fmt,
+                head,
+                self._num_values(head),
+                fields,
+                num_bytes,
+            )
+            return struct_fmt
+        if "*" in fmt:
+            struct_fmt, scale = fmt.split("*")
+            offset = 0
+            if "+" in scale:
+                scale, offset = scale.split("+")
+            self.quantized[fmt] = (struct_fmt, float(scale), float(offset))
+            return struct_fmt
+        if "e" in fmt:
+            assert set(
+                [c for c in fmt if not c.isdigit() and c not in "<=e"]
+            ) == set(), "Half floats can't be mixed with other types"
+            self.quantized[fmt] = (fmt.replace("e", "H"), None, 0)
+            return self.quantized[fmt][0]
+        return super()._add_format(fmt)
+
+    def _num_values(self, fmt):
+        # Return the number of values in a format.
+        self._add_format(fmt)
+        if fmt in self.bitfields:
+            return self.bitfields[fmt][2] + len(self.bitfields[fmt][3])
+        if fmt in self.deltas:
+            return self.deltas[fmt][3]
+        return super()._num_values(fmt)
+
+    def decode(self, fmt: str, data: bytes):
+        if fmt in self.bitfields:
+            struct_fmt, head, num_head, fields, num_bytes = self.bitfields[fmt]
+            size = struct.calcsize(struct_fmt) - num_bytes
+            values = self.decode(head, data[:size]) if head else ()
+            # Unpack all bit fields from a single integer.
+            bits = int.from_bytes(bytes(data[size : size + num_bytes]), "little")
+            return values + tuple(
+                [kind(bits >> shift & mask) for shift, mask, kind in fields]
+            )
+        if fmt in self.quantized:
+            struct_fmt, scale, offset = self.quantized[fmt]
+            data = struct.unpack(struct_fmt, data[: struct.calcsize(struct_fmt)])
+            if scale is None:
+                return tuple([half_to_float(v) for v in data])
+            return tuple([v * scale + offset for v in data])
+        return super().decode(fmt, data)
+
+    def encode(self, size, format, *argv):
+        if format in self.bitfields:
+            struct_fmt, head, num_head, fields, num_bytes = self.bitfields[format]
+            s = self.encode(size, head, *argv[:num_head]) if head else b""
+            # Pack all bit fields into a single integer.
+            bits = sum(
+                [
+                    (int(value) & mask) << shift
+                    for (shift, mask, kind), value in zip(fields, argv[num_head:])
+                ]
+            )
+            s += bits.to_bytes(num_bytes, "little")
+        elif format in self.quantized:
+            struct_fmt, scale, offset = self.quantized[format]
+            if scale is None:
+                argv = [float_to_half(v) for v in argv]
+            else:
+                argv = [round((v - offset) / scale) for v in argv]
+            s = struct.pack(struct_fmt, *argv)
+        else:
+            return super().encode(size, format, *argv)
+        assert len(s) <= size, "Payload exceeds maximum packet size"
+        return s
+
+    def _apply_delta(self, fmt, data, values):
+        # Return the values with the changes from a delta frame applied. The
+        # bitmap at the start of the frame says which values it contains.
+        struct_fmt, order, code, n, num_bitmap, key_frames = self.deltas[fmt]
+        bitmap = int.from_bytes(bytes(data[:num_bitmap]), "little")
+        indexes = [i for i in range(n) if bitmap >> i & 1]
+        changes_fmt = order + "%d" % len(indexes) + code
+        start = num_bitmap + 1  # After the sequence number
+        changes = struct.unpack(
+            changes_fmt, bytes(data[start : start + struct.calcsize(changes_fmt)])
+        )
+        values = list(values)
+        for i, value in zip(indexes, changes):
+            values[i] = value
+        return values
+
+    def _result_from_sensor(self, mode, data):
+        command = self.commands[mode]
+        if command[TO_HUB_FORMAT] in self.deltas:
+            return self._delta_result(
+                command, bytes([b if b >= 0 else b + 256 for b in data])
+            )
+        return super()._result_from_sensor(mode, data)
+
+    def _delta_result(self, command, data):
+        # Apply a delta frame to the values the hub keeps. After a missed
+        # frame, values are stale until a key frame brings them again.
+        fmt = command[TO_HUB_FORMAT]
+        n, num_bitmap = self.deltas[fmt][3], self.deltas[fmt][4]
+        if DELTA not in command:
+            # Values, sequence number of the last frame, bitmap of the values
+            # that arrived at least once, and whether the last frame came
+            # after a missed one
+            command[DELTA] = [[0] * n, None, 0, False]
+        state = command[DELTA]
+        seq = data[num_bitmap]
+        state[3] = False
+        if seq != state[1]:
+            state[3] = state[1] is None or seq != (state[1] + 1) & 0xFF
+            state[0] = self._apply_delta(fmt, data, state[0])
+            state[1] = seq
+            state[2] |= int.from_bytes(bytes(data[:num_bitmap]), "little")
+        return tuple(state[0])
+
+    def _all_deltas(self, mode):
+        # Return whether all values of a delta channel arrived at least once.
+        command = self.commands[mode]
+        return command[DELTA][2] == (1 << self.deltas[command[TO_HUB_FORMAT]][3]) - 1
+
+    def _is_delta(self, mode_name):
+        # Return whether a mode is a delta channel.
+        return (
+            mode_name in self.modes
+            and self.commands[self.modes[mode_name]][TO_HUB_FORMAT] in self.deltas
+        )
+
+    def call(self, mode_name: str, *argv, wait_ms=0):
+        # Only wait for the first values of a delta channel. After that, return
+        # the values the hub has, and let a key frame bring the ones it missed.
+        if not self._is_delta(mode_name):
+            return super().call(mode_name, *argv, wait_ms=wait_ms)
+        assert (
+            not run_task()
+        ), "Use 'call_multitask' instead of 'call', with multiple start blocks or multitask blocks"
+        mode = self.modes[mode_name]
+        for i in range(DELTA_READS):
+            result = self._result_from_sensor(mode, self.pup_device.read(mode))
+            if self.commands[mode][DELTA][3]:
+                # Missed a frame. Any write asks the sensor for a key frame.
+                self.pup_device.write(mode, [0] * self._write_size(mode))
+            if self._all_deltas(mode):
+                break
+            wait(5)
+        return result
+
+    async def _execute_call(self, mode_name: str, *argv, wait_ms=0):
+        if not self._is_delta(mode_name):
+            return await super()._execute_call(mode_name, *argv, wait_ms=wait_ms)
+        mode = self.modes[mode_name]
+        for i in range(DELTA_READS):
+            data = await self.pup_device.read(mode)
+            result = self._result_from_sensor(mode, data)
+            if self.commands[mode][DELTA][3]:
+                # Missed a frame. Any write asks the sensor for a key frame.
+                await self.pup_device.write(mode, [0] * self._write_size(mode))
+            if self._all_deltas(mode):
+                break
+            await wait(5)
+        return result
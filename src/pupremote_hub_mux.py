@@ -0,0 +1,114 @@
+# Multiplexed commands add-on for pupremote_hub.py on Pybricks hubs
+#
+# Calls the commands that share a single mode, added with `mux=True`, and
+# waits while the sensor says it is busy with a call. Mix it into the hub
+# class:
+#
+#     from pupremote_hub import PUPRemoteHub
+#     from pupremote_hub_mux import MuxMixin
+#
+#     class Hub(MuxMixin, PUPRemoteHub):
+#         pass
+
+__author__ = "Anton Vanhoucke & Ste7an"
+__copyright__ = "Copyright 2023,2024 AntonsMindstorms.com"
+__license__ = "GPL"
+__version__ = "2.1"
+__status__ = "Production"
+
+from pybricks.tools import wait, run_task
+from micropython import const
+from pupremote_hub import FROM_HUB_FORMAT, MUX, SIZE, TO_HUB_FORMAT
+
+MUX_RETRIES = const(100)  # Reads of 5ms before a multiplexed call times out
+MUX_BUSY_READS = const(2000)  # Reads of 5ms before a busy multiplexed call times out
+MUX_BUSY = const(255)  # Command id with which the sensor says a call is busy
+
+
+class MuxMixin:
+    """Multiplexed commands for a PUPRemoteHub.
+
+    Use it with a sensor that has commands or channels with `mux=True`.
+    """
+
+    _mux_seq = 0
+
+    def _mux_values(self, mode_name, argv):
+        # Encode a multiplexed call as the values to write to the shared mode.
+        command = self.mux_commands[self.mux[mode_name]]
+        self._mux_seq = self._mux_seq % 255 + 1
+        payl = bytes([self.mux[mode_name], self._mux_seq])
+        size = self._write_size(self.modes[MUX])
+        if FROM_HUB_FORMAT in command:
+            self._check_args(command, argv)
+            payl += self.encode(
+                min(command[SIZE], size - 2), command[FROM_HUB_FORMAT], *argv
+            )
+        return self._int8_to_uint8(tuple(payl + b"\x00" * (size - len(payl))))
+
+    def _mux_result(self, mode_name, data):
+        # Decode the shared mode data. Returns None if the sensor did not
+        # answer the last call yet, or False if it is still busy with it.
+        if data[1] & 0xFF != self._mux_seq:
+            return None
+        if data[0] & 0xFF == MUX_BUSY:
+            return False
+        if data[0] & 0xFF != self.mux[mode_name]:
+            return None
+        command = self.mux_commands[self.mux[mode_name]]
+        fmt = command[TO_HUB_FORMAT]
+        result = self.decode(fmt, bytes([b & 0xFF for b in data[2:]]))
+        if fmt in self.stamped:
+            result = self._unstamp(command, result)
+        return result
+
+    def call(self, mode_name: str, *argv, wait_ms=0):
+        # Call a multiplexed command through the shared mode.
+        if mode_name not in self.mux:
+            return super().call(mode_name, *argv, wait_ms=wait_ms)
+        assert (
+            not run_task()
+        ), "Use 'call_multitask' instead of 'call', with multiple start blocks or multitask blocks"
+        mode = self.modes[MUX]
+        self.pup_device.write(mode, self._mux_values(mode_name, argv))
+        wait(wait_ms)
+        retries = MUX_RETRIES
+        reads = MUX_BUSY_READS
+        while retries and reads:
+            result = self._mux_result(mode_name, self.pup_device.read(mode))
+            if result is False:
+                # Keep waiting as long as the sensor is busy.
+                retries = MUX_RETRIES
+            elif result is not None:
+                # Convert tuple size 1 to single value
+                return result[0] if len(result) == 1 else result
+            retries -= 1
+            reads -= 1
+            wait(5)
+        if not reads:
+            raise OSError("Sensor still busy with '{}'".format(mode_name))
+        raise OSError("No answer to '{}' from sensor".format(mode_name))
+
+    async def _execute_call(self, mode_name: str, *argv, wait_ms=0):
+        if mode_name not in self.mux:
+            return await super()._execute_call(mode_name, *argv, wait_ms=wait_ms)
+        mode = self.modes[MUX]
+        await self.pup_device.write(mode, self._mux_values(mode_name, argv))
+        await wait(wait_ms)
+        retries = MUX_RETRIES
+        reads = MUX_BUSY_READS
+        while retries and reads:
+            data = await self.pup_device.read(mode)
+            result = self._mux_result(mode_name, data)
+            if result is False:
+                # Keep waiting as long as the sensor is busy.
+                retries = MUX_RETRIES
+            elif result is not None:
+                # Convert tuple size 1 to single value
+                return result[0] if len(result) == 1 else result
+            retries -= 1
+            reads -= 1
+            await wait(5)
+        if not reads:
+            raise OSError("Sensor still busy with '{}'".format(mode_name))
+        raise OSError("No answer to '{}' from sensor".format(mode_name))
@@ -0,0 +1,39 @@
+# Frame size probe add-on for pupremote_hub.py on Pybricks hubs
+#
+# Checks if the hub can write the large frames of a sensor created with
+# negotiate=True, so the sensor can use them for the modes the hub writes.
+# Without it, the hub only writes 16 byte frames. Mix it into the hub class:
+#
+#     from pupremote_hub import PUPRemoteHub
+#     from pupremote_hub_probe import ProbeMixin
+#
+#     class Hub(ProbeMixin, PUPRemoteHub):
+#         pass
+
+__author__ = "Anton Vanhoucke & Ste7an"
+__copyright__ = "Copyright 2023,2024 AntonsMindstorms.com"
+__license__ = "GPL"
+__version__ = "2.1"
+__status__ = "Production"
+
+from pybricks.tools import wait
+from micropython import const
+
+PROBE_READS = const(20)  # Reads of 5ms before a probed frame size counts as failed
+
+
+class ProbeMixin:
+    """Frame size probe for a PUPRemoteHub, with a sensor that has negotiate=True."""
+
+    def _probe(self):
+        # Write a test pattern in a full frame, and see if the sensor got it.
+        # Pybricks writes all values of a mode, and frames that are too large
+        # for the hub arrive broken, so the sensor drops them.
+        super()._probe()
+        size = self._sensor_modes[0][1]
+        self.pup_device.write(0, list(range(1, size + 1)))
+        for i in range(PROBE_READS):
+            wait(5)
+            if self._result_from_sensor(0, self.pup_device.read(0)) == size:
+                self.frame_size = size
+                break
@@ -0,0 +1,68 @@
+# Schema add-on for pupremote_hub.py on Pybricks hubs
+#
+# Registers all commands from the command table of a sensor created with
+# schema=True, so the hub needs no add_command() calls. Mix it into the hub
+# class:
+#
+#     from pupremote_hub import PUPRemoteHub
+#     from pupremote_hub_schema import SchemaMixin
+#
+#     class Hub(SchemaMixin, PUPRemoteHub):
+#         pass
+
+__author__ = "Anton Vanhoucke & Ste7an"
+__copyright__ = "Copyright 2023,2024 AntonsMindstorms.com"
+__license__ = "GPL"
+__version__ = "2.1"
+__status__ = "Production"
+
+from pybricks.tools import wait
+from micropython import const
+from pupremote_hub import BULK, CLOCK, SCHEMA
+
+SCHEMA_READS = const(200)  # Reads of 5ms before a page of the table counts as lost
+
+
+class SchemaMixin:
+    """Automatic registration for a PUPRemoteHub, with a sensor that has schema=True."""
+
+    def _read_schema(self):
+        # Register all commands from the command table the sensor publishes.
+        super()._read_schema()
+        mode = self.modes[SCHEMA]
+        n = self._sensor_modes[mode][1] - 1  # Schema bytes per page
+        schema = b""
+        page = 1
+        while True:
+            self.pup_device.write(mode, self._values_to_sensor(mode, (page,)))
+            for i in range(SCHEMA_READS):
+                wait(5)
+                number, chunk = self._result_from_sensor(
+                    mode, self.pup_device.read(mode)
+                )
+                if number == page:
+                    break
+            else:
+                raise OSError("No command table from sensor on " + str(self.port))
+            chunk = chunk.rstrip(b"\x00")
+            schema += chunk
+            if len(chunk) < n:
+                break
+            page += 1
+        for entry in schema.decode().split(";") if schema else []:
+            mux = entry[0] == "*"
+            fields = entry.lstrip("*@%&").split(",")
+            if entry == BULK:
+                self.add_bulk()
+            elif entry == CLOCK:
+                self.add_clock()
+            elif entry[0] == "%":
+                self.add_stream(*fields)
+            elif entry[0] == "&":
+                self.add_buffered_channel(*fields)
+            elif entry[0] == "@":
+                self.add_snapshot(fields[0], fields[1].split("+"))
+            elif len(fields) == 2:
+                self.add_channel(*fields, mux=mux)
+            else:
+                self.add_command(*fields, mux=mux)
@@ -0,0 +1,63 @@
+# Snapshot add-on for pupremote_hub.py on Pybricks hubs
+#
+# Reads all channels of a snapshot mode, added with `add_snapshot()`, at once
+# with `read_snapshot()`. Mix it into the hub class:
+#
+#     from pupremote_hub import PUPRemoteHub
+#     from pupremote_hub_snapshot import SnapshotMixin
+#
+#     class Hub(SnapshotMixin, PUPRemoteHub):
+#         pass
+
+__author__ = "Anton Vanhoucke & Ste7an"
+__copyright__ = "Copyright 2023,2024 AntonsMindstorms.com"
+__license__ = "GPL"
+__version__ = "2.1"
+__status__ = "Production"
+
+import ustruct as struct
+from pupremote_hub import MEMBERS, TO_HUB_FORMAT
+
+
+class SnapshotMixin:
+    """Snapshot reads for a PUPRemoteHub, with a sensor that has `add_snapshot()`."""
+
+    def read_snapshot(self, mode_name: str, as_tuple=False):
+        """Read all channels of a snapshot mode at once.
+
+        Use `call_multitask(mode_name)` for the same result in multitask programs.
+
+        Args:
+            mode_name: The name of the snapshot you defined with `add_snapshot()`.
+            as_tuple: Set to True to get the values in the order of the channels
+                in the snapshot, instead of a dictionary. Defaults to False.
+
+        Returns:
+            A dictionary with the latest values of each channel in the snapshot,
+            or a tuple of them.
+        """
+        snapshot = self.call(mode_name)
+        if as_tuple:
+            members = self.commands[self.modes[mode_name]][MEMBERS]
+            return tuple([snapshot[name] for name in members])
+        return snapshot
+
+    def _result_from_sensor(self, mode, data):
+        command = self.commands[mode]
+        if MEMBERS in command:
+            return self._decode_snapshot(
+                command, bytes([b if b >= 0 else b + 256 for b in data])
+            )
+        return super()._result_from_sensor(mode, data)
+
+    def _decode_snapshot(self, command, data):
+        # Split snapshot data into a dictionary of channel values.
+        snapshot = {}
+        offset = 0
+        for name in command[MEMBERS]:
+            fmt = self._command(name)[TO_HUB_FORMAT]
+            size = struct.calcsize(self._add_format(fmt))
+            values = self.decode(fmt, data[offset : offset + size])
+            snapshot[name] = values[0] if len(values) == 1 else values
+            offset += size
+        return snapshot
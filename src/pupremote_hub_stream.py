@@ -0,0 +1,158 @@
+# Stream add-on for pupremote_hub.py on Pybricks hubs
+#
+# Iterates over generators on the sensor with `stream()`, and drains the
+# samples of buffered channels with `drain()`. Mix it into the hub class:
+#
+#     from pupremote_hub import PUPRemoteHub
+#     from pupremote_hub_stream import StreamMixin
+#
+#     class Hub(StreamMixin, PUPRemoteHub):
+#         pass
+
+__author__ = "Anton Vanhoucke & Ste7an"
+__copyright__ = "Copyright 2023,2024 AntonsMindstorms.com"
+__license__ = "GPL"
+__version__ = "2.1"
+__status__ = "Production"
+
+import ustruct as struct
+from pybricks.tools import wait
+from micropython import const
+from pupremote_hub import NAME, RING, RING_HEADER, RING_MORE, SIZE, STREAM
+
+STREAM_READS = const(50)  # Reads without a reply before the hub writes again
+STREAM_RETRIES = const(5)  # Writes again before a stream request fails
+# Stream requests: op, sequence number, arguments. Replies: sequence number,
+# number of items with the end flag, items.
+STREAM_START = const(1)  # Call the generator
+STREAM_NEXT = const(2)  # Next items
+STREAM_STOP = const(3)  # Close the generator
+STREAM_END = const(0x80)  # No items after these
+
+
+class StreamMixin:
+    """Streams and buffered channels for a PUPRemoteHub.
+
+    Use it with a sensor that has `add_stream()` or `add_buffered_channel()`.
+    """
+
+    _stream_seq = 0
+    # Number of the next sample to drain, by buffered channel
+    _next_sample = None
+    # Samples the sensor dropped before the hub drained them
+    samples_lost = 0
+
+    def stream(self, mode_name: str, *argv):
+        """Call a remote generator and iterate over the items it yields.
+
+        The hub reads a frame of items at a time, and asks for the next frame
+        when the loop has used them. Leaving the loop early, like with `break`,
+        closes the generator on the sensor.
+
+        Args:
+            mode_name: The name of a stream added with `add_stream()`.
+            *argv: The arguments of the generator.
+
+        Yields:
+            The items, as single values or tuples.
+        """
+        mode = self.modes[mode_name]
+        command = self.commands[mode]
+        item_fmt, args_fmt, item_size = command[STREAM]
+        size = self._write_size(mode)
+        args = self.encode(size - 2, args_fmt, *argv) if args_fmt else b""
+        # The sensor takes a start with the sequence number it answered last
+        # for a resend, so skip that one. It may be from an earlier program.
+        last = self._result_from_sensor(mode, self.pup_device.read(mode))[0]
+        if self._stream_seq % 255 + 1 == last:
+            self._stream_seq = last
+        op = STREAM_START
+        end = False
+        try:
+            while not end:
+                data = self._stream_request(mode, size, op, args)
+                op = STREAM_NEXT
+                args = b""
+                end = data[1] & STREAM_END
+                for i in range(data[1] & ~STREAM_END):
+                    start = 2 + i * item_size
+                    item = self.decode(item_fmt, data[start : start + item_size])
+                    yield item[0] if len(item) == 1 else item
+        finally:
+            if not end:
+                self._stream_seq = self._stream_seq % 255 + 1
+                self._stream_write(mode, size, STREAM_STOP)
+
+    def drain(self, mode_name: str):
+        """Read all samples of a buffered channel since the last drain.
+
+        The hub acknowledges each frame of samples, so the sensor can drop them,
+        and reads until the sensor has no more. Samples the sensor had to drop
+        because its buffer was full are counted in `samples_lost`.
+
+        Args:
+            mode_name: The name of a channel added with `add_buffered_channel()`.
+
+        Returns:
+            A list of (time, value) pairs, with the time in us on the sensor
+            clock, which `hub_time()` converts. The value is a tuple for
+            formats with several values.
+        """
+        mode = self.modes[mode_name]
+        command = self.commands[mode]
+        fmt, sample_size, per_frame = command[RING]
+        fmt = "<" + fmt.lstrip("<=")
+        header_size = struct.calcsize(RING_HEADER)
+        if self._next_sample is None:
+            self._next_sample = {}
+        samples = []
+        while True:
+            wanted = self._next_sample.get(mode_name)
+            self.pup_device.write(
+                mode, self._values_to_sensor(mode, (wanted is not None, wanted or 0))
+            )
+            for i in range(STREAM_READS):
+                data = self._result_from_sensor(mode, self.pup_device.read(mode))
+                first, count, t = struct.unpack(RING_HEADER, data[:header_size])
+                skipped = (first - wanted) & 0xFFFF if wanted is not None else 0
+                if skipped < 0x8000:
+                    # Not a frame from before the acknowledgement
+                    break
+                wait(2)
+            else:
+                raise OSError("No samples from '{}' on {}".format(mode_name, self.port))
+            self.samples_lost += skipped
+            more = count & RING_MORE
+            count &= ~RING_MORE
+            offset = header_size
+            for i in range(count):
+                values = struct.unpack_from("<H" + fmt[1:], data, offset)
+                t += values[0] if i else 0
+                samples.append((t, values[1] if len(values) == 2 else values[1:]))
+                offset += sample_size
+            self._next_sample[mode_name] = (first + count) & 0xFFFF
+            if count < per_frame and not more:
+                return samples
+
+    def _stream_write(self, mode, size, op, args=b""):
+        # Write a stream request with the current sequence number.
+        payl = bytes([op, self._stream_seq]) + args
+        payl += b"\x00" * (size - len(payl))
+        self.pup_device.write(mode, self._int8_to_uint8(tuple(payl)))
+
+    def _stream_request(self, mode, size, op, args):
+        # Write a stream request and read until the reply to it arrives. Writes
+        # the request again if it or the reply got lost.
+        self._stream_seq = self._stream_seq % 255 + 1
+        for i in range(STREAM_RETRIES):
+            self._stream_write(mode, size, op, args)
+            for j in range(STREAM_READS):
+                data = self._result_from_sensor(mode, self.pup_device.read(mode))
+                if data[0] == self._stream_seq:
+                    return data
+                wait(2)
+        raise OSError(
+            "No answer from stream '{}' on {}".format(
+                self.commands[mode][NAME], self.port
+            )
+        )
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# Measure the sustained bytes/sec of bulk blob transfers in both directions,
+# with several window sizes. Runs pupremote.py on CPython against the hub
+# emulator. Time is the UART time of all bytes on the wire, plus the time the
+# hub waits for replies.
+from hub_emulator import FakePUPDevice, HubEmulator, load_pupremote
+
+BAUD = 115200
+BLOB = bytes(range(256)) * 16  # 4 kB
+
+
+def run(window, frame):
+    pupremote = load_pupremote()
+    sensor = pupremote.PUPRemoteSensor(max_packet_size=frame)
+    sensor.add_bulk()
+    hub = HubEmulator(sensor.lpup, sensor.process)
+    device = FakePUPDevice(hub)
+    pupremote.PUPDevice = lambda port: device
+    pupremote.run_task = lambda: False
+    waited = [0]
+    pupremote.wait = lambda ms: waited.__setitem__(0, waited[0] + ms)
+    sent = [0]
+    send = hub._send
+
+    def counting_send(msg, broken=False):
+        sent[0] += len(msg) + 1
+        send(msg, broken)
+
+    hub._send = counting_send
+    remote = pupremote.PUPRemoteHub("A", frame)
+    remote.add_bulk()
+
+    def seconds(transfer):
+        start = (hub.bytes_received + sent[0], waited[0])
+        transfer()
+        wire = hub.bytes_received + sent[0] - start[0]
+        return wire * 10 / BAUD + (waited[0] - start[1]) / 1000
+
+    t_send = seconds(lambda: remote.send_blob("blob", BLOB, window))
+    assert sensor.get_blob("blob") == BLOB
+    sensor.put_blob("blob", BLOB)
+    result = []
+    t_read = seconds(lambda: result.append(remote.read_blob("blob")))
+    assert result[0] == BLOB
+    print(
+        "frames {:2d} window {:d}: send {:6.0f} bytes/s, read {:6.0f} bytes/s".format(
+            remote.frame_size, window, len(BLOB) / t_send, len(BLOB) / t_read
+        )
+    )
+
+
+for frame in (16, 32):
+    for window in (1, 4, 8):
+        run(window, frame)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# Compare UART use and loop rate of a tight update_channel() loop, like the
+# two-rangefinder wall follower, with and without coalescing. Runs lpf2.py on
+# CPython against the hub emulator. UART writes take as long as they would
+# at 115200 baud, with a 128 byte transmit FIFO, like on the ESP32.
+import time
+
+from hub_emulator import FakeUART, HubEmulator, load_pupremote
+
+BAUD = 115200
+FIFO = 128
+DURATION = 2.0  # Seconds
+NACK_MS = 10  # Hub heartbeat interval
+
+
+class TimedUART(FakeUART):
+    def __init__(self):
+        super().__init__()
+        self.free_at = time.monotonic()
+
+    def write(self, data):
+        now = time.monotonic()
+        busy = max(0, self.free_at - now)
+        duration = len(data) * 10 / BAUD
+        if busy + duration > FIFO * 10 / BAUD:
+            # FIFO full: block until the data fits.
+            time.sleep(busy + duration - FIFO * 10 / BAUD)
+        self.free_at = max(now, self.free_at) + duration
+        return super().write(data)
+
+
+def run(coalesce_ms):
+    pupremote = load_pupremote()
+    sensor = pupremote.PUPRemoteSensor(coalesce_ms=coalesce_ms)
+    sensor.add_channel("walls", "2h")
+    hub = HubEmulator(sensor.lpup, sensor.process)
+    hub.uart = sensor.lpup.uart = TimedUART()
+    tx_bytes = sensor.lpup.tx_bytes
+    loops = 0
+    start = next_nack = time.monotonic()
+    while time.monotonic() - start < DURATION:
+        sensor.update_channel("walls", loops % 1000, 1000 - loops % 1000)
+        if time.monotonic() >= next_nack:
+            next_nack += NACK_MS / 1000
+            hub.nack()
+        else:
+            sensor.process()
+            hub.receive()
+        loops += 1
+    tx_bytes = sensor.lpup.tx_bytes - tx_bytes
+    print(
+        "coalesce_ms={:3d}: {:7.0f} loops/s, {:6d} bytes, UART {:3.0f}% busy".format(
+            coalesce_ms,
+            loops / DURATION,
+            tx_bytes,
+            100 * tx_bytes * 10 / BAUD / DURATION,
+        )
+    )
+
+
+for coalesce_ms in (0, 5, 20):
+    run(coalesce_ms)
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+# Compare the bytes and UART time a 'repr' channel with short replies takes,
+# with full size frames and with the smallest frames that fit. Runs
+# pupremote.py on CPython against the hub emulator.
+from hub_emulator import HubEmulator, load_pupremote
+
+BAUD = 115200
+REPLIES = [1, "ok", True, -42, (3, 4), "done", None, [1, 2, 3]]
+NACKS = 10  # Heartbeats the hub sends per reply
+
+
+def run(max_packet_size, fit):
+    pupremote = load_pupremote()
+    sensor = pupremote.PUPRemoteSensor(max_packet_size=max_packet_size)
+    sensor.add_channel("reply", "repr")
+    mode = sensor.modes["reply"]
+    sensor.lpup.modes[mode][10] = fit
+    hub = HubEmulator(sensor.lpup, sensor.process)
+    hub.select(mode)
+    tx_bytes = sensor.lpup.tx_bytes
+    for reply in REPLIES:
+        sensor.update_channel("reply", reply)
+        for i in range(NACKS):
+            hub.nack()
+        assert sensor.decode("repr", hub.data[mode]) == (reply,)
+    tx_bytes = sensor.lpup.tx_bytes - tx_bytes
+    frames = len(REPLIES) * (NACKS + 1)
+    print(
+        "max_packet_size={:2d} fit={!s:5}: {:5d} bytes, {:4.0f}us per frame".format(
+            max_packet_size, fit, tx_bytes, tx_bytes * 10 / BAUD / frames * 1e6
+        )
+    )
+
+
+for max_packet_size in (16, 32):
+    for fit in (False, True):
+        run(max_packet_size, fit)
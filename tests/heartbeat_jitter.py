@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# Measure how well process_async() keeps its heartbeat deadlines while the
+# application does heavy work in another task. Runs pupremote.py on CPython
+# against the hub emulator.
+import asyncio
+import time
+
+from hub_emulator import HubEmulator, load_pupremote
+
+DURATION = 2.0  # Seconds
+INTERVAL_MS = 20
+
+
+async def hub_task(hub):
+    # A hub sends a NACK every 100ms.
+    while True:
+        hub.uart.rx.append(0x02)
+        await asyncio.sleep(0.1)
+        hub.receive()
+
+
+async def app_task(work_ms):
+    # Heavy application code that blocks in chunks of work_ms.
+    while work_ms:
+        end = time.monotonic() + work_ms / 1000
+        while time.monotonic() < end:
+            pass
+        await asyncio.sleep(0)
+
+
+async def run(work_ms):
+    pupremote = load_pupremote()
+    sensor = pupremote.PUPRemoteSensor()
+    sensor.add_channel("dist", "h")
+    hub = HubEmulator(sensor.lpup, lambda: None)
+    tasks = [
+        asyncio.create_task(sensor.process_async(INTERVAL_MS)),
+        asyncio.create_task(hub_task(hub)),
+        asyncio.create_task(app_task(work_ms)),
+    ]
+    await asyncio.sleep(DURATION)
+    for task in tasks:
+        task.cancel()
+    rounds = sum(sensor.lateness_hist)
+    print(
+        "work {:2d}ms: {:5.1f} heartbeats/s, max late {:5.1f}ms, missed {:2d}, "
+        "late <1/<2/<4/<8/<16/<32/<64/more ms: {}".format(
+            work_ms,
+            rounds / DURATION,
+            sensor.max_lateness_us / 1000,
+            sensor.missed_beats,
+            sensor.lateness_hist,
+        )
+    )
+
+
+for work_ms in (0, 5, 15, 30):
+    asyncio.run(run(work_ms))
@@ -0,0 +1,30 @@
+#!/bin/micropython
+# Compare decoding a 'repr' payload with eval() and with literal().
+# Run from the tests directory on the MicroPython unix port.
+import sys
+from time import ticks_ms, ticks_diff
+
+sys.path.append("../src")
+from pupremote_hub import literal
+
+PAYLOADS = [
+    "123",
+    "-4.5",
+    "'hello'",
+    "[12, -3, 4.5]",
+    "(True, None, 'abc')",
+    "{'x': 120, 'y': 80, 'w': [1, 2]}",
+]
+N = 2000
+
+for text in PAYLOADS:
+    assert literal(text) == eval(text)
+    start = ticks_ms()
+    for i in range(N):
+        eval(text)
+    t_eval = ticks_diff(ticks_ms(), start)
+    start = ticks_ms()
+    for i in range(N):
+        literal(text)
+    t_literal = ticks_diff(ticks_ms(), start)
+    print("{:36s} eval {:5d}ms  literal {:5d}ms".format(text, t_eval, t_literal))
@@ -0,0 +1,21 @@
+#!/bin/micropython
+# Compare hub-side decoding of a '4h' command: DATA8 vs native DATA16 mode.
+from time import ticks_ms
+import struct
+
+# What PUPDevice.read() returns for a DATA8 mode: 8 signed bytes.
+data8 = tuple([b if b < 128 else b - 256 for b in struct.pack("4h", 1000, -2, 300, -4000)])
+# What PUPDevice.read() returns for a DATA16 mode: 4 signed values.
+data16 = (1000, -2, 300, -4000)
+
+start = ticks_ms()
+for i in range(100000):
+    raw_data = bytes([b if b >= 0 else b + 256 for b in data8])
+    size = struct.calcsize("4h")
+    result = struct.unpack("4h", raw_data[:size])
+print("DATA8 convert & unpack", ticks_ms() - start)
+
+start = ticks_ms()
+for i in range(100000):
+    result = data16[:4]
+print("DATA16 native", ticks_ms() - start)
@@ -0,0 +1,32 @@
+# Measure hub startup time with 15 commands, with and without the sensor schema.
+# With the schema, its mode takes the 16th mode.
+# Run this file as main.py on the LMS-ESP32 and run it on the Pybricks hub too.
+# Set SCHEMA to the same value on both sides.
+from pupremote import PUPRemoteSensor, PUPRemoteHub, side
+
+SCHEMA = True
+FORMATS = ["b", "2h", "4h", "f", "repr", "B", "3B", "i"] * 2
+
+if side == "Sensor":
+
+    def cmd(*args):
+        return 0
+
+    p = PUPRemoteSensor(schema=SCHEMA)
+    for i, fmt in enumerate(FORMATS[:15]):
+        globals()["cmd%d" % i] = cmd
+        p.add_command("cmd%d" % i, fmt)
+    while True:
+        p.process()
+
+else:
+    from pybricks.parameters import Port
+    from pybricks.tools import StopWatch
+
+    sw = StopWatch()
+    pr = PUPRemoteHub(Port.A)
+    if not SCHEMA:
+        for i, fmt in enumerate(FORMATS[:15]):
+            pr.add_command("cmd%d" % i, fmt)
+    print("Startup with schema={}: {} commands in {} ms".format(
+        SCHEMA, len(pr.commands) - SCHEMA, sw.time()))
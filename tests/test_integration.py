@@ -101,7 +101,18 @@ class TestSourceFileConsistency(unittest.TestCase):
         version_pattern = r'__version__\s*=\s*"2\.1"'
         import re
 
-        files_to_check = ["pupremote.py", "pupremote_hub.py"]
+        files_to_check = [
+            "pupremote.py",
+            "pupremote_hub.py",
+            "pupremote_hub_bulk.py",
+            "pupremote_hub_clock.py",
+            "pupremote_hub_formats.py",
+            "pupremote_hub_mux.py",
+            "pupremote_hub_probe.py",
+            "pupremote_hub_schema.py",
+            "pupremote_hub_snapshot.py",
+            "pupremote_hub_stream.py",
+        ]
 
         for filename in files_to_check:
             file_path = src_dir / filename
@@ -129,7 +140,18 @@ class TestSourceFileConsistency(unittest.TestCase):
         """Test that author is properly attributed."""
         src_dir = Path(__file__).parent.parent / "src"
 
-        files_to_check = ["pupremote.py", "pupremote_hub.py"]
+        files_to_check = [
+            "pupremote.py",
+            "pupremote_hub.py",
+            "pupremote_hub_bulk.py",
+            "pupremote_hub_clock.py",
+            "pupremote_hub_formats.py",
+            "pupremote_hub_mux.py",
+            "pupremote_hub_probe.py",
+            "pupremote_hub_schema.py",
+            "pupremote_hub_snapshot.py",
+            "pupremote_hub_stream.py",
+        ]
 
         for filename in files_to_check:
             file_path = src_dir / filename
@@ -0,0 +1,273 @@
+"""Tests for the LPF2 sensor engine in lpf2.py.
+
+Runs lpf2.py on CPython against the hub emulator in hub_emulator.py.
+"""
+
+import struct
+import unittest
+
+from hub_emulator import HubEmulator, load_lpf2
+
+lpf2 = load_lpf2()
+
+
+def make_sensor(modes, **kwargs):
+    return lpf2.LPF2(modes, max_packet_size=32, **kwargs)
+
+
+class TestHandshake(unittest.TestCase):
+    """Test the mode information the sensor sends to the hub."""
+
+    def test_modes_and_data_types(self):
+        """Test that the hub learns mode names, sizes and data types."""
+        sensor = make_sensor(
+            [
+                lpf2.LPF2.mode("bytes", 3),
+                lpf2.LPF2.mode("shorts", 4, lpf2.DATA16),
+                lpf2.LPF2.mode("floats", 2, lpf2.DATAF),
+            ]
+        )
+        hub = HubEmulator(sensor)
+
+        self.assertEqual(hub.modes[0]["name"], b"bytes")
+        self.assertEqual((hub.modes[1]["values"], hub.modes[1]["data_type"]), (4, 1))
+        self.assertEqual((hub.modes[2]["values"], hub.modes[2]["data_type"]), (2, 3))
+        # A DATAF value takes 4 bytes, so 2 floats fit an 8 byte frame.
+        self.assertEqual(sensor.modes[2][8], 8)
+
+    def test_nack_resends_payload(self):
+        """Test that the sensor answers a heartbeat with the current payload."""
+        sensor = make_sensor([lpf2.LPF2.mode("shorts", 2, lpf2.DATA16)])
+        hub = HubEmulator(sensor)
+        sensor.load_payload(struct.pack("<2h", -5, 1000), 0)
+
+        hub.nack()
+
+        self.assertEqual(hub.values(0), (-5, 1000))
+
+    def test_write_from_hub(self):
+        """Test that data the hub writes is returned by heartbeat()."""
+        sensor = make_sensor(
+            [lpf2.LPF2.mode("a", 1), lpf2.LPF2.mode("b", 4, writable=lpf2.ABSOLUTE)]
+        )
+        hub = HubEmulator(sensor)
+
+        data, mode = hub.write(1, b"\x01\x02\x03\x04")
+
+        self.assertEqual((bytes(data), mode), (b"\x01\x02\x03\x04", 1))
+
+
+class TestModeCombos(unittest.TestCase):
+    """Test streaming several modes at once."""
+
+    def setUp(self):
+        self.sensor = make_sensor(
+            [
+                lpf2.LPF2.mode("dist", 1, lpf2.DATA16),
+                lpf2.LPF2.mode("flags", 2),
+                lpf2.LPF2.mode("angle", 1, lpf2.DATAF),
+            ],
+            combos=[0b011, 0b101],
+        )
+        self.hub = HubEmulator(self.sensor)
+
+    def test_combos_advertised(self):
+        """Test that mode combinations are announced with mode 0."""
+        self.assertEqual(self.hub.combos, [0b011, 0b101])
+
+    def test_combo_updates_without_mode_switches(self):
+        """Test that all modes in a combination update in one stream."""
+        self.hub.set_combo((0, 0), (1, 0), (1, 1))
+        frames = self.hub.frames
+
+        self.sensor.update_payload(struct.pack("<h", 300), 0)
+        self.sensor.update_payload(bytes([5, 250]), 1)
+        self.hub.nack()
+
+        self.assertEqual(self.hub.values(0), (300,))
+        self.assertEqual(self.hub.values(1), (5, -6))
+        self.assertEqual(self.hub.frames - frames, 3)
+        self.assertEqual(self.hub.mode_switches, 0)
+
+    def test_select_ends_combo(self):
+        """Test that selecting a single mode ends the combination."""
+        self.hub.set_combo((0, 0), (2, 0))
+        self.hub.select(2)
+        self.sensor.update_payload(struct.pack("<f", 1.5), 2)
+        self.hub.receive()
+
+        self.assertEqual(self.sensor.combo, [])
+        self.assertEqual(self.hub.values(2), (1.5,))
+
+    def test_combo_within_packet_size(self):
+        """Test that a combination larger than a frame is ignored."""
+        sensor = lpf2.LPF2(
+            [lpf2.LPF2.mode("a", 3, lpf2.DATAF), lpf2.LPF2.mode("b", 2, lpf2.DATAF)],
+            max_packet_size=16,
+            combos=[0b11],
+        )
+        hub = HubEmulator(sensor)
+        hub.set_combo((0, 0), (0, 1), (0, 2), (1, 0), (1, 1))
+        self.assertEqual(sensor.combo, [])
+        # The sensor keeps answering heartbeats.
+        sensor.load_payload(struct.pack("<3f", 1, 2, 3), 0)
+        hub.nack()
+        self.assertEqual(hub.values(0), (1, 2, 3))
+
+    def test_unadvertised_combo_ignored(self):
+        """Test that combinations the sensor didn't advertise are ignored."""
+        self.hub.set_combo((1, 0), (2, 0))
+        self.assertEqual(self.sensor.combo, [])
+        self.hub.set_combo((0, 0), (1, 2))
+        self.assertEqual(self.sensor.combo, [])
+
+
+class TestCoalescing(unittest.TestCase):
+    """Test rate limiting of payload updates in the selected mode."""
+
+    def setUp(self):
+        self.sensor = make_sensor(
+            [lpf2.LPF2.mode("dist", 1, lpf2.DATA16)], coalesce_ms=10000
+        )
+        self.hub = HubEmulator(self.sensor)
+        self.hub.nack()
+
+    def test_only_newest_payload_is_sent(self):
+        """Test that updates within the interval wait for the next heartbeat."""
+        frames = self.hub.frames
+        for i in range(5):
+            self.sensor.update_payload(struct.pack("<h", i), 0)
+        self.hub.receive()
+        self.assertEqual(self.hub.frames, frames)
+        self.assertTrue(self.sensor.pending)
+
+        self.hub.nack()
+        self.assertEqual(self.hub.frames, frames + 1)
+        self.assertEqual(self.hub.values(0), (4,))
+
+    def test_statistics(self):
+        """Test that frames and bytes written to the UART are counted."""
+        self.sensor.coalesce_ms = 0
+        frames = self.sensor.tx_frames
+        tx_bytes = self.sensor.tx_bytes
+        self.sensor.update_payload(struct.pack("<h", 1), 0)
+        self.assertEqual(self.sensor.tx_frames, frames + 1)
+        # Extended mode message and a data message with 2 bytes
+        self.assertEqual(self.sensor.tx_bytes, tx_bytes + 3 + 4)
+
+
+class TestShortFrames(unittest.TestCase):
+    """Test sending the smallest frame that fits variable length data."""
+
+    def setUp(self):
+        self.sensor = make_sensor([lpf2.LPF2.mode("text", 32, fit=True)])
+        self.hub = HubEmulator(self.sensor)
+
+    def test_frame_fits_payload(self):
+        """Test that short payloads go out in short frames."""
+        tx_bytes = self.sensor.tx_bytes
+        self.sensor.update_payload(b"'hello world'\x00", 0)
+        # Extended mode message and a data message with 16 bytes
+        self.assertEqual(self.sensor.tx_bytes - tx_bytes, 3 + 18)
+
+        tx_bytes = self.sensor.tx_bytes
+        self.sensor.update_payload(b"1\x00", 0)
+        self.hub.receive()
+        self.assertEqual(self.sensor.tx_bytes - tx_bytes, 3 + 4)
+        # The hub keeps the rest of the longer frame.
+        self.assertEqual(self.hub.data[0][:16], b"1\x00ello world'\x00\x00\x00")
+
+    def test_nack_resends_short_frame(self):
+        """Test that heartbeats resend the short frame."""
+        self.sensor.load_payload(b"ok\x00", 0)
+        tx_bytes = self.sensor.tx_bytes
+        self.hub.nack()
+        self.assertEqual(self.sensor.tx_bytes - tx_bytes, 3 + 6)
+
+
+class TestTxQueue(unittest.TestCase):
+    """Test queueing data for the hub while the UART is busy."""
+
+    def setUp(self):
+        self.sensor = make_sensor(
+            [lpf2.LPF2.mode("dist", 1, lpf2.DATA16)], tx_queue=16
+        )
+        self.hub = HubEmulator(self.sensor)
+        self.busy = True
+        self.hub.uart.txdone = lambda: not self.busy
+
+    def test_frames_wait_for_uart(self):
+        """Test that frames are queued while the UART is busy."""
+        self.sensor.update_payload(struct.pack("<h", 1), 0)
+        self.sensor.update_payload(struct.pack("<h", 2), 0)
+        self.assertEqual(self.hub.uart.tx, b"")
+        self.assertEqual(self.sensor.tx_max_queued, 14)
+
+        self.busy = False
+        self.sensor.drain()
+        self.hub.receive()
+        self.assertEqual(self.hub.frames, 2)
+        self.assertEqual(self.hub.values(0), (2,))
+
+    def test_full_queue_drops_whole_frames(self):
+        """Test that frames that don't fit are dropped, not truncated."""
+        for i in range(3):
+            self.sensor.update_payload(struct.pack("<h", i), 0)
+        self.assertEqual(self.sensor.tx_dropped, 1)
+
+        self.busy = False
+        self.hub.nack()
+        self.assertEqual(self.hub.frames, 3)
+        self.assertEqual(self.hub.values(0), (2,))
+
+
+class TestRxRing(unittest.TestCase):
+    """Test receiving from an interrupt into a ring buffer."""
+
+    def setUp(self):
+        self.sensor = make_sensor(
+            [lpf2.LPF2.mode("a", 1), lpf2.LPF2.mode("b", 2)], rx_ring=32
+        )
+        self.hub = HubEmulator(self.sensor, self.interrupt_and_heartbeat)
+        self.sensor.start_rx()
+        # The emulated UART has no irq(), so a timer polls it.
+        self.timer = self.sensor.rx_timer
+
+    def interrupt_and_heartbeat(self):
+        self.timer.callback(self.timer)
+        return self.sensor.heartbeat()
+
+    def test_nack_buffered(self):
+        """Test that the interrupt only buffers heartbeats, for the main loop."""
+        self.sensor.load_payload(b"\x07", 0)
+        self.hub.uart.rx.append(0x02)  # NACK
+        self.timer.callback(self.timer)
+        self.assertEqual(self.hub.uart.tx, bytearray())
+        self.assertNotEqual(self.sensor.rx_head, self.sensor.rx_tail)
+
+        self.sensor.heartbeat()
+        self.hub.receive()
+        self.assertEqual(self.hub.values(0), (7,))
+        self.assertEqual(self.sensor.rx_head, self.sensor.rx_tail)
+
+    def test_messages_buffered(self):
+        """Test that the main loop handles buffered mode switches and writes."""
+        self.hub.select(1)
+        self.assertEqual(self.sensor.current_mode, 1)
+
+        data, mode = self.hub.write(1, b"\x02\x02")
+        self.assertEqual((bytes(data), mode), (b"\x02\x02", 1))
+        self.assertEqual(self.sensor.rx_overflows, 0)
+
+    def test_stop_rx(self):
+        """Test that the interrupt leaves the UART alone after stop_rx()."""
+        self.sensor.stop_rx()
+        self.hub.uart.rx.append(0x04)  # ACK of a new handshake
+        # An interrupt that was already pending
+        self.sensor.rx_irq(None)
+        self.assertEqual(self.sensor.rx_head, self.sensor.rx_tail)
+        self.assertEqual(self.sensor.readchar(), 0x04)
+
+
+if __name__ == "__main__":
+    unittest.main()
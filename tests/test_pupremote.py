@@ -9,7 +9,9 @@ Tests core functionality of pupremote.py including:
 
 import unittest
 import sys
+import struct
 from pathlib import Path
+import unittest.mock
 from unittest.mock import MagicMock
 
 # Add src to path so we can import pupremote
@@ -131,6 +133,1390 @@ class TestEncodingDecoding(unittest.TestCase):
                 self.fail(f"Invalid struct format: {fmt}")
 
 
+class TestLiteral(unittest.TestCase):
+    """Test the literal parser that decodes the 'repr' format."""
+
+    def test_round_trip(self):
+        """Test that the repr() of supported values parses to the same value."""
+        import pupremote
+        import pupremote_hub
+
+        values = [
+            0,
+            -12,
+            3.25,
+            -1e-05,
+            "it's \"quoted\"\n\x01",
+            b"\x00\xffab",
+            True,
+            False,
+            None,
+            [1, [2.5, (3,)], "x"],
+            (),
+            (1, -2),
+            {"a": [1, {2: None}]},
+            {1, 2},
+            {},
+        ]
+        for module in (pupremote, pupremote_hub):
+            for value in values:
+                result = module.literal(repr(value))
+                self.assertEqual(result, value)
+                self.assertIs(type(result), type(value))
+
+    def test_invalid(self):
+        """Test that anything but a literal raises ValueError."""
+        import pupremote
+
+        for text in ["", "[1,", "(1, 2", "'abc", "1 2", "print('hi')", "x"]:
+            with self.assertRaises(ValueError):
+                pupremote.literal(text)
+
+
+class TestNativeDataTypes(unittest.TestCase):
+    """Test mapping of homogeneous struct formats on LPF2 data types."""
+
+    def test_native_type(self):
+        """Test that single-type formats map on DATA8/16/32/F."""
+        import pupremote
+
+        cases = [
+            ("4h", pupremote.DATA16),
+            ("hh", pupremote.DATA16),
+            ("2i", pupremote.DATA32),
+            ("<3f", pupremote.DATAF),
+            ("b", pupremote.DATA8),
+            ("2h2h", pupremote.DATA16),
+            ("4H", None),
+            ("2l", None),
+            ("hb", None),
+            ("", None),
+        ]
+        for fmt, expected in cases:
+            self.assertEqual(pupremote.native_type(fmt), expected, fmt)
+
+
+class RealStructTestCase(unittest.TestCase):
+    """Base class for tests that need pupremote with the real struct module."""
+
+    def setUp(self):
+        """Use the real struct module for format calculations."""
+        import struct
+        import pupremote
+        from unittest.mock import patch
+
+        patcher = patch.object(pupremote, "struct", struct)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pupremote = pupremote
+
+
+class TestMultiplexing(RealStructTestCase):
+    """Test registration of multiplexed commands."""
+
+    def test_mux_commands_share_one_mode(self):
+        """Test that many multiplexed commands use a single mode."""
+        pr = self.pupremote.PUPRemote()
+        pr.add_command("first", "b")
+        for i in range(40):
+            pr.add_command("cmd%d" % i, "h", "2b", mux=True)
+        pr.add_channel("chan", "2h", mux=True)
+        pr.add_command("last", "b")
+
+        self.assertEqual(list(pr.modes), ["first", self.pupremote.MUX, "last"])
+        self.assertEqual(len(pr.mux_commands), 41)
+        self.assertEqual(pr.mux["cmd39"], 39)
+        self.assertNotIn(self.pupremote.FROM_HUB_FORMAT, pr.mux_commands[40])
+
+    def test_mux_payload_limit(self):
+        """Test that multiplexed payloads leave room for the 2 byte header."""
+        pr = self.pupremote.PUPRemote(max_packet_size=16)
+        pr.add_command("fits", "14s", mux=True)
+        with self.assertRaises(AssertionError):
+            pr.add_command("toobig", "15s", mux=True)
+
+
+class TestSnapshot(RealStructTestCase):
+    """Test snapshot modes that combine several channels."""
+
+    def test_snapshot_size(self):
+        """Test that a snapshot packs its channels back to back."""
+        pr = self.pupremote.PUPRemote()
+        pr.add_channel("a", "h")
+        pr.add_channel("b", "2b")
+        pr.add_channel("c", "f", mux=True)
+        pr.add_snapshot("snap", ["a", "b", "c"])
+
+        snapshot = pr.commands[pr.modes["snap"]]
+        self.assertEqual(snapshot[self.pupremote.SIZE], 8)
+        self.assertEqual(snapshot[self.pupremote.MEMBERS], ["a", "b", "c"])
+
+    def test_snapshot_rejects_commands(self):
+        """Test that only channels can be part of a snapshot."""
+        pr = self.pupremote.PUPRemote()
+        pr.add_command("cmd", "h", "h")
+        pr.add_channel("text", "repr")
+        for members in (["cmd"], ["text"]):
+            with self.assertRaises(AssertionError):
+                pr.add_snapshot("snap", members)
+
+
+class TestQuantizedFormats(RealStructTestCase):
+    """Test scaled integer and half float formats."""
+
+    def test_scaled_round_trip(self):
+        """Test that scaled values travel as small integers."""
+        pr = self.pupremote.PUPRemote()
+        pr.add_channel("pos", "2h*0.01")
+        pr.add_channel("temp", "b*0.5+-20")
+
+        self.assertEqual(pr.commands[pr.modes["pos"]][self.pupremote.SIZE], 4)
+        self.assertNotIn(self.pupremote.DATA_TYPE, pr.commands[pr.modes["pos"]])
+        data = pr.encode(4, "2h*0.01", 1.234, -2.5)
+        self.assertEqual(data, struct.pack("<2h", 123, -250))
+        x, y = pr.decode("2h*0.01", data)
+        self.assertAlmostEqual(x, 1.23)
+        self.assertAlmostEqual(y, -2.5)
+        self.assertEqual(pr.decode("b*0.5+-20", pr.encode(1, "b*0.5+-20", 21.5)), (21.5,))
+
+    def test_half_floats(self):
+        """Test that half floats match the IEEE 754 binary16 format."""
+        pr = self.pupremote.PUPRemote()
+        pr.add_channel("imu", "4e")
+        values = (1.5, -0.000123, 65504.0, 1e6)
+
+        self.assertEqual(pr.commands[pr.modes["imu"]][self.pupremote.SIZE], 8)
+        data = pr.encode(8, "4e", *values)
+        self.assertEqual(data, struct.pack("<3e", *values[:3]) + b"\x00\x7c")
+        self.assertEqual(pr.decode("4e", data), struct.unpack("<4e", data))
+
+    def test_mixed_half_floats_rejected(self):
+        """Test that half floats can't share a format with other types."""
+        pr = self.pupremote.PUPRemote()
+        with self.assertRaises(AssertionError):
+            pr.add_channel("mixed", "eh")
+
+
+class TestBitFields(RealStructTestCase):
+    """Test packing booleans and small numbers into bits."""
+
+    def test_bit_fields_round_trip(self):
+        """Test that 12 flags and two 3 bit numbers take 3 bytes."""
+        pr = self.pupremote.PUPRemote()
+        pr.add_channel("buttons", "2h|12?2u3")
+        command = pr.commands[pr.modes["buttons"]]
+        flags = [i % 3 == 0 for i in range(12)]
+
+        self.assertEqual(command[self.pupremote.SIZE], 7)
+        self.assertEqual(command[self.pupremote.ARGS_TO_HUB], 16)
+        data = pr.encode(7, "2h|12?2u3", -5, 300, *flags, 5, 7)
+        self.assertEqual(data[:4], struct.pack("2h", -5, 300))
+        self.assertEqual(int.from_bytes(data[4:], "little"), 0b111101001001001001)
+        self.assertEqual(pr.decode("2h|12?2u3", data), (-5, 300, *flags, 5, 7))
+
+    def test_only_bit_fields(self):
+        """Test a format with bit fields and no struct values."""
+        pr = self.pupremote.PUPRemote()
+        pr.add_command("leds", "", "|3?u4")
+        data = pr.encode(1, "|3?u4", True, False, True, 9)
+        self.assertEqual(data, bytes([0b1001101]))
+        self.assertEqual(pr.decode("|3?u4", data), (True, False, True, 9))
+
+
+class SensorTestCase(unittest.TestCase):
+    """Base class for tests of a PUPRemoteSensor connected to an emulated hub."""
+
+    def setUp(self):
+        from hub_emulator import load_pupremote
+
+        self.pupremote = load_pupremote()
+        self.sensor = self.pupremote.PUPRemoteSensor(max_packet_size=32)
+
+    def connect(self, process=None):
+        from hub_emulator import HubEmulator
+
+        self.hub = HubEmulator(self.sensor.lpup, process or self.sensor.process)
+        return self.hub
+
+    def connect_hub(self, max_write=32, **kwargs):
+        """Return a PUPRemoteHub that talks to the sensor through the emulated hub."""
+        from hub_emulator import FakePUPDevice
+
+        self.hub.max_write = max_write
+        return self.hub_class(FakePUPDevice(self.hub))("A", **kwargs)
+
+    def hub_class(self, device):
+        """Return the PUPRemoteHub class of pupremote.py, on top of device."""
+        self.pupremote.PUPDevice = lambda port: device
+        self.pupremote.run_task = lambda: False
+        self.hub_modules = [self.pupremote]
+        return self.pupremote.PUPRemoteHub
+
+    def hub_module(self, name):
+        """Return the module of the hub side that defines name."""
+        return [m for m in self.hub_modules if hasattr(m, name)][0]
+
+
+class HubFileTestCase(SensorTestCase):
+    """Base class to run the hub side of sensor tests with pupremote_hub.py.
+
+    Set addons to the add-on modules and their mixin classes the hub needs.
+    """
+
+    addons = ()
+
+    def hub_class(self, device):
+        """Return a PUPRemoteHub class of pupremote_hub.py with the add-ons."""
+        from hub_emulator import load_pupremote_hub
+
+        modules = load_pupremote_hub(device, *[name for name, mixin in self.addons])
+        self.hub_modules = modules
+        mixins = [getattr(m, mixin) for m, (name, mixin) in zip(modules[1:], self.addons)]
+        return type("Hub", tuple(mixins) + (modules[0].PUPRemoteHub,), {})
+
+
+class TestNativeModes(SensorTestCase):
+    """Test commands that the hub reads and writes as native LPF2 values."""
+
+    def setUp(self):
+        super().setUp()
+        self.pupremote.turn = lambda a, b: (b, -a)
+        self.sensor.add_command("turn", "2h", "2h")
+        self.sensor.add_channel("heading", "f")
+        self.connect()
+
+    def test_advertised_data_types(self):
+        """Test that the modes have the data type and count of the format."""
+        self.assertEqual(self.hub.modes[0]["values"], 2)
+        self.assertEqual(self.hub.modes[0]["data_type"], self.pupremote.DATA16)
+        self.assertEqual(self.hub.modes[1]["values"], 1)
+        self.assertEqual(self.hub.modes[1]["data_type"], self.pupremote.DATAF)
+
+    def test_round_trip(self):
+        """Test that the hub writes and reads native values."""
+        remote = self.connect_hub(max_packet_size=32)
+        remote.add_command("turn", "2h", "2h")
+        remote.add_channel("heading", "f")
+        self.assertEqual(remote.call("turn", 300, -2), (-2, -300))
+        self.sensor.update_channel("heading", 1.5)
+        self.assertEqual(remote.call("heading"), 1.5)
+
+    def test_combo_size(self):
+        """Test that combinations must fit a frame."""
+        self.sensor.add_combo("turn", "heading")
+        self.assertEqual(self.sensor.lpup.combos, [0b11])
+        self.sensor.add_channel("wide", "7f")
+        with self.assertRaises(AssertionError):
+            self.sensor.add_combo("turn", "heading", "wide")
+        self.assertEqual(self.sensor.lpup.combos, [0b11])
+
+
+class TestSchema(SensorTestCase):
+    """Test registering the commands of a sensor from its command table."""
+
+    def setUp(self):
+        super().setUp()
+        self.pupremote.add = lambda a, b: a + b
+        self.pupremote.mul = lambda a, b: a * b
+        self.sensor = self.pupremote.PUPRemoteSensor(schema=True)
+        self.sensor.add_channel("dist", "h")
+        self.sensor.add_command("add", "h", "2h")
+        self.sensor.add_channel("flags", "B", mux=True)
+        self.sensor.add_command("mul", "h", "2h", mux=True)
+        self.sensor.add_snapshot("snap", ["dist", "flags"])
+        self.sensor.add_bulk()
+        self.connect()
+
+    def test_hub_registers_commands(self):
+        """Test that the hub reads the table over several pages."""
+        self.sensor._schema_page(1)
+        # 15 bytes to a page with 16 byte packets
+        self.assertGreater(len(self.sensor._schema), 3 * 15)
+        remote = self.connect_hub()
+        self.assertEqual(
+            list(remote.modes),
+            [self.pupremote.SCHEMA, "dist", "add", self.pupremote.MUX, "snap", "_blk"],
+        )
+        self.assertEqual(list(remote.mux), ["flags", "mul"])
+        self.assertEqual(remote.commands[remote.modes["add"]][self.pupremote.SIZE], 4)
+        self.assertEqual(
+            remote.commands[remote.modes["snap"]][self.pupremote.MEMBERS],
+            ["dist", "flags"],
+        )
+        # Adding the same commands again only checks them.
+        remote.add_command("add", "h", "2h")
+        remote.add_snapshot("snap", ["dist", "flags"])
+        self.assertNotIn(
+            self.pupremote.MEMBERS, remote.commands[remote.modes["_blk"]]
+        )
+        with self.assertRaises(AssertionError):
+            remote.add_command("add", "b", "2h")
+
+        self.assertEqual(remote.call("add", 2, 3), 5)
+        self.assertEqual(remote.call("mul", 4, -3), -12)
+        self.sensor.update_channel("dist", 120)
+        self.sensor.update_channel("flags", 5)
+        self.assertEqual(remote.read_snapshot("snap"), {"dist": 120, "flags": 5})
+
+
+class TestSnapshotReads(SensorTestCase):
+    """Test reading the channels of a snapshot on the hub."""
+
+    def setUp(self):
+        super().setUp()
+        self.sensor.add_channel("dist", "h")
+        self.sensor.add_channel("pos", "2h*0.1")
+        self.sensor.add_channel("light", "B", mux=True)
+        self.sensor.add_snapshot("snap", ["pos", "dist", "light"])
+        self.connect()
+
+    def test_read_snapshot(self):
+        """Test that one read returns all channels as a dict or a tuple."""
+        remote = self.connect_hub(max_packet_size=32)
+        remote.add_channel("dist", "h")
+        remote.add_channel("pos", "2h*0.1")
+        remote.add_channel("light", "B", mux=True)
+        remote.add_snapshot("snap", ["pos", "dist", "light"])
+        self.sensor.update_channel("dist", -300)
+        self.sensor.update_channel("pos", 1.5, -2.5)
+        self.sensor.update_channel("light", 200)
+        switches = self.hub.mode_switches
+
+        self.assertEqual(
+            remote.read_snapshot("snap"),
+            {"pos": (1.5, -2.5), "dist": -300, "light": 200},
+        )
+        self.assertEqual(
+            remote.read_snapshot("snap", as_tuple=True), ((1.5, -2.5), -300, 200)
+        )
+        self.assertEqual(self.hub.mode_switches - switches, 1)
+
+
+class TestProducerChannels(SensorTestCase):
+    """Test channels that compute their values on demand."""
+
+    def setUp(self):
+        super().setUp()
+        self.calls = {"near": 0, "far": 0}
+        for name in self.calls:
+            self.sensor.add_channel(name, "h", producer=self.producer(name))
+
+    def producer(self, name):
+        def produce():
+            self.calls[name] += 1
+            return self.calls[name]
+
+        return produce
+
+    def test_only_selected_mode_is_produced(self):
+        """Test that producers of unselected modes are not called."""
+        hub = self.connect()
+        for i in range(3):
+            hub.nack()
+        self.assertEqual(self.calls, {"near": 3, "far": 0})
+        self.assertEqual(hub.values(0), (3,))
+
+        hub.select(1)
+        self.assertEqual(self.calls, {"near": 3, "far": 1})
+        self.assertEqual(hub.values(1), (1,))
+
+    def test_interval(self):
+        """Test that producers are called at most once per interval."""
+        self.calls["slow"] = 0
+        self.sensor.add_channel(
+            "slow", "h", producer=self.producer("slow"), interval_ms=10000
+        )
+        hub = self.connect()
+        hub.select(2)
+        hub.nack()
+        hub.nack()
+        self.assertEqual(self.calls["slow"], 1)
+        self.assertEqual(hub.values(2), (1,))
+
+    def test_not_in_heartbeat_loop(self):
+        """Test that process_async() calls producers apart from the heartbeats."""
+        self.connect()
+        calls = dict(self.calls)
+        # asyncio is mocked here, so each loop stops at its first sleep.
+        with self.assertRaises(TypeError):
+            self.sensor._heartbeat_loop(1).send(None)
+        self.assertEqual(self.calls, calls)
+        with self.assertRaises(TypeError):
+            self.sensor._refresh_loop(1).send(None)
+        self.assertEqual(self.calls["near"], calls["near"] + 1)
+
+
+class TestRefreshedCommands(SensorTestCase):
+    """Test commands without arguments that the sensor refreshes itself."""
+
+    def setUp(self):
+        super().setUp()
+        self.calls = 0
+
+        def touch():
+            self.calls += 1
+            return self.calls
+
+        # The sensor looks up command functions by name.
+        self.pupremote.touch = touch
+
+    def test_promoted_to_channel(self):
+        """Test that a refreshed command is a channel on both sides."""
+        self.sensor.add_command("touch", "h", refresh_ms=50)
+        hub = self.pupremote.PUPRemote()
+        hub.add_command("touch", "h", refresh_ms=50)
+
+        for pr in (self.sensor, hub):
+            self.assertNotIn(self.pupremote.FROM_HUB_FORMAT, pr.commands[0])
+
+    def test_refreshed_in_background(self):
+        """Test that the result is preloaded, also when the mode is not selected."""
+        self.sensor.add_channel("other", "h")
+        self.sensor.add_command("touch", "h", refresh_ms=10000)
+        hub = self.connect()
+        hub.nack()
+        hub.nack()
+
+        self.assertEqual(self.calls, 1)
+        hub.select(1)
+        self.assertEqual(hub.values(1), (1,))
+
+    def test_multiplexed_not_called_on_demand(self):
+        """Test that the hub reads a refreshed multiplexed command from memory."""
+        self.sensor.add_command("touch", "h", mux=True, refresh_ms=10000)
+        self.connect().nack()
+        remote = self.connect_hub(max_packet_size=32)
+        remote.add_command("touch", "h", mux=True, refresh_ms=10000)
+
+        self.assertEqual(remote.call("touch"), 1)
+        self.assertEqual(remote.call("touch"), 1)
+        self.assertEqual(self.calls, 1)
+
+    def test_arguments_rejected(self):
+        """Test that functions with arguments can't be refreshed."""
+        with self.assertRaises(AssertionError):
+            self.sensor.add_command("touch", "h", "b", refresh_ms=50)
+
+
+class TestPending(SensorTestCase):
+    """Test calls that finish after the function returned."""
+
+    def setUp(self):
+        super().setUp()
+        self.pending = self.pupremote.Pending()
+        self.pupremote.slow = lambda x: self.pending
+        self.sensor.add_command("slow", "h", "h", mux=True)
+        self.hub = self.connect()
+
+    def test_busy_until_done(self):
+        """Test that the hub reads a busy status, then the result."""
+        import struct
+
+        mode = self.sensor.modes[self.pupremote.MUX]
+        self.hub.write(mode, bytes([0, 1]) + struct.pack("<h", 5))
+        self.hub.nack()
+        self.assertEqual(self.hub.data[mode][:2], bytes([self.pupremote.MUX_BUSY, 1]))
+
+        self.pending.done(10)
+        self.hub.nack()
+        self.assertEqual(self.hub.data[mode][:4], bytes([0, 1]) + struct.pack("<h", 10))
+        self.assertEqual(self.sensor._pending, [])
+
+    def test_poll(self):
+        """Test that process() polls until the result is done."""
+        polls = []
+
+        def poll(pending):
+            polls.append(1)
+            if len(polls) == 3:
+                pending.done(3)
+
+        self.pending.poll = poll
+        mode = self.sensor.modes[self.pupremote.MUX]
+        self.hub.write(mode, bytes([0, 1, 5, 0]))
+        for i in range(4):
+            self.hub.nack()
+        self.assertEqual(len(polls), 3)
+        self.assertEqual(self.hub.data[mode][:4], bytes([0, 1, 3, 0]))
+
+    def test_busy_status(self):
+        """Test that the hub keeps waiting while the sensor is busy."""
+        polls = []
+
+        def poll(pending):
+            polls.append(1)
+            if len(polls) == 2 * self.pupremote.MUX_RETRIES:
+                pending.done(7)
+
+        self.pending.poll = poll
+        remote = self.connect_hub(max_packet_size=32)
+        remote.add_command("slow", "h", "h", mux=True)
+        self.assertEqual(remote.call("slow", 5), 7)
+
+    def test_busy_timeout(self):
+        """Test that the hub stops waiting for a sensor that stays busy."""
+        from unittest import mock
+
+        remote = self.connect_hub(max_packet_size=32)
+        remote.add_command("slow", "h", "h", mux=True)
+        with mock.patch.object(self.hub_module("MUX_BUSY_READS"), "MUX_BUSY_READS", 300):
+            with self.assertRaisesRegex(OSError, "busy"):
+                remote.call("slow", 5)
+
+    def test_only_multiplexed(self):
+        """Test that a Pending from a command without busy status is refused."""
+        self.pupremote.late = lambda x: self.pending
+        self.sensor.add_command("late", "h", "h")
+        hub = self.connect()
+        with self.assertRaises(AssertionError):
+            hub.write(self.sensor.modes["late"], b"\x05\x00")
+
+
+class TestCache(SensorTestCase):
+    """Test remembering the results of commands."""
+
+    def setUp(self):
+        super().setUp()
+        self.calls = 0
+
+        def square(x):
+            self.calls += 1
+            return x * x
+
+        self.pupremote.square = square
+
+    def call(self, mode, *args):
+        self.hub.write(mode, bytes(args))
+        self.hub.nack()
+        return self.hub.data[mode]
+
+    def test_repeated_calls_answered_from_cache(self):
+        """Test that the function only runs for new arguments."""
+        self.sensor.add_command("square", "B", "B", cache=2)
+        self.connect()
+        self.assertEqual(self.call(0, 3)[0], 9)
+        self.assertEqual(self.call(0, 4)[0], 16)
+        self.assertEqual(self.call(0, 3)[0], 9)
+
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(self.sensor.cache_info("square"), (1, 2))
+
+    def test_least_recently_used_evicted(self):
+        """Test that the least recently used result is forgotten first."""
+        self.sensor.add_command("square", "B", "B", mux=True, cache=2)
+        self.connect()
+        for x in (2, 3, 2, 4, 2, 3):
+            data = self.call(0, 0, x, x)
+            self.assertEqual(data[:3], bytes([0, x, x * x]))
+
+        # 3 was evicted by 4, 2 stayed in use.
+        self.assertEqual(self.calls, 4)
+
+
+class TestRepeatedResults(SensorTestCase):
+    """Test resending the frame of a result that did not change."""
+
+    def setUp(self):
+        super().setUp()
+        self.pupremote.status = lambda x: x // 10
+        self.sensor.add_command("status", "B", "B")
+        self.hub = self.connect()
+
+    def call(self, arg):
+        self.hub.write(0, bytes([arg]))
+        self.hub.nack()
+        return self.hub.data[0][0]
+
+    def test_frame_reused(self):
+        """Test that the same result resends the frame that was built before."""
+        self.assertEqual(self.call(11), 1)
+        frame = self.sensor.lpup.payloads[0]
+        self.assertEqual(self.call(12), 1)
+
+        self.assertIs(self.sensor.lpup.payloads[0], frame)
+        self.assertEqual(self.sensor.repeat_hits, 1)
+        self.assertEqual(self.call(21), 2)
+        self.assertEqual(self.sensor.repeat_hits, 1)
+
+    def test_repeat_cached(self):
+        """Test that new arguments with the same result are cached too."""
+        self.pupremote.tens = lambda x: x // 10
+        self.sensor.add_command("tens", "B", "B", cache=4)
+        self.connect()
+        mode = self.sensor.modes["tens"]
+        for arg in (11, 12, 12):
+            self.hub.write(mode, bytes([arg]))
+            self.hub.nack()
+            self.assertEqual(self.hub.data[mode][0], 1)
+
+        self.assertEqual(self.sensor.repeat_hits, 1)
+        self.assertEqual(self.sensor.cache_info("tens"), (1, 2))
+
+    def test_repr_encoded(self):
+        """Test that equal results with a different repr() are not repeated."""
+        results = [[1], [True], {"a": 1}, {"a": 1.0}]
+        self.pupremote.show = lambda i: results[i]
+        self.sensor.add_command("show", "repr", "B")
+        self.connect()
+        mode = self.sensor.modes["show"]
+        for i, text in enumerate((b"[1]", b"[True]", b"{'a': 1}", b"{'a': 1.0}")):
+            self.hub.write(mode, bytes([i]))
+            self.hub.nack()
+            self.assertEqual(self.hub.data[mode][: len(text)], text)
+        self.assertEqual(self.sensor.repeat_hits, 0)
+
+
+class TestDeltaChannels(SensorTestCase):
+    """Test channels that only send the values that changed."""
+
+    def setUp(self):
+        super().setUp()
+        self.sensor = self.pupremote.PUPRemoteSensor(max_packet_size=16)
+        self.sensor.add_channel("touch", "10h~4")
+        self.mode = self.sensor.modes["touch"]
+        self.connect()
+        self.values = list(range(10))
+
+    def connect_hub(self):
+        remote = super().connect_hub(max_packet_size=16)
+        remote.add_channel("touch", "10h~4")
+        return remote
+
+    def update(self, i=None, value=0):
+        if i is not None:
+            self.values[i] = value
+        self.sensor.update_channel("touch", *self.values)
+        self.hub.receive()
+        return self.hub.data[self.mode]
+
+    def test_only_changes_sent(self):
+        """Test that a 20 byte channel fits a 16 byte frame."""
+        remote = self.connect_hub()
+        self.assertEqual(self.sensor.commands[self.mode][self.pupremote.SIZE], 16)
+        # The first frame has room for 6 values. The hub asks for a key frame
+        # with the rest.
+        self.assertEqual(self.update()[:3], struct.pack("<HB", 0b111111, 1))
+        self.assertEqual(remote.call("touch"), tuple(range(10)))
+
+        frame = self.update(3, 300)
+        self.assertEqual(frame[:5], struct.pack("<HBh", 1 << 3, 3, 300))
+        self.assertEqual(remote.call("touch"), (0, 1, 2, 300, 4, 5, 6, 7, 8, 9))
+
+    def test_missed_updates(self):
+        """Test that the hub gets all values after updates it did not read."""
+        remote = self.connect_hub()
+        self.update()
+        remote.call("touch")
+        self.update(1, 100)
+        self.update(2, 200)
+        self.update(8, 800)
+        # The hub returns what it has, and asks for a key frame with the rest.
+        self.assertEqual(remote.call("touch")[8], 800)
+        self.assertEqual(remote.call("touch"), (0, 100, 200, 3, 4, 5, 6, 7, 800, 9))
+
+    def test_key_frame_requests(self):
+        """Test that the hub only asks for key frames after missed updates."""
+        remote = self.connect_hub()
+        writes = []
+        write = remote.pup_device.write
+        remote.pup_device.write = lambda *args: writes.append(args) or write(*args)
+        self.update()
+        remote.call("touch")
+        remote.call("touch")
+        writes.clear()
+        for i in range(3):
+            self.update(i, i + 100)
+            remote.call("touch")
+        self.assertEqual(writes, [])
+        self.update(4, 400)
+        self.update(5, 500)
+        remote.call("touch")
+        self.assertEqual(len(writes), 1)
+
+    def test_no_key_frames(self):
+        """Test that deltas need updates between key frames."""
+        with self.assertRaises(AssertionError):
+            self.sensor.add_channel("rate", "10h~0")
+
+    def test_key_frames(self):
+        """Test that every 4th update fills up with unchanged values."""
+        self.update()
+        counts = []
+        for i in range(4):
+            bitmap = struct.unpack("<H", self.update()[:2])[0]
+            counts.append(bin(bitmap).count("1"))
+        # The 4 values that did not fit the first frame, no changes, and then a
+        # key frame.
+        self.assertEqual(counts, [4, 0, 0, 6])
+
+
+class TestShortReprFrames(SensorTestCase):
+    """Test sending 'repr' data in the smallest frame that fits."""
+
+    def test_short_reply_after_long_one(self):
+        """Test that the hub ignores what is left of longer frames."""
+        self.sensor.add_channel("reply", "repr")
+        mode = self.sensor.modes["reply"]
+        self.connect()
+        self.sensor.update_channel("reply", "a longer reply")
+        tx_bytes = self.sensor.lpup.tx_bytes
+        self.sensor.update_channel("reply", 1)
+        self.hub.receive()
+
+        # Extended mode message and a data message with 2 bytes
+        self.assertEqual(self.sensor.lpup.tx_bytes - tx_bytes, 3 + 4)
+        self.assertEqual(self.sensor.decode("repr", self.hub.data[mode]), (1,))
+
+    def test_only_variable_length(self):
+        """Test that modes with formats of a fixed length send full frames."""
+        self.sensor.add_channel("reply", "repr")
+        self.sensor.add_channel("dist", "2h")
+        self.sensor.add_channel("name", "12s")
+        self.sensor.add_channel("pos", "b", mux=True)
+        self.sensor.add_snapshot("snap", ["dist", "name"])
+        fit = dict([(m[0].rstrip(), m[10]) for m in self.sensor.lpup.modes])
+        self.assertEqual(
+            fit,
+            {"reply": True, "dist": False, "name": False, "_mux": True, "snap": False},
+        )
+
+
+class TestFrameSizeProbe(SensorTestCase):
+    """Test a negotiating sensor with hubs that can and can't write 32 byte frames."""
+
+    def setUp(self):
+        super().setUp()
+        self.pupremote.echo = lambda x: x
+        self.pupremote.double = lambda x: 2 * x
+        self.sensor = self.pupremote.PUPRemoteSensor(negotiate=True)
+        self.sensor.add_command("echo", "repr", "repr")
+        self.sensor.add_command("double", "h", "h")
+        self.sensor.add_channel("text", "repr")
+        self.connect()
+
+    def connect_hub(self, max_write):
+        remote = super().connect_hub(max_write)
+        remote.add_command("echo", "repr", "repr")
+        remote.add_command("double", "h", "h")
+        remote.add_channel("text", "repr")
+        return remote
+
+    def test_large_frames(self):
+        """Test that a hub that writes 32 byte frames finds out."""
+        remote = self.connect_hub(32)
+        self.assertEqual((remote.frame_size, self.sensor.frame_size), (32, 32))
+        self.assertEqual(remote.max_packet_size, 32)
+
+    def test_small_frames(self):
+        """Test that a hub that breaks 32 byte frames reads and calls everything."""
+        remote = self.connect_hub(16)
+        self.assertEqual((remote.frame_size, self.sensor.frame_size), (16, 16))
+        self.assertEqual(remote.call("double", 21), 42)
+        self.assertEqual(remote.call("echo", "x" * 10), "x" * 10)
+        # Channels the hub only reads use 32 byte frames.
+        self.sensor.update_channel("text", "y" * 25)
+        self.assertEqual(remote.call("text"), "y" * 25)
+
+    def test_written_modes(self):
+        """Test that the modes the hub writes to are 16 bytes."""
+        self.assertEqual(self.sensor.commands[self.sensor.modes["echo"]][1], 16)
+        self.assertEqual(self.sensor.commands[self.sensor.modes["text"]][1], 32)
+        with self.assertRaises(AssertionError):
+            self.sensor.add_command("long", "20s", "20s")
+
+    def test_full_modes_written(self):
+        """Test that the hub writes as many values as each mode has."""
+        remote = self.connect_hub(32)
+        device = remote.pup_device
+        with self.assertRaises(ValueError):
+            device.write(0, list(range(1, 17)))
+        self.assertEqual(remote.call("echo", "ok"), "ok")
+
+    def test_schema_small_frames(self):
+        """Test the built-in modes with a hub that only writes 16 byte frames."""
+        self.pupremote.grid = lambda: iter(range(10))
+        self.sensor = self.pupremote.PUPRemoteSensor(negotiate=True, schema=True)
+        self.sensor.add_command("echo", "repr", "repr")
+        self.sensor.add_channel("pos", "2h", mux=True)
+        self.sensor.add_bulk()
+        self.sensor.add_stream("grid", "b")
+        self.sensor.add_buffered_channel("touch", "h")
+        self.connect()
+        remote = super().connect_hub(16)
+        self.assertEqual(remote.frame_size, 16)
+        self.assertEqual(remote.call("echo", [1, 2]), [1, 2])
+        self.sensor.update_channel("pos", 3, -4)
+        self.assertEqual(remote.call("pos"), (3, -4))
+        self.sensor.append_sample("touch", 5)
+        self.assertEqual([value for t, value in remote.drain("touch")], [5])
+        self.assertEqual(list(remote.stream("grid")), list(range(10)))
+        remote.send_blob("table", bytes(range(100)))
+        self.assertEqual(self.sensor.get_blob("table"), bytes(range(100)))
+
+
+class TestBulkTransfer(SensorTestCase):
+    """Test moving blobs in chunks over the bulk transfer mode."""
+
+    def setUp(self):
+        super().setUp()
+        self.sensor = self.pupremote.PUPRemoteSensor(negotiate=True)
+        self.sensor.add_bulk()
+        self.connect()
+        self.blob = bytes(range(256)) * 2 + b"end"
+
+    def connect_hub(self, max_write=32):
+        remote = super().connect_hub(max_write)
+        remote.add_bulk()
+        return remote
+
+    def test_crc(self):
+        """Test the CRC-16/CCITT-FALSE check value."""
+        self.assertEqual(self.pupremote.crc16(b"123456789"), 0x29B1)
+
+    def test_send_blob(self):
+        """Test sending a blob to the sensor with several window sizes."""
+        remote = self.connect_hub()
+        for window in (1, 4, 8):
+            remote.send_blob("table", self.blob[window:], window)
+            self.assertEqual(self.sensor.get_blob("table"), self.blob[window:])
+        remote.send_blob("empty", b"")
+        self.assertEqual(self.sensor.get_blob("empty"), b"")
+
+    def test_read_blob(self):
+        """Test reading a blob the sensor offers."""
+        remote = self.connect_hub()
+        self.sensor.put_blob("grid", self.blob)
+        self.assertEqual(remote.read_blob("grid"), self.blob)
+        self.assertIsNone(remote.read_blob("nothing"))
+
+    def test_small_frames(self):
+        """Test transfers in 16 byte frames."""
+        self.sensor = self.pupremote.PUPRemoteSensor(max_packet_size=16)
+        self.sensor.add_bulk()
+        self.connect()
+        remote = self.connect_hub(16)
+        remote.send_blob("table", self.blob)
+        self.assertEqual(self.sensor.get_blob("table"), self.blob)
+        self.sensor.put_blob("grid", self.blob[::-1])
+        self.assertEqual(remote.read_blob("grid"), self.blob[::-1])
+
+    def test_blob_too_large(self):
+        """Test that the sensor refuses blobs larger than it takes."""
+        self.sensor = self.pupremote.PUPRemoteSensor(negotiate=True)
+        self.sensor.add_bulk(max_size=100)
+        self.connect()
+        remote = self.connect_hub()
+        with self.assertRaises(OSError):
+            remote.send_blob("table", self.blob)
+        self.assertIsNone(self.sensor.get_blob("table"))
+        remote.send_blob("table", self.blob[:100])
+        self.assertEqual(self.sensor.get_blob("table"), self.blob[:100])
+
+    def test_lost_chunks(self):
+        """Test that lost chunks are written again."""
+        remote = self.connect_hub()
+        write = self.hub.write
+        writes = []
+
+        def lossy_write(mode, data):
+            writes.append(data)
+            if len(writes) % 7 == 3:
+                return None
+            return write(mode, data)
+
+        self.hub.write = lossy_write
+        remote.send_blob("table", self.blob)
+        self.assertEqual(self.sensor.get_blob("table"), self.blob)
+
+    def test_broken_blob(self):
+        """Test that a blob that fails the CRC check is not stored."""
+        remote = self.connect_hub()
+        write = self.hub.write
+
+        def corrupting_write(mode, data):
+            if data[:1] == b"\x02":  # A chunk of data
+                data = data[:-1] + b"?"
+            return write(mode, data)
+
+        self.hub.write = corrupting_write
+        with self.assertRaises(OSError):
+            remote.send_blob("table", self.blob)
+        self.assertIsNone(self.sensor.get_blob("table"))
+
+
+class TestStreams(SensorTestCase):
+    """Test iterating on the hub over generators on the sensor."""
+
+    def setUp(self):
+        super().setUp()
+        self.made = []
+        self.closed = False
+
+        def scan(steps):
+            try:
+                for angle in range(0, steps * 10, 10):
+                    self.made.append(angle)
+                    yield angle, 1000 - angle
+            finally:
+                self.closed = True
+
+        self.pupremote.scan = scan
+        self.pupremote.names = lambda: iter(["a", ("b", 2), {"c": 3}])
+        self.sensor = self.pupremote.PUPRemoteSensor(max_packet_size=32)
+        self.sensor.add_stream("scan", "2h", "B")
+        self.sensor.add_stream("names", "repr")
+        self.connect()
+
+    def connect_hub(self):
+        remote = super().connect_hub(max_packet_size=32)
+        remote.add_stream("scan", "2h", "B")
+        remote.add_stream("names", "repr")
+        return remote
+
+    def test_items_per_frame(self):
+        """Test that frames carry as many items as fit."""
+        remote = self.connect_hub()
+        scan = remote.stream("scan", 20)
+        self.assertEqual(next(scan), (0, 1000))
+        # 7 items of 4 bytes fit a 32 byte frame.
+        self.assertEqual(len(self.made), 7)
+        self.assertEqual(list(scan)[-1], (190, 810))
+        self.assertEqual(len(self.made), 20)
+        self.assertTrue(self.closed)
+
+    def test_repr_items(self):
+        """Test streaming any python objects."""
+        remote = self.connect_hub()
+        self.assertEqual(list(remote.stream("names")), ["a", ("b", 2), {"c": 3}])
+
+    def test_stop_early(self):
+        """Test that leaving the loop closes the generator on the sensor."""
+        remote = self.connect_hub()
+        for angle, distance in remote.stream("scan", 100):
+            if angle == 30:
+                break
+        self.assertEqual(len(self.made), 7)
+        self.assertTrue(self.closed)
+        # The stream can start again.
+        self.assertEqual(len(list(remote.stream("scan", 3))), 3)
+
+    def test_missed_reply(self):
+        """Test that a repeated request gets the same items again."""
+        command = self.sensor.commands[self.sensor.modes["scan"]]
+        self.hub.write(self.sensor.modes["scan"], bytes([1, 5, 10]))
+        first = command[self.pupremote.GENERATOR][2]
+        self.hub.write(self.sensor.modes["scan"], bytes([2, 6]))
+        second = command[self.pupremote.GENERATOR][2]
+        self.hub.write(self.sensor.modes["scan"], bytes([2, 6]))
+        self.assertEqual(command[self.pupremote.GENERATOR][2], second)
+        self.assertEqual(first[:2], bytes([5, 7]))
+        self.assertEqual(second[:2], bytes([6, 3 | 0x80]))
+
+    def test_missed_start_reply(self):
+        """Test that a repeated start doesn't run the generator again."""
+        command = self.sensor.commands[self.sensor.modes["scan"]]
+        self.hub.write(self.sensor.modes["scan"], bytes([1, 5, 10]))
+        first = command[self.pupremote.GENERATOR][2]
+        self.hub.write(self.sensor.modes["scan"], bytes([1, 5, 10]))
+        self.assertEqual(command[self.pupremote.GENERATOR][2], first)
+        self.assertEqual(len(self.made), 7)
+
+    def test_sequence_numbers(self):
+        """Test that requests never have sequence number 0, or the last one."""
+        remote = self.connect_hub()
+        remote._stream_seq = 254
+        self.assertEqual(len(list(remote.stream("scan", 3))), 3)
+        self.assertEqual(remote._stream_seq, 255)
+        self.assertEqual(len(list(remote.stream("scan", 3))), 3)
+        self.assertEqual(remote._stream_seq, 1)
+        # A new hub program starts counting again, and skips the number the
+        # sensor answered last.
+        remote = self.connect_hub()
+        self.assertEqual(len(list(remote.stream("scan", 3))), 3)
+        self.assertEqual(remote._stream_seq, 2)
+        self.assertEqual(len(self.made), 9)
+
+    def test_async_generator(self):
+        """Test that process_async() also takes items from async generators."""
+
+        async def ticks():
+            for i in range(3):
+                yield i
+
+        self.pupremote.ticks = ticks
+        sensor = self.pupremote.PUPRemoteSensor()
+        sensor.add_stream("ticks", "b")
+        command = sensor.commands[0]
+        # asyncio is mocked here, so run the coroutine by hand.
+        with self.assertRaises(StopIteration):
+            sensor._stream_async(0, command, bytes([1, 1])).send(None)
+        self.assertEqual(
+            command[self.pupremote.GENERATOR][2], bytes([1, 3 | 0x80, 0, 1, 2])
+        )
+
+    def test_schema(self):
+        """Test that streams are listed in the command table."""
+        self.assertEqual(self.sensor._schema_page(1)[1], b"%scan,2h,B;%names,repr,")
+
+
+class TestBufferedChannel(SensorTestCase):
+    """Test draining timestamped samples from a ring buffer on the sensor."""
+
+    def setUp(self):
+        super().setUp()
+        self.now = 1000
+        utime = self.pupremote.utime
+        patcher = unittest.mock.patch.object(utime, "ticks_us", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.sensor = self.pupremote.PUPRemoteSensor(max_packet_size=32)
+        self.sensor.add_buffered_channel("touch", "h", length=16)
+        self.sensor.add_buffered_channel("imu", "3h")
+        self.connect()
+
+    def connect_hub(self):
+        remote = super().connect_hub(max_packet_size=32)
+        remote.add_buffered_channel("touch", "h")
+        remote.add_buffered_channel("imu", "3h")
+        return remote
+
+    def sample(self, name, values):
+        for value in values:
+            self.sensor.append_sample(name, *value)
+            self.now += 2000
+
+    def test_drain(self):
+        """Test that the hub gets all samples with their times, in batches."""
+        remote = self.connect_hub()
+        self.sample("touch", [(i,) for i in range(15)])
+        samples = remote.drain("touch")
+        self.assertEqual(samples, [(1000 + 2000 * i, i) for i in range(15)])
+        self.assertEqual(remote.drain("touch"), [])
+        self.sample("touch", [(-1,), (-2,)])
+        self.assertEqual(remote.drain("touch"), [(31000, -1), (33000, -2)])
+        self.assertEqual(remote.samples_lost, 0)
+
+    def test_samples_with_several_values(self):
+        """Test samples of several values."""
+        remote = self.connect_hub()
+        self.sample("imu", [(1, 2, 3), (4, 5, -6)])
+        self.assertEqual(remote.drain("imu"), [(1000, (1, 2, 3)), (3000, (4, 5, -6))])
+
+    def test_slow_samples(self):
+        """Test that samples more than 65.5 ms apart keep their times."""
+        remote = self.connect_hub()
+        for i in range(3):
+            self.sensor.append_sample("touch", i)
+            self.now += 100000
+        self.sample("touch", [(3,), (4,)])
+        self.assertEqual(
+            remote.drain("touch"),
+            [(1000, 0), (101000, 1), (201000, 2), (301000, 3), (303000, 4)],
+        )
+        self.assertEqual(remote.samples_lost, 0)
+
+    def test_full_ring(self):
+        """Test that a full ring drops the oldest samples, and the hub counts them."""
+        remote = self.connect_hub()
+        self.assertEqual(remote.drain("touch"), [])
+        self.sample("touch", [(i,) for i in range(20)])
+        samples = remote.drain("touch")
+        self.assertEqual([value for t, value in samples], list(range(4, 20)))
+        self.assertEqual(remote.samples_lost, 4)
+        self.assertEqual(self.sensor.commands[0][self.pupremote.SAMPLES][5], 4)
+
+    def test_frame_updates(self):
+        """Test that the frame the hub reads shows new samples until it is full."""
+        mode = self.sensor.modes["touch"]
+        self.hub.select(mode)
+        self.sample("touch", [(7,), (8,)])
+        self.hub.nack()
+        first, count, t = struct.unpack("<HBI", self.hub.data[mode][:7])
+        self.assertEqual((first, count, t), (0, 2, 1000))
+
+    def test_schema(self):
+        """Test that buffered channels are listed in the command table."""
+        self.assertEqual(self.sensor._schema_page(1)[1], b"&touch,h;&imu,3h")
+
+
+class TestClockSync(SensorTestCase):
+    """Test syncing the hub clock to the sensor clock, and value ages."""
+
+    def setUp(self):
+        super().setUp()
+        self.now = 0  # Hub time in ms
+        self.rate = 1.0  # Sensor clock speed
+        utime = self.pupremote.utime
+        patcher = unittest.mock.patch.object(
+            utime, "ticks_ms", lambda: round(5000 + self.now * self.rate)
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # The us clock wraps like on MicroPython.
+        patcher = unittest.mock.patch.object(
+            utime, "ticks_us", lambda: round((5000 + self.now) * 1000) % (1 << 30)
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.sensor = self.pupremote.PUPRemoteSensor(max_packet_size=32)
+        self.sensor.add_clock()
+        self.sensor.add_channel("dist", "h@")
+        self.sensor.add_channel("pos", "2h*0.1@", mux=True)
+        self.connect()
+
+    def connect_hub(self):
+        remote = super().connect_hub(max_packet_size=32)
+        remote.add_clock()
+        remote.add_channel("dist", "h@")
+        remote.add_channel("pos", "2h*0.1@", mux=True)
+        remote._watch = unittest.mock.Mock(time=lambda: self.now)
+        return remote
+
+    def test_offset_and_drift(self):
+        """Test measuring the offset and then the drift of the sensor clock."""
+        remote = self.connect_hub()
+        self.assertEqual(remote.sync_clock(), 5000)
+        self.rate = 1.001
+        self.now = 10000
+        self.assertAlmostEqual(remote.sync_clock(), 5010, 0)
+        self.assertAlmostEqual(remote.clock[2], 0.001)
+        # 2 seconds after the sync, the sensor time is 12000 * 1.001 + 5000.
+        self.assertEqual(remote.hub_time(17012), 12000)
+
+    def test_age(self):
+        """Test that the hub knows how old the values of a channel are."""
+        remote = self.connect_hub()
+        self.sensor.update_channel("dist", 120)
+        self.assertEqual(remote.call("dist"), 120)
+        self.assertIsNone(remote.age("dist"))
+        remote.sync_clock()
+        self.now = 250
+        self.assertEqual(remote.call("dist"), 120)
+        self.assertEqual(remote.age("dist"), 250)
+        self.now = 300
+        self.assertEqual(remote.age("dist"), 300)
+
+    def test_age_multiplexed(self):
+        """Test timestamps of multiplexed channels, with converted values."""
+        remote = self.connect_hub()
+        remote.sync_clock()
+        self.now = 70000
+        self.sensor.update_channel("pos", 1.5, -2.5)
+        self.now = 70040
+        self.assertEqual(remote.call("pos"), (1.5, -2.5))
+        self.assertEqual(remote.age("pos"), 40)
+
+    def test_age_of_old_values(self):
+        """Test that values that didn't change for a long time are that old."""
+        remote = self.connect_hub()
+        remote.sync_clock()
+        self.sensor.update_channel("dist", 7)
+        self.now = 40000
+        self.assertEqual(remote.call("dist"), 7)
+        self.assertEqual(remote.age("dist"), 40000)
+
+    def test_hub_time_us(self):
+        """Test converting sensor times in us, across the wrap of the us clock."""
+        remote = self.connect_hub()
+        self.now = 1068000
+        remote.sync_clock()
+        # 2 seconds later, the us clock has wrapped.
+        self.assertEqual(remote.hub_time(1075000000 % (1 << 30), us=True), 1070000)
+        self.assertEqual(remote.hub_time(1073000000 - 500000, us=True), 1067500)
+
+    def test_schema(self):
+        """Test that the clock mode and timestamped formats are listed."""
+        self.assertEqual(self.sensor._schema_page(1)[1], b"_clk;dist,h@;*pos,2h*0.1@")
+
+
+class TestHubFileSchema(HubFileTestCase, TestSchema):
+    """Test registering commands with pupremote_hub.py and its schema add-on."""
+
+    addons = (
+        ("pupremote_hub_schema", "SchemaMixin"),
+        ("pupremote_hub_mux", "MuxMixin"),
+        ("pupremote_hub_snapshot", "SnapshotMixin"),
+    )
+
+
+class TestHubFileSnapshotReads(HubFileTestCase, TestSnapshotReads):
+    """Test snapshot reads with pupremote_hub.py and its snapshot add-on."""
+
+    addons = (
+        ("pupremote_hub_snapshot", "SnapshotMixin"),
+        ("pupremote_hub_formats", "FormatMixin"),
+    )
+
+
+class TestHubFilePending(HubFileTestCase, TestPending):
+    """Test waiting for busy calls with pupremote_hub.py and its mux add-on."""
+
+    addons = (("pupremote_hub_mux", "MuxMixin"),)
+
+
+class TestHubFileDeltaChannels(HubFileTestCase, TestDeltaChannels):
+    """Test delta channels with pupremote_hub.py and its formats add-on."""
+
+    addons = (("pupremote_hub_formats", "FormatMixin"),)
+
+
+class TestHubFileFrameSizeProbe(HubFileTestCase, TestFrameSizeProbe):
+    """Test checking the frames the hub can write, with pupremote_hub.py."""
+
+    addons = (
+        ("pupremote_hub_probe", "ProbeMixin"),
+        ("pupremote_hub_schema", "SchemaMixin"),
+        ("pupremote_hub_mux", "MuxMixin"),
+        ("pupremote_hub_bulk", "BulkMixin"),
+        ("pupremote_hub_stream", "StreamMixin"),
+    )
+
+
+class TestHubFileBulkTransfer(HubFileTestCase, TestBulkTransfer):
+    """Test bulk transfers with pupremote_hub.py and its bulk add-on."""
+
+    addons = (("pupremote_hub_bulk", "BulkMixin"),)
+
+
+class TestHubFileStreams(HubFileTestCase, TestStreams):
+    """Test streams with pupremote_hub.py and its stream add-on."""
+
+    addons = (("pupremote_hub_stream", "StreamMixin"),)
+
+
+class TestHubFileBufferedChannel(HubFileTestCase, TestBufferedChannel):
+    """Test buffered channels with pupremote_hub.py and its stream add-on."""
+
+    addons = (("pupremote_hub_stream", "StreamMixin"),)
+
+
+class TestHubFileClockSync(HubFileTestCase, TestClockSync):
+    """Test clock sync with pupremote_hub.py and its clock add-on."""
+
+    addons = (
+        ("pupremote_hub_clock", "ClockMixin"),
+        ("pupremote_hub_mux", "MuxMixin"),
+        ("pupremote_hub_formats", "FormatMixin"),
+    )
+
+
+class TestHubFileWithoutAddons(HubFileTestCase):
+    """Test pupremote_hub.py with sensors that use features of its add-ons."""
+
+    def test_no_probe(self):
+        """Test that a hub without ProbeMixin writes 16 byte frames."""
+        self.pupremote.double = lambda x: 2 * x
+        self.sensor = self.pupremote.PUPRemoteSensor(negotiate=True)
+        self.sensor.add_command("double", "h", "h")
+        self.connect()
+        remote = self.connect_hub(32)
+        remote.add_command("double", "h", "h")
+        self.assertEqual((remote.frame_size, self.sensor.frame_size), (16, 16))
+        self.assertEqual(remote.call("double", 21), 42)
+
+    def test_no_schema(self):
+        """Test that a hub without SchemaMixin registers the commands itself."""
+        self.sensor = self.pupremote.PUPRemoteSensor(schema=True)
+        self.sensor.add_channel("dist", "h")
+        self.connect()
+        remote = self.connect_hub()
+        self.assertEqual(list(remote.modes), [self.pupremote.SCHEMA])
+        remote.add_channel("dist", "h")
+        self.sensor.update_channel("dist", 120)
+        self.assertEqual(remote.call("dist"), 120)
+
+    def test_no_formats(self):
+        """Test that formats of FormatMixin are refused without it."""
+        self.sensor.add_channel("pos", "2h*0.1")
+        self.connect()
+        remote = self.connect_hub()
+        with self.assertRaises(AssertionError):
+            remote.add_channel("pos", "2h*0.1")
+
+
+class TestHeartbeatSchedule(SensorTestCase):
+    """Test the deadlines and timing statistics of the heartbeat loop."""
+
+    def setUp(self):
+        super().setUp()
+        self.now = 0
+        utime = self.pupremote.utime
+        patcher = unittest.mock.patch.object(utime, "ticks_us", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_lateness(self):
+        """Test that lateness is recorded in a histogram of doubling bins."""
+        for self.now in (0, 500, 1500, 3000, 900000):
+            self.sensor._late(0)
+        self.assertEqual(self.sensor.lateness_hist, [2, 1, 1, 0, 0, 0, 0, 1])
+        self.assertEqual(self.sensor.max_lateness_us, 900000)
+
+    def test_no_drift(self):
+        """Test that late rounds shorten the next sleep, or are skipped."""
+        self.now = 4000
+        self.assertEqual(self.sensor._next(0, 10000), (10000, 6000))
+        self.now = 12000
+        self.assertEqual(self.sensor._next(10000, 10000), (20000, 8000))
+        self.now = 35000
+        self.assertEqual(self.sensor._next(20000, 10000), (30000, 0))
+        self.now = 52000
+        self.assertEqual(self.sensor._next(30000, 10000), (52000, 0))
+        self.assertEqual(self.sensor.missed_beats, 1)
+
+
+class TestProtocolThread(SensorTestCase):
+    """Test running the hub communication in a separate thread."""
+
+    def setUp(self):
+        super().setUp()
+        self.pupremote.double = lambda x: 2 * x
+        self.sensor.add_channel("dist", "h")
+        self.sensor.add_command("double", "h", "h")
+        # The protocol thread handles what the hub sends.
+        self.hub = self.connect(process=lambda: None)
+        self.sensor.process_thread(interval_ms=1)
+        self.addCleanup(self.sensor.stop_thread)
+
+    def wait(self, ms=50):
+        import time
+
+        time.sleep(ms / 1000)
+        self.hub.receive()
+
+    def test_link_kept_without_process(self):
+        """Test that heartbeats and channel updates don't need process()."""
+        self.sensor.update_channel("dist", 123)
+        for i in range(3):
+            self.hub.nack()
+            self.wait()
+        self.assertEqual(self.hub.values(0), (123,))
+        self.assertGreaterEqual(self.hub.frames, 4)
+        self.assertTrue(self.sensor.lpup.connected)
+
+    def test_call_handled_by_process(self):
+        """Test that the main loop runs calls the protocol thread queued."""
+        import struct
+
+        self.hub.write(1, struct.pack("<h", 21))
+        self.wait()
+        self.assertEqual(len(self.sensor._callback_queue), 1)
+
+        self.sensor.process()
+        self.wait()
+        self.assertEqual(self.hub.values(1), (42,))
+
+    def test_stop_thread(self):
+        """Test that process() talks to the hub again after stop_thread()."""
+        self.sensor.update_channel("dist", 5)
+        self.sensor.stop_thread()
+        self.assertFalse(self.sensor._thread_running)
+        self.hub.process = self.sensor.process
+        self.sensor.update_channel("dist", 6)
+        self.hub.nack()
+        self.assertEqual(self.hub.values(0), (6,))
+
+
 class TestResultHolder(unittest.TestCase):
     """Test result holder functionality."""
 